@@ -1,10 +1,43 @@
 import os
-import math
+import collections
 import numpy as np
 import pandas as pd
+import storage
+import od
+import instrument
+import timebins
 
 
-def data_read(folder, mode, type_of_data, region=None):
+PANEL_KEYS = ['pickup_month', 'pickup_date', 'pickup_hour', 'pickup_day']
+# the panels of the most recently used (folder, region) pairs, least recently used first
+PANEL_ENTRIES = 8
+_PANELS = collections.OrderedDict()
+
+
+def data_path(folder, mode, type_of_data, region=None, tract=False):
+    """
+    This function returns the path of an aggregated trip file.
+    
+    Args:
+      folder: The folder parameter is a string that represents the directory path where the data file is
+    located.
+      mode: The "mode" parameter refers to the trip being "single" or "shared".   
+      type_of_data: type_of_data is a string that specifies the type of mode either "realized" or "requested".
+      region: the name of the region sub-folder, or None for the citywide files.
+      tract: a boolean indicating whether the path is for the census tract level file.
+    
+    Returns:
+      the path `<folder>[/<region>]/<mode>_trips_df_<type_of_data>_agg[_tract].csv`.
+    """
+    name = mode + '_trips_df_' + type_of_data + \
+        ('_agg_tract.csv' if tract else '_agg.csv')
+    if region is None:
+        return os.path.join(folder, name)
+    return os.path.join(folder, region, name)
+
+
+@instrument.traced
+def data_read(folder, mode, type_of_data, region=None, columns=None):
     """
     This function reads a CSV file containing aggregated data for a specific type of trip and returns it
     as a pandas dataframe.
@@ -17,23 +50,21 @@ def data_read(folder, mode, type_of_data, region=None):
     The realized shared trips are the trips that were actually shared/matched,
     while the requested shared trips are the trips that were requested to be shared. For single trips, the realized shared trips 
     nclude shared trips that were not matched.
+      columns: an optional list of the columns to load. Defaults to all columns.
     
     Returns:
       a pandas DataFrame that is read from a CSV file located in the specified folder, with a file name
     that is constructed based on the input parameters `mode`, `type_of_data`, and the fixed string
-    '_trips_df_' and '_agg.csv'.
+    '_trips_df_' and '_agg.csv'. The file is read through the columnar cache in `storage`, so the
+    columns have the compact dtypes declared there.
     """
-    if region is None:
-        path = os.path.join(folder, mode + '_trips_df_' +
-                            type_of_data + '_agg.csv')
-    else:
-        path = os.path.join(folder, region, mode +
-                            '_trips_df_' + type_of_data + '_agg.csv')
-    df = pd.read_csv(path)
+    path = data_path(folder, mode, type_of_data, region)
+    df = storage.read_table(path, columns)
     return df
 
 
-def data_read2(folder, mode, type_of_data, region=None):
+@instrument.traced
+def data_read2(folder, mode, type_of_data, region=None, columns=None):
     """
     This function reads a CSV file containing aggregated trip data from a specified folder and returns
     it as a pandas dataframe.
@@ -46,71 +77,295 @@ def data_read2(folder, mode, type_of_data, region=None):
     The realized shared trips are the trips that were actually shared/matched,
     while the requested shared trips are the trips that were requested to be shared. For single trips, the realized shared trips 
     nclude shared trips that were not matched.
+      columns: an optional list of the columns to load. Defaults to all columns.
     
     Returns:
       a pandas DataFrame that is read from a CSV file located in the specified folder. The CSV file name
-    is constructed using the input parameters `mode`, `type_of_data`, and a fixed string.
+    is constructed using the input parameters `mode`, `type_of_data`, and a fixed string. The file is
+    read through the columnar cache in `storage`.
     """
-    if region is None:
-        path = os.path.join(folder, mode + '_trips_df_' +
-                            type_of_data + '_agg_tract.csv')
-    else:
-        path = os.path.join(folder, region, mode +
-                            '_trips_df_' + type_of_data + '_agg_tract.csv')
-    df = pd.read_csv(path)
+    path = data_path(folder, mode, type_of_data, region, tract=True)
+    df = storage.read_table(path, columns)
     return df
 
 
-def data_agg(df, base):
+def key_code(df):
     """
-    This function aggregates data from a dataframe and calculates various metrics related to ride
-    sharing, such as total fares, trip distances, and percentages of shared rides, and categorizes the
-    data into time intervals.
+    This function packs the pickup time keys into a single integer that sorts in the order of
+    `PANEL_KEYS` (month, date, hour, day of the week), preceded by the year when the frame has a
+    'year' column and followed by the minute within the hour when it has a 'pickup_minute' column.
+    
+    Args:
+      df: a pandas DataFrame with the columns 'pickup_hour', 'pickup_date', 'pickup_day' and 'pickup_month'.
+    
+    Returns:
+      a numpy int64 array with one code per row.
+    """
+    code = df['pickup_month'].to_numpy(np.int64)
+    if 'year' in df.columns:
+        code = code + df['year'].to_numpy(np.int64)*13
+    code = code*32 + df['pickup_date'].to_numpy(np.int64)
+    code = code*24 + df['pickup_hour'].to_numpy(np.int64)
+    code = code*7 + df['pickup_day'].to_numpy(np.int64)
+    if 'pickup_minute' in df.columns:
+        code = code*60 + df['pickup_minute'].to_numpy(np.int64) % 60
+    return code
+
+
+@instrument.traced
+def align_frames(frames, index=PANEL_KEYS, codes=None):
+    """
+    This function inner-joins frames that have one row per pickup hour. Each frame is sorted once on
+    its packed time key and the frames are aligned by intersecting the sorted keys, which keeps the
+    same rows as successive inner merges on the key columns. Frames with more than one row for a key
+    fall back to those successive `pd.merge` calls, which pair every duplicate row with every match.
+    
+    Args:
+      frames: a list of pandas DataFrames with the key columns in `index`.
+      index: the key columns, in the order used for the index of the result.
+      codes: an optional list with one int64 key array per frame, used instead of `key_code` when the
+    rows are identified by more than the pickup time (for example by OD pair and time).
+    
+    Returns:
+      a pandas DataFrame indexed by `index` in sorted order, with the non-key columns of every frame
+    side by side.
+    """
+    if codes is None:
+        codes = [key_code(df) for df in frames]
+    sorted_codes = []
+    for code in codes:
+        order = np.argsort(code, kind='stable')
+        code = code[order]
+        if (np.diff(code) == 0).any():
+            merged = frames[0]
+            for df in frames[1:]:
+                merged = pd.merge(merged, df, on=list(index))
+            return merged.sort_values(list(index), kind='stable').set_index(index)
+        sorted_codes.append((code, order))
+    common = sorted_codes[0][0]
+    for code, order in sorted_codes[1:]:
+        common = np.intersect1d(common, code, assume_unique=True)
+    columns = []
+    for i, (df, (code, order)) in enumerate(zip(frames, sorted_codes)):
+        rows = order[np.searchsorted(code, common)]
+        part = df.iloc[rows]
+        if i > 0:
+            part = part.drop(columns=index)
+        columns.append(part.reset_index(drop=True))
+    return pd.concat(columns, axis=1).set_index(index)
+
+
+@instrument.traced
+def build_panel(folder, region=None):
+    """
+    This function joins the single realized, shared realized and shared requested files into one
+    hourly panel with `align_frames`, which keeps the same rows as the two inner merges on
+    ['pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month']. Panels are kept in memory per
+    (folder, region) and rebuilt only when one of the files changes; only the last `PANEL_ENTRIES`
+    pairs are kept.
+    
+    Args:
+      folder: The folder parameter is a string that represents the directory path where the data files
+    are located.
+      region: The region parameter is a string that specifies the geographic region, or None for the
+    citywide files.
+    
+    Returns:
+      a pandas DataFrame indexed by `PANEL_KEYS` in sorted order, preceded by 'year' for files that
+    have a year column and followed by 'pickup_minute' for files aggregated in finer time bins (see
+    `ingest.build_aggregates`), with the single realized, shared
+    realized and shared requested columns side by side. The frame is shared between callers and must
+    not be modified in place.
+    """
+    trip_types = [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]
+    paths = [data_path(folder, mode, type_of_data, region) for mode, type_of_data in trip_types]
+    signature = tuple(tuple(sorted(storage.source_signature(path).items())) for path in paths)
+    key = (os.path.abspath(folder), region)
+    if key in _PANELS and _PANELS[key][0] == signature:
+        _PANELS.move_to_end(key)
+        return _PANELS[key][1]
+    frames = [data_read(folder, mode, type_of_data, region) for mode, type_of_data in trip_types]
+    index = ['year'] + PANEL_KEYS if 'year' in frames[0].columns else list(PANEL_KEYS)
+    if 'pickup_minute' in frames[0].columns:
+        index.append('pickup_minute')
+    panel = align_frames(frames, index)
+    _PANELS[key] = (signature, panel)
+    _PANELS.move_to_end(key)
+    while len(_PANELS) > PANEL_ENTRIES:
+        _PANELS.popitem(last=False)
+    return panel
+
+
+def clear_panels():
+    """
+    This function drops every panel kept in memory by `build_panel`.
+    """
+    _PANELS.clear()
+
+
+def factorize_keys(df, base):
+    """
+    This function assigns a group code to every row of a dataframe, the way `df.groupby(base)` does,
+    without building a groupby object. Each key column is factorized once and the codes are combined
+    into a single integer per row.
+    
+    Args:
+      df: a pandas DataFrame containing the key columns.
+      base: The base parameter is a list of columns to group the data by.
+    
+    Returns:
+      a tuple `(codes, keys)` where `keys` is a pandas DataFrame with one row per group, sorted by the
+    key columns, and `codes` is a numpy int64 array with the group of each row. Rows with a missing key,
+    which groupby drops, get the code `len(keys)`.
+    """
+    combined = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    uniques = []
+    radix = 1
+    for column in base:
+        column_codes, column_uniques = pd.factorize(df[column], sort=True)
+        radix *= max(len(column_uniques), 1)
+        if radix >= 2**62:
+            codes = df.groupby(base, sort=True).ngroup().to_numpy(np.int64)
+            keys = df.loc[codes >= 0, base].drop_duplicates().sort_values(base)
+            codes[codes < 0] = len(keys)
+            return codes, keys.reset_index(drop=True)
+        missing |= column_codes < 0
+        combined = combined*len(column_uniques) + column_codes
+        uniques.append(column_uniques)
+    if missing.any():
+        combined[missing] = radix
+    if radix <= 4*len(df) + 1024:
+        occupied = np.bincount(combined, minlength=radix + 1)[:radix] > 0
+        groups = np.flatnonzero(occupied)
+        rank = np.cumsum(occupied) - 1
+        codes = np.append(rank, len(groups))[combined]
+    else:
+        groups, codes = np.unique(combined, return_inverse=True)
+        if missing.any():
+            groups = groups[:-1]
+    keys = {}
+    remainder = groups
+    for column, column_uniques in zip(reversed(base), reversed(uniques)):
+        remainder, position = np.divmod(remainder, len(column_uniques))
+        keys[column] = column_uniques.take(position)
+    keys = pd.DataFrame({column: keys[column] for column in base})
+    for column in base:
+        if keys[column].dtype != df[column].dtype:
+            keys[column] = keys[column].astype(df[column].dtype)
+    return codes.astype(np.int64), keys
+
+
+def group_sum(codes, n_groups, values):
+    """
+    This function sums values per group, skipping missing values like `groupby(...).sum()`.
+    
+    Args:
+      codes: the group codes returned by `factorize_keys`.
+      n_groups: the number of groups.
+      values: a numpy array with one value per row.
+    
+    Returns:
+      a numpy array with one sum per group, as int64 for integer values and float64 otherwise.
+    """
+    if np.issubdtype(values.dtype, np.integer):
+        sums = np.bincount(codes, weights=values, minlength=n_groups + 1)[:n_groups]
+        return sums.round().astype(np.int64)
+    nan = np.isnan(values)
+    if nan.any():
+        values = np.where(nan, 0, values)
+    return np.bincount(codes, weights=values, minlength=n_groups + 1)[:n_groups]
+
+
+def group_count(codes, n_groups, values):
+    """
+    This function counts the non-missing values per group, like `groupby(...).count()`.
+    
+    Args:
+      codes: the group codes returned by `factorize_keys`.
+      n_groups: the number of groups.
+      values: a numpy array with one value per row.
+    
+    Returns:
+      a numpy int64 array with one count per group.
+    """
+    if not np.issubdtype(values.dtype, np.integer):
+        codes = codes[~np.isnan(values)]
+    return np.bincount(codes, minlength=n_groups + 1)[:n_groups].astype(np.int64)
+
+
+def group_mean(codes, n_groups, values):
+    """
+    This function averages values per group, skipping missing values like `groupby(...).mean()`.
+    
+    Args:
+      codes: the group codes returned by `factorize_keys`.
+      n_groups: the number of groups.
+      values: a numpy array with one value per row.
+    
+    Returns:
+      a numpy float64 array with one mean per group.
+    """
+    sums = group_sum(codes, n_groups, values)
+    counts = group_count(codes, n_groups, values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+AGG_COUNTS = ['count_shared_realized', 'count_shared_requested', 'count_single_realized']
+AGG_TOTALS = [measure + '_' + mode + '_realized_total'
+              for measure in ['fare_total', 'trip_miles', 'trip_seconds'] for mode in ['shared', 'single']]
+AGG_STATISTICS = [count + suffix for count in AGG_COUNTS for suffix in ['_total', '_rows']] + AGG_TOTALS
+
+
+@instrument.traced
+def agg_statistics(df, base):
+    """
+    This function reduces a dataframe to the sufficient statistics behind `data_agg`: the sum and the
+    number of rows of each trip count, and the count-weighted fare, mile and second totals. These
+    statistics add up across disjoint sets of rows, so aggregates can be merged.
     
     Args:
       df: a pandas DataFrame containing the data to be aggregated
       base: The base parameter is a list of columns to group the data by for aggregation.
     
     Returns:
-      The function `data_agg` returns a pandas DataFrame that aggregates and calculates various metrics
-    based on the input DataFrame `df` and grouping variable `base`.
-    """
-    df['fare_total_shared_realized_total'] = df['fare_total_shared_realized'] * \
-        df['count_shared_realized']
-    df['fare_total_single_realized_total'] = df['fare_total_single_realized'] * \
-        df['count_single_realized']
-    df['trip_miles_shared_realized_total'] = df['trip_miles_shared_realized'] * \
-        df['count_shared_realized']
-    df['trip_miles_single_realized_total'] = df['trip_miles_single_realized'] * \
-        df['count_single_realized']
-    df['trip_seconds_shared_realized_total'] = df['trip_seconds_shared_realized'] * \
-        df['count_shared_realized']
-    df['trip_seconds_single_realized_total'] = df['trip_seconds_single_realized'] * \
-        df['count_single_realized']
-    df_agg = df.groupby(base).agg(count_shared_realized_total=('count_shared_realized', 'sum'),
-                                  count_shared_realized_mean=(
-                                      'count_shared_realized', 'mean'),
-                                  count_shared_requested_total=(
-                                      'count_shared_requested', 'sum'),
-                                  count_shared_requested_mean=(
-                                      'count_shared_requested', 'mean'),
-                                  count_single_realized_total=(
-                                      'count_single_realized', 'sum'),
-                                  count_single_realized_mean=(
-                                      'count_single_realized', 'mean'),
-                                  fare_total_shared_realized_total=(
-                                      'fare_total_shared_realized_total', 'sum'),
-                                  fare_total_single_realized_total=(
-                                      'fare_total_single_realized_total', 'sum'),
-                                  trip_miles_shared_realized_total=(
-                                      'trip_miles_shared_realized_total', 'sum'),
-                                  trip_miles_single_realized_total=(
-                                      'trip_miles_single_realized_total', 'sum'),
-                                  trip_seconds_shared_realized_total=(
-                                      'trip_seconds_shared_realized_total', 'sum'),
-                                  trip_seconds_single_realized_total=(
-                                      'trip_seconds_single_realized_total', 'sum')
-                                  ).reset_index()
+      a pandas DataFrame with the `base` columns and the `AGG_STATISTICS` columns, one row per group.
+    """
+    codes, df_agg = factorize_keys(df, base)
+    n_groups = len(df_agg)
+    for count in AGG_COUNTS:
+        values = df[count].to_numpy()
+        df_agg[count + '_total'] = group_sum(codes, n_groups, values)
+        df_agg[count + '_rows'] = group_count(codes, n_groups, values)
+    for measure in ['fare_total', 'trip_miles', 'trip_seconds']:
+        for mode in ['shared', 'single']:
+            values = df[measure + '_' + mode + '_realized'].to_numpy(np.float64) * \
+                df['count_' + mode + '_realized'].to_numpy(np.float64)
+            df_agg[measure + '_' + mode + '_realized_total'] = group_sum(codes, n_groups, values)
+    return df_agg
+
+
+@instrument.traced
+def agg_metrics(df_stats):
+    """
+    This function derives the columns of `data_agg` from the sufficient statistics of
+    `agg_statistics`.
+    
+    Args:
+      df_stats: a pandas DataFrame returned by `agg_statistics`, or any subset of its rows.
+    
+    Returns:
+      a new pandas DataFrame with the key columns of `df_stats` followed by the columns of `data_agg`.
+    """
+    keys = [column for column in df_stats.columns if column not in AGG_STATISTICS]
+    df_agg = df_stats[keys].copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for count in AGG_COUNTS:
+            df_agg[count + '_total'] = df_stats[count + '_total']
+            df_agg[count + '_mean'] = df_stats[count + '_total'] / df_stats[count + '_rows']
+    for column in AGG_TOTALS:
+        df_agg[column] = df_stats[column]
     df_agg['fare_minute_single_realized_mean'] = df_agg['fare_total_single_realized_total'] / \
         df_agg['trip_seconds_single_realized_total']*60
     df_agg['fare_minute_shared_realized_mean'] = df_agg['fare_total_shared_realized_total'] / \
@@ -131,21 +386,32 @@ def data_agg(df, base):
         df_agg['fare_minute_single_realized_mean']
     df_agg['cost_ratio_mile'] = df_agg['fare_mile_shared_realized_mean'] / \
         df_agg['fare_mile_single_realized_mean']
-    df_agg['interval'] = "AM Peak"
-    df_agg.loc[(df_agg['pickup_hour'] > 6) & (
-        df_agg['pickup_hour'] < 13), 'interval'] = "Mid-day"
-    df_agg.loc[(df_agg['pickup_hour'] >= 13) & (
-        df_agg['pickup_hour'] <= 18), 'interval'] = "PM Peak"
-    df_agg.loc[(df_agg['pickup_hour'] > 18) | (
-        df_agg['pickup_hour'] < 4), 'interval'] = "Night"
-    colors = {'Night': 'blue', 'AM Peak': 'orange',
-              'Mid-day': 'green', 'PM Peak': 'red'}
-    symbols = {'Night': 'o', 'AM Peak': '^', 'Mid-day': 's', 'PM Peak': 'D'}
-    df_agg['colors'] = df_agg['interval'].map(colors)
-    df_agg['markers'] = df_agg['interval'].map(symbols)
+    df_agg['interval'] = timebins.periods(df_agg)
+    df_agg['colors'] = df_agg['interval'].map(timebins.PERIOD_COLORS)
+    df_agg['markers'] = df_agg['interval'].map(timebins.PERIOD_MARKERS)
     return df_agg
 
 
+@instrument.traced
+def data_agg(df, base):
+    """
+    This function aggregates data from a dataframe and calculates various metrics related to ride
+    sharing, such as total fares, trip distances, and percentages of shared rides, and categorizes the
+    data into time intervals.
+    
+    Args:
+      df: a pandas DataFrame containing the data to be aggregated
+      base: The base parameter is a list of columns to group the data by for aggregation.
+    
+    Returns:
+      The function `data_agg` returns a pandas DataFrame that aggregates and calculates various metrics
+    based on the input DataFrame `df` and grouping variable `base`. The count-weighted totals are
+    reduced per group with `group_sum`, so `df` is left unchanged.
+    """
+    return agg_metrics(agg_statistics(df, base))
+
+
+@instrument.traced
 def agg_hdm(folder, region=None):
     """
     The function aggregates data from different sources and creates a dataframe with calculated trip
@@ -160,13 +426,7 @@ def agg_hdm(folder, region=None):
     trip durations for single and shared rides, grouped by pickup hour, day, and month, and with an
     additional column indicating whether the pickup month is before or after September/October.
     """
-    df_shared_requested = data_read(folder, 'shared', 'requested', region)
-    df_shared_realized = data_read(folder, 'shared', 'realized', region)
-    df_single_realized = data_read(folder, 'single', 'realized', region)
-    df_merged = df_single_realized.merge(df_shared_realized, on=[
-                                         'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
-    df_merged = df_merged.merge(df_shared_requested, on=[
-                                'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
+    df_merged = build_panel(folder, region).reset_index()
     df_merged['trip_minutes_single_realized'] = df_merged['trip_seconds_single_realized']/60
     df_merged['trip_minutes_shared_realized'] = df_merged['trip_seconds_shared_realized']/60
     df_hdm = data_agg(df_merged, ['pickup_hour', 'pickup_day', 'pickup_month'])
@@ -175,6 +435,7 @@ def agg_hdm(folder, region=None):
     return df_hdm
 
 
+@instrument.traced
 def data_agg_weekday_new(df):
     """
     This function aggregates data by weekday, pickup hour, and pickup day, calculates the percentage of
@@ -190,39 +451,31 @@ def data_agg_weekday_new(df):
     `count_total`, the sum of `count_total`, and the sum of `count_shared_requested`. Additionally, the
     function calculates a new column `d or n` based on the pickup hour, and a new column
     """
-    df_weekday = df.groupby(['pickup_hour', 'weekday', 'pickup_day']).agg(count_total=('count_total', 'mean'),
-                                                                          count_total2=(
-                                                                              'count_total', 'sum'),
-                                                                          count_shared_requested=('count_shared_requested', 'sum')).reset_index()
-    df_weekday['d or n'] = 30
-    df_weekday.loc[(df_weekday['pickup_hour'] >= 4) & (
-        df_weekday['pickup_hour'] <= 18), 'd or n'] = 70
+    codes, df_weekday = factorize_keys(df, ['pickup_hour', 'weekday', 'pickup_day'])
+    n_groups = len(df_weekday)
+    count_total = df['count_total'].to_numpy()
+    df_weekday['count_total'] = group_mean(codes, n_groups, count_total)
+    df_weekday['count_total2'] = group_sum(codes, n_groups, count_total)
+    df_weekday['count_shared_requested'] = group_sum(
+        codes, n_groups, df['count_shared_requested'].to_numpy())
+    df_weekday['d or n'] = np.where(timebins.periods(df_weekday, 'day_night') == 'Day', 70, 30)
     df_weekday['requested_per'] = df_weekday['count_shared_requested'] / \
         df_weekday['count_total2']*100
     return df_weekday
 
 
-def df_day(folder, region=None):
+@instrument.traced
+def weekday_metrics(df_merged):
     """
-    This function takes a region as input, reads data from different sources, merges them, calculates
-    various percentages, maps weekdays and weekends, and aggregates the data by weekday.
+    This function adds the total count, the requested and realized shared percentages and the weekday
+    labels to a joined hourly panel and aggregates it by weekday.
     
     Args:
-      region: The region parameter is a string that specifies the geographic region for which the data
-    is being analyzed.
+      df_merged: a pandas DataFrame with the columns of the panel returned by `build_panel`.
     
     Returns:
-      The function `df_day(region)` returns a dataframe `df_merged_weekday_new` after performing some
-    data processing and aggregation operations on the input dataframes `df_shared_requested`,
-    `df_shared_realized`, and `df_single_realized`.
+      the DataFrame returned by `data_agg_weekday_new` for the rows of `df_merged`.
     """
-    df_shared_requested = data_read(folder, 'shared', 'requested', region)
-    df_shared_realized = data_read(folder, 'shared', 'realized', region)
-    df_single_realized = data_read(folder, 'single', 'realized', region)
-    df_merged = df_single_realized.merge(df_shared_realized, on=[
-                                         'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
-    df_merged = df_merged.merge(df_shared_requested, on=[
-                                'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
     df_merged['count_total'] = df_merged['count_single_realized'] + \
         df_merged['count_shared_realized']
     df_merged['requested_per'] = df_merged['count_shared_requested'] / \
@@ -237,14 +490,32 @@ def df_day(folder, region=None):
     df_merged['weekday_weekend'] = "Weekend"
     df_merged.loc[(df_merged['pickup_day'] >= 0) & (
         df_merged['pickup_day'] <= 4), 'weekday_weekend'] = 'Weekday'
-    df_merged['d or n'] = 10
-    df_merged.loc[(df_merged['pickup_hour'] >= 4) & (
-        df_merged['pickup_hour'] <= 18), 'd or n'] = 50
+    df_merged['d or n'] = np.where(timebins.periods(df_merged, 'day_night') == 'Day', 50, 10)
     df_merged_weekday_new = data_agg_weekday_new(
         df_merged[df_merged['pickup_month'] < 13])
     return df_merged_weekday_new
 
 
+@instrument.traced
+def df_day(folder, region=None):
+    """
+    This function takes a region as input, reads data from different sources, merges them, calculates
+    various percentages, maps weekdays and weekends, and aggregates the data by weekday.
+    
+    Args:
+      region: The region parameter is a string that specifies the geographic region for which the data
+    is being analyzed.
+    
+    Returns:
+      The function `df_day(region)` returns a dataframe `df_merged_weekday_new` after performing some
+    data processing and aggregation operations on the input dataframes `df_shared_requested`,
+    `df_shared_realized`, and `df_single_realized`.
+    """
+    df_merged = build_panel(folder, region).reset_index()
+    return weekday_metrics(df_merged)
+
+
+@instrument.traced
 def df_day_Jan_Sep(folder, region):
     """
     This function aggregates and processes data related to ride requests and realizations for weekdays
@@ -260,38 +531,12 @@ def df_day_Jan_Sep(folder, region):
     the week and whether it is a weekday or weekend, and whether the pickup time is during the day or
     night.
     """
-    df_shared_requested = data_read(folder, 'shared', 'requested', region)
-    df_shared_requested = df_shared_requested[df_shared_requested['pickup_month'] <= 9]
-    df_shared_realized = data_read(folder, 'shared', 'realized', region)
-    df_shared_realized = df_shared_realized[df_shared_realized['pickup_month'] <= 9]
-    df_single_realized = data_read(folder, 'single', 'realized', region)
-    df_single_realized = df_single_realized[df_single_realized['pickup_month'] <= 9]
-    df_merged = df_single_realized.merge(df_shared_realized, on=[
-                                         'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
-    df_merged = df_merged.merge(df_shared_requested, on=[
-                                'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
-    df_merged['count_total'] = df_merged['count_single_realized'] + \
-        df_merged['count_shared_realized']
-    df_merged['requested_per'] = df_merged['count_shared_requested'] / \
-        df_merged['count_total']*100
-    df_merged['realized_per'] = df_merged['count_shared_realized'] / \
-        df_merged['count_total']*100
-    df_merged['realized_per2'] = df_merged['count_shared_realized'] / \
-        df_merged['count_shared_requested']*100
-    days = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday',
-            3: 'Thursday', 4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
-    df_merged['weekday'] = df_merged['pickup_day'].map(days)
-    df_merged['weekday_weekend'] = "Weekend"
-    df_merged.loc[(df_merged['pickup_day'] >= 0) & (
-        df_merged['pickup_day'] <= 4), 'weekday_weekend'] = 'Weekday'
-    df_merged['d or n'] = 10
-    df_merged.loc[(df_merged['pickup_hour'] >= 4) & (
-        df_merged['pickup_hour'] <= 18), 'd or n'] = 50
-    df_merged_weekday_new = data_agg_weekday_new(
-        df_merged[df_merged['pickup_month'] < 13])
-    return df_merged_weekday_new
+    df_merged = build_panel(folder, region).reset_index()
+    df_merged = df_merged[df_merged['pickup_month'] <= 9].reset_index(drop=True)
+    return weekday_metrics(df_merged)
 
 
+@instrument.traced
 def merge_tract_trips_weekdays(folder):
     """
     This function merges two dataframes of weekday taxi trips and calculates the total count of trips
@@ -304,20 +549,27 @@ def merge_tract_trips_weekdays(folder):
     Returns:
       a merged dataframe of two input dataframes, with additional columns for total count and
     origin-destination (OD) pairs. The input dataframes are filtered for weekdays and specific time
-    periods.
+    periods. The OD column holds the int64 identifier of `od.pack_od`, which is the same for an OD
+    pair in every call and which `od.unpack_od` turns back into the tract pair.
     """
     df1 = data_read2(folder, 'shared', 'realized')
     df1 = df1[(df1['pickup_day'] < 4) | (
         (df1['pickup_day'] == 4) & (df1['pickup_hour'] <= 14))]
-    df1['Dropoff Census Tract'] = df1['Dropoff Census Tract'].astype(np.int64)
-    df1['Pickup Census Tract'] = df1['Pickup Census Tract'].astype(np.int64)
     df2 = data_read2(folder, 'single', 'realized')
-    df2['Dropoff Census Tract'] = df2['Dropoff Census Tract'].astype(np.int64)
-    df2['Pickup Census Tract'] = df2['Pickup Census Tract'].astype(np.int64)
-    df_merged = df2.merge(df1, on=['Pickup Census Tract', 'Dropoff Census Tract',
-                          'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month'], how='inner')
+    tracts = od.tract_index(df1, df2)
+    # dense ranks of the time slots, so that the packed codes stay small whatever the years
+    slots, ranks = np.unique(np.concatenate([key_code(df2), key_code(df1)]), return_inverse=True)
+    ranks = np.split(ranks.astype(np.int64), [len(df2)])
+    codes = [od.encode_od(df['Pickup Census Tract'], df['Dropoff Census Tract'], tracts) * len(slots)
+             + rank for df, rank in zip((df2, df1), ranks)]
+    index = ['Pickup Census Tract', 'Dropoff Census Tract', 'pickup_hour', 'pickup_date', 'pickup_day',
+             'pickup_month']
+    if 'year' in df2.columns:
+        index.append('year')
+    df_merged = align_frames([df2, df1], index, codes).reset_index()
+    df_merged = df_merged[list(df2.columns) +
+                          [column for column in df1.columns if column not in df2.columns]]
     df_merged['count_total'] = df_merged['count_shared_realized'] + \
         df_merged['count_single_realized']
-    df_merged['OD'] = df_merged['Pickup Census Tract'].astype(
-        str) + df_merged['Dropoff Census Tract'].astype(str)
+    df_merged['OD'] = od.pack_od(df_merged['Pickup Census Tract'], df_merged['Dropoff Census Tract'])
     return df_merged
@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import sys
+import tracemalloc
+import numpy as np
+import pandas as pd
+import analysis
+import fitting
+import storage
+import synthetic
+
+SCALES = {
+    'small': {'years': 1, 'days': 28, 'tracts': 30, 'od_pairs': 200, 'trips_per_hour': 500},
+    'medium': {'years': 1, 'days': 365, 'tracts': 200, 'od_pairs': 2000, 'trips_per_hour': 2000},
+    # five years of citywide data over the 801 census tracts of Chicago
+    'full': {'years': 5, 'days': 365, 'tracts': 801, 'od_pairs': 20000, 'trips_per_hour': 10000},
+}
+FIRST_YEAR = 2019
+HDM_KEYS = ['pickup_hour', 'pickup_day', 'pickup_month']
+# import budgets of the modules loaded by batch workers: the seconds and the growth of the peak
+# resident memory of a fresh interpreter, and the modules they must not load
+PLOTTING_MODULES = ['matplotlib', 'statsmodels', 'adjustText']
+IMPORT_BUDGETS = {'compute': {'seconds': 1.5, 'rss_mb': 150, 'forbidden': PLOTTING_MODULES},
+                  'utils': {'seconds': 1.5, 'rss_mb': 150, 'forbidden': PLOTTING_MODULES}}
+IMPORT_SCRIPT = """
+import sys, json, time, resource
+def peak():
+    # ru_maxrss carries over from the parent on Linux; the high-water mark of /proc starts afresh
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1])*1024 for line in f if line.startswith('VmHWM'))
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+start_rss = peak()
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'rss_mb': (peak() - start_rss)/2**20, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def synthetic_folders(root, scale, seed=0):
+    """
+    This function generates the synthetic data of a benchmark scale, one folder per year, unless the
+    folders already hold data generated with the same parameters.
+
+    Args:
+      root: the directory under which the data of every scale is kept.
+      scale: a key of `SCALES`.
+      seed: the seed of the generator.
+
+    Returns:
+      the list of the year folders of the scale.
+    """
+    params = dict(SCALES[scale], seed=seed)
+    folders = []
+    for i in range(params['years']):
+        folder = os.path.join(root, scale, str(FIRST_YEAR + i))
+        marker = os.path.join(folder, 'synthetic.json')
+        expected = dict(params, year=FIRST_YEAR + i)
+        current = None
+        if os.path.exists(marker):
+            with open(marker) as f:
+                current = json.load(f)
+        if current != expected:
+            storage.clear_cache(folder)
+            synthetic.generate(folder, year=FIRST_YEAR + i, days=params['days'],
+                               tracts=params['tracts'], od_pairs=params['od_pairs'],
+                               trips_per_hour=params['trips_per_hour'], seed=seed + i)
+            with open(marker, 'w') as f:
+                json.dump(expected, f, indent=1)
+        folders.append(folder)
+    return folders
+
+
+def read_csv_files(folder):
+    """
+    This function reads the three citywide trip files from the CSV files, bypassing the cache.
+    """
+    storage.CACHE_ENABLED = False
+    try:
+        return read_cached_files(folder)
+    finally:
+        storage.CACHE_ENABLED = True
+
+
+def read_cached_files(folder):
+    """
+    This function reads the three citywide trip files through the columnar cache.
+    """
+    return [analysis.data_read(folder, mode, type_of_data) for mode, type_of_data in
+            [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]]
+
+
+def warm_cache(folder):
+    """
+    This function fills the columnar cache of a folder and returns the folder.
+    """
+    read_cached_files(folder)
+    return folder
+
+
+def warm_tract_cache(folder):
+    """
+    This function fills the columnar cache of the census tract files of a folder and returns the folder.
+    """
+    for mode, type_of_data in [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]:
+        analysis.data_read2(folder, mode, type_of_data)
+    return folder
+
+
+def warm_panel(folder):
+    """
+    This function builds the in-memory panel of a folder and returns the folder.
+    """
+    analysis.build_panel(folder)
+    return folder
+
+
+def cold_panel(folder):
+    """
+    This function builds the panel of a folder from the cache, without the in-memory copy.
+    """
+    analysis.clear_panels()
+    return analysis.build_panel(folder)
+
+
+def hdm_panel(folder):
+    """
+    This function returns the panel of a folder as `agg_hdm` passes it to `data_agg`.
+    """
+    return analysis.build_panel(folder).reset_index()
+
+
+def hdm_fits(df_hdm):
+    """
+    This function fits every functional form of the match rate and unit fare ratio plots by period.
+    """
+    return fitting.fit_forms(df_hdm, [('count_shared_requested_mean', 'matched_percent'),
+                                      ('count_mean_total', 'cost_ratio_mile')], by=['interval'])
+
+
+def plot_setup(folder):
+    """
+    This function selects a non-interactive backend and returns the `agg_hdm` output of a folder.
+    """
+    import figures
+    figures.init_worker()
+    return analysis.agg_hdm(folder)
+
+
+def periodplot_agg(df_hdm):
+    """
+    This function draws the aggregate match rate plot with the square root fit.
+    """
+    import matplotlib.pyplot as plt
+    import utils
+    utils.periodplot_agg(df_hdm, 'count_shared_requested_mean', 'matched_percent', '', '', '', 'sqrt')
+    plt.close('all')
+    return df_hdm
+
+
+def periodplot_disagg(df_hdm):
+    """
+    This function draws the match rate plot with period effects.
+    """
+    import matplotlib.pyplot as plt
+    import utils
+    utils.periodplot_disagg(df_hdm.copy(), 'count_shared_requested_mean', 'matched_percent', '', '', '')
+    plt.close('all')
+    return df_hdm
+
+
+# (name, setup, run): `setup(folder)` prepares the input of `run` and is not measured
+STAGES = [
+    ('data_read_csv', str, read_csv_files),
+    ('data_read_cached', warm_cache, read_cached_files),
+    ('build_panel', warm_cache, cold_panel),
+    ('data_agg', hdm_panel, lambda df: analysis.data_agg(df, HDM_KEYS)),
+    ('agg_hdm', warm_panel, analysis.agg_hdm),
+    ('data_agg_weekday_new', warm_panel, analysis.df_day),
+    ('merge_tract_trips_weekdays', warm_tract_cache, analysis.merge_tract_trips_weekdays),
+    ('fit_forms', analysis.agg_hdm, hdm_fits),
+    ('periodplot_agg', plot_setup, periodplot_agg),
+    ('periodplot_disagg', plot_setup, periodplot_disagg),
+]
+
+
+def result_rows(result):
+    """
+    This function counts the rows of a stage result, or of a list of results.
+    """
+    if isinstance(result, list):
+        rows = [result_rows(part) for part in result]
+        return None if None in rows else sum(rows)
+    return len(result) if hasattr(result, '__len__') else None
+
+
+def measure_stage(setup, run, folders, repeat=3):
+    """
+    This function measures one stage over the year folders of a scale.
+
+    Args:
+      setup: a function of a folder returning the input of `run`. It is not measured.
+      run: the measured function.
+      folders: the year folders of the scale; a stage run covers every folder.
+      repeat: the number of timed runs.
+
+    Returns:
+      a dictionary with the best and median wall time 'seconds' and 'seconds_median' of a run, the
+    peak traced memory 'peak_mb' of a run and the number of rows of the results 'rows'.
+    """
+    times = []
+    for _ in range(repeat):
+        inputs = [setup(folder) for folder in folders]
+        start = time.perf_counter()
+        results = [run(arg) for arg in inputs]
+        times.append(time.perf_counter() - start)
+    inputs = [setup(folder) for folder in folders]
+    tracemalloc.start()
+    results = [run(arg) for arg in inputs]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'seconds_median': float(np.median(times)),
+            'peak_mb': peak/2**20, 'rows': result_rows(results)}
+
+
+def measure_import(module, repeat=3):
+    """
+    This function measures the import of a module in fresh interpreters.
+
+    Args:
+      module: the name of the module.
+      repeat: the number of interpreters; the best time and memory are kept.
+
+    Returns:
+      a dictionary with the import time 'seconds', the growth of the peak resident memory 'rss_mb' and
+    the top-level names of the loaded 'modules'.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module=module)], cwd=here,
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output))
+    return {'seconds': min(run['seconds'] for run in runs), 'rss_mb': min(run['rss_mb'] for run in runs),
+            'modules': sorted({name.split('.')[0] for name in runs[0]['modules']})}
+
+
+def check_imports(budgets=None, repeat=3):
+    """
+    This function checks that the modules used by batch workers import within their time and memory
+    budgets and without the plotting stack.
+
+    Args:
+      budgets: a dictionary like `IMPORT_BUDGETS`, the default.
+      repeat: the number of fresh interpreters per module.
+
+    Returns:
+      a pandas DataFrame with one row per module with its measures, its budgets, the forbidden modules
+    it loaded and whether it is 'within' budget.
+    """
+    rows = []
+    for module, budget in (budgets or IMPORT_BUDGETS).items():
+        measure = measure_import(module, repeat)
+        loaded = [name for name in budget.get('forbidden', []) if name in measure['modules']]
+        rows.append({'module': module, 'seconds': measure['seconds'], 'seconds_budget': budget['seconds'],
+                     'rss_mb': measure['rss_mb'], 'rss_mb_budget': budget['rss_mb'],
+                     'forbidden_loaded': ','.join(loaded),
+                     'within': measure['seconds'] <= budget['seconds'] and
+                     measure['rss_mb'] <= budget['rss_mb'] and not loaded})
+    return pd.DataFrame(rows)
+
+
+def git_commit():
+    """
+    This function returns the short hash of the checked out commit, or None outside a git checkout.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(root, scale='small', stages=None, repeat=3, history=None, seed=0):
+    """
+    This function runs the benchmark suite at one scale on synthetic data and appends the results to a
+    history file, so that the timings of successive commits can be compared with `compare_runs`.
+
+    Args:
+      root: the directory where the synthetic data is generated and kept between runs.
+      scale: a key of `SCALES`.
+      stages: an optional list of stage names from `STAGES`. Defaults to every stage.
+      repeat: the number of timed runs of each stage. The peak memory is measured in an extra run,
+    since tracing slows the code down.
+      history: the path of the JSON lines history file. Defaults to `<root>/history.jsonl`.
+      seed: the seed of the synthetic data.
+
+    Returns:
+      a pandas DataFrame with one row per stage and the measures of `measure_stage`.
+    """
+    folders = synthetic_folders(root, scale, seed)
+    history = history or os.path.join(root, 'history.jsonl')
+    run_id = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+              'scale': scale, 'python': platform.python_version(), 'numpy': np.__version__,
+              'pandas': pd.__version__}
+    records = []
+    for name, setup, run in STAGES:
+        if stages is not None and name not in stages:
+            continue
+        record = dict(run_id, stage=name, repeat=repeat)
+        record.update(measure_stage(setup, run, folders, repeat))
+        records.append(record)
+        with open(history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return pd.DataFrame(records)
+
+
+def compare_runs(history, scale='small'):
+    """
+    This function compares the last two measures of every stage of a scale in a history file.
+
+    Args:
+      history: the path of the JSON lines history file written by `run_benchmarks`.
+      scale: a key of `SCALES`.
+
+    Returns:
+      a pandas DataFrame indexed by stage with the best time and the peak memory of the previous and the
+    last measure, and their ratios (above 1 when the last measure is slower or uses more memory).
+    """
+    df = pd.read_json(history, lines=True, convert_dates=False)
+    df = df[df['scale'] == scale].sort_values('time', kind='stable')
+    last = df.groupby('stage').nth(-1).set_index('stage')
+    previous = df[df.groupby('stage').cumcount(ascending=False) == 1].set_index('stage')
+    table = pd.DataFrame({'commit_previous': previous['commit'], 'commit_last': last['commit'],
+                          'seconds_previous': previous['seconds'], 'seconds_last': last['seconds'],
+                          'peak_mb_previous': previous['peak_mb'], 'peak_mb_last': last['peak_mb']})
+    table['seconds_ratio'] = table['seconds_last']/table['seconds_previous']
+    table['peak_mb_ratio'] = table['peak_mb_last']/table['peak_mb_previous']
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline on synthetic data.')
+    parser.add_argument('root', nargs='?', help='directory of the synthetic data and of the history file')
+    parser.add_argument('--scale', default='small', choices=list(SCALES))
+    parser.add_argument('--stage', action='append', dest='stages', help='stage to run, repeatable')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--history', default=None)
+    parser.add_argument('--check-imports', action='store_true',
+                        help='check the import budgets of the compute modules and exit')
+    args = parser.parse_args()
+    pd.set_option('display.width', 200)
+    if args.check_imports:
+        imports = check_imports()
+        print(imports.round(3).to_string(index=False))
+        sys.exit(0 if imports['within'].all() else 1)
+    if args.root is None:
+        parser.error('the root directory is required')
+    results = run_benchmarks(args.root, args.scale, args.stages, args.repeat, args.history)
+    print(results[['stage', 'seconds', 'seconds_median', 'peak_mb', 'rows']].to_string(index=False))
+    history = args.history or os.path.join(args.root, 'history.jsonl')
+    print(compare_runs(history, args.scale).loc[results['stage']].round(3).to_string())
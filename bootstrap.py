@@ -0,0 +1,183 @@
+import math
+import concurrent.futures
+import numpy as np
+import analysis
+import fitting
+import instrument
+
+INTERVALS = ['Night', 'AM Peak', 'Mid-day', 'PM Peak']
+
+
+def design_matrix(df, x, y, transform, effects=False):
+    """
+    This function builds the regression design of the scale-effect curves.
+
+    Args:
+      df: a pandas DataFrame such as the output of `agg_hdm`.
+      x: the name of the regressor column.
+      y: the name of the response column.
+      transform: one of `fitting.TRANSFORMS`.
+      effects: a boolean adding AM Peak, Mid-day and PM Peak dummies with Night as the reference, as in
+    `periodplot_disagg`.
+
+    Returns:
+      a tuple `(X, y, rows)` with the design matrix, the (transformed) response and the positions in
+    `df` of the rows without missing or infinite values.
+    """
+    x_values = df[x].to_numpy(np.float64)
+    x_min = np.full(len(df), np.nanmin(x_values))
+    t, y_t = fitting.transform_xy(x_values, df[y].to_numpy(np.float64), transform, x_min)
+    columns = [np.ones(len(df))]
+    if effects:
+        interval = df['interval'].to_numpy()
+        columns += [(interval == level).astype(np.float64) for level in INTERVALS[1:]]
+    columns.append(t)
+    X = np.column_stack(columns)
+    rows = np.flatnonzero(np.isfinite(X).all(axis=1) & np.isfinite(y_t))
+    return X[rows], y_t[rows], rows
+
+
+def weighted_fits(X, y, weights):
+    """
+    This function solves one weighted least squares problem per row of `weights` in a single batched
+    linear algebra call. A replicate whose weighted design is singular, for example one that draws no
+    row of a period, has no unique solution and gets NaN coefficients.
+
+    Args:
+      X: the design matrix, of shape (n, p).
+      y: the response, of length n.
+      weights: the replicate weights, of shape (B, n).
+
+    Returns:
+      a numpy array of shape (B, p) with the coefficients of every replicate, NaN for the singular ones.
+    """
+    weighted = weights[:, :, None]*X[None, :, :]
+    xtwx = np.matmul(weighted.transpose(0, 2, 1), X)
+    xtwy = np.matmul(weighted.transpose(0, 2, 1), y)
+    solvable = np.linalg.matrix_rank(xtwx) == X.shape[1]
+    params = np.full((len(weights), X.shape[1]), np.nan)
+    if solvable.any():
+        params[solvable] = np.linalg.solve(xtwx[solvable], xtwy[solvable][..., None])[..., 0]
+    return params
+
+
+def bootstrap_batch(X, y, blocks, n_blocks, replicates, seed):
+    """
+    This function draws one batch of block bootstrap replicates and refits them. Each replicate draws
+    `n_blocks` blocks with replacement; the number of times a block is drawn becomes the weight of all
+    its rows, so the rows of a block always move together.
+
+    Args:
+      X: the design matrix.
+      y: the response.
+      blocks: the block code of every row.
+      n_blocks: the number of blocks.
+      replicates: the number of replicates in the batch.
+      seed: a `numpy.random.SeedSequence` for the batch.
+
+    Returns:
+      a numpy array of shape (replicates, p) with the refitted coefficients.
+    """
+    rng = np.random.default_rng(seed)
+    draws = rng.multinomial(n_blocks, np.full(n_blocks, 1/n_blocks), size=replicates)
+    return weighted_fits(X, y, draws[:, blocks].astype(np.float64))
+
+
+def curve(params, x_range, transform, x_min, offset=None):
+    """
+    This function evaluates fitted curves on a grid of the regressor.
+
+    Args:
+      params: a numpy array of shape (B, p) of coefficients, with the intercept first and the slope last.
+      x_range: the grid of regressor values.
+      transform: the functional form of the fits.
+      x_min: the minimum of the regressor in the sample, used by the "log" and "reciprocal_offset" forms.
+      offset: an optional index of the coefficient added to the intercept, for the period effects.
+
+    Returns:
+      a numpy array of shape (B, len(x_range)) with the fitted response, transformed back to the scale of
+    the response for the "log" form.
+    """
+    t, _ = fitting.transform_xy(x_range, x_range, transform, np.full(len(x_range), x_min))
+    intercept = params[:, 0] if offset is None else params[:, 0] + params[:, offset]
+    fitted = intercept[:, None] + params[:, -1][:, None]*t[None, :]
+    return 10**fitted if transform == 'log' else fitted
+
+
+@instrument.traced
+def bootstrap_fit(df, x, y, transform='sqrt', effects=False, block=('pickup_month', 'pickup_day'),
+                  replicates=2000, batch_size=250, level=0.95, seed=0, max_workers=None, num=20):
+    """
+    This function computes block bootstrap confidence intervals for the parameters of a scale-effect
+    fit and confidence bands for its curve. Rows are resampled in blocks, by default all the hours of a
+    day of the week in a month of the `agg_hdm` panel, so that the correlation between the hours of a
+    day is kept. Replicates are drawn in batches that are refitted with one batched solve each and
+    spread over a process pool; every batch has its own seed spawned from `seed`, so the result does
+    not depend on the number of workers.
+
+    Args:
+      df: a pandas DataFrame such as the output of `agg_hdm`.
+      x: the name of the regressor column, for example 'count_shared_requested_mean'.
+      y: the name of the response column, for example 'matched_percent'.
+      transform: one of `fitting.TRANSFORMS`.
+      effects: a boolean adding period effects as in `periodplot_disagg`.
+      block: the columns identifying a block, for example ('pickup_month', 'pickup_date') to resample
+    whole days of the hourly panel.
+      replicates: the number of bootstrap replicates.
+      batch_size: the number of replicates refitted together.
+      level: the confidence level of the intervals and bands.
+      seed: the seed of the random draws.
+      max_workers: the number of worker processes. Defaults to the number of CPUs; 1 runs the batches in
+    the calling process.
+      num: the number of grid points of the bands.
+
+    Returns:
+      a dictionary with the point estimates 'params', their intervals 'params_lower' and 'params_upper',
+    the parameter 'names', the coefficients of the kept 'replicates', the number of 'singular'
+    replicates that had no unique fit and were dropped (see `weighted_fits`), and 'bands'. The bands map the
+    period name (or None without period effects) to a dictionary with the grid 'x', the fitted curve
+    'fit' and the band 'lower' and 'upper', on the same grid as `periodplot_agg` and
+    `periodplot_disagg`.
+    """
+    X, y_t, rows = design_matrix(df, x, y, transform, effects)
+    blocks, keys = analysis.factorize_keys(df.iloc[rows], list(block))
+    n_blocks = len(keys)
+    estimate = weighted_fits(X, y_t, np.ones((1, len(y_t))))[0]
+    sizes = [batch_size]*(replicates // batch_size)
+    if replicates % batch_size:
+        sizes.append(replicates % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(X, y_t, blocks, n_blocks, size, child) for size, child in zip(sizes, seeds)]
+    if max_workers == 1:
+        batches = [bootstrap_batch(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            batches = list(pool.map(bootstrap_batch, *zip(*args)))
+    params = np.concatenate(batches)
+    solvable = np.isfinite(params).all(axis=1)
+    singular = int((~solvable).sum())
+    params = params[solvable]
+    alpha = (1 - level)/2*100
+    names = ['Intercept'] + (['AM Peak', 'Mid-day', 'PM Peak'] if effects else []) + [transform]
+    x_values = df[x].to_numpy(np.float64)
+    x_min = np.nanmin(x_values)
+    bands = {}
+    levels = INTERVALS if effects else [None]
+    for interval in levels:
+        subset = x_values if interval is None else x_values[df['interval'].to_numpy() == interval]
+        if len(subset) == 0:
+            continue
+        low = math.floor(np.nanmin(subset))
+        if transform in ('log', 'reciprocal_offset'):
+            # the offset forms are undefined below the sample minimum
+            low = max(low, x_min)
+        x_range = np.linspace(low, math.ceil(np.nanmax(subset)), num=num)
+        offset = None if interval in (None, 'Night') else 1 + INTERVALS[1:].index(interval)
+        fits = curve(params, x_range, transform, x_min, offset)
+        bands[interval] = {'x': x_range,
+                           'fit': curve(estimate[None, :], x_range, transform, x_min, offset)[0],
+                           'lower': np.nanpercentile(fits, alpha, axis=0),
+                           'upper': np.nanpercentile(fits, 100 - alpha, axis=0)}
+    return {'params': estimate, 'params_lower': np.nanpercentile(params, alpha, axis=0),
+            'params_upper': np.nanpercentile(params, 100 - alpha, axis=0), 'names': names,
+            'replicates': params, 'singular': singular, 'bands': bands}
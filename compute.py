@@ -0,0 +1,12 @@
+# the aggregation and fitting functions of the analysis without the plotting stack: batch workers use
+# `from compute import *`, which loads neither matplotlib, adjustText nor statsmodels (see
+# `benchmark.check_imports`)
+from analysis import (data_read, data_read2, build_panel, clear_panels, data_agg, agg_hdm,
+                      data_agg_weekday_new, weekday_metrics, df_day, df_day_Jan_Sep,
+                      merge_tract_trips_weekdays)
+from fitting import TRANSFORMS, fit_forms, best_fits
+from bootstrap import bootstrap_fit
+
+__all__ = ['data_read', 'data_read2', 'build_panel', 'clear_panels', 'data_agg', 'agg_hdm',
+           'data_agg_weekday_new', 'weekday_metrics', 'df_day', 'df_day_Jan_Sep',
+           'merge_tract_trips_weekdays', 'TRANSFORMS', 'fit_forms', 'best_fits', 'bootstrap_fit']
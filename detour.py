@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+
+def read_detour(path, od_path=None):
+    """
+    This function reads the detour table of `Detour_plots.R`.
+
+    Args:
+      path: the path of the detour file, for example 'detour_data_Jan_Sep.txt', with one row per OD pair
+    and hour with at least the 'OD', 'pickup_month', 'count_shared_realized' and 'detour_dis_actual'
+    columns.
+      od_path: an optional path of the OD list, for example 'od_Jan_Sep.txt'. When given, only the OD
+    pairs of the list are kept.
+
+    Returns:
+      a pandas DataFrame with the rows of the detour file.
+    """
+    df_detour = pd.read_csv(path, sep=',')
+    if od_path is not None:
+        df_od = pd.read_csv(od_path, sep=',')
+        df_detour = df_detour[df_detour['OD'].isin(df_od['OD'])]
+    return df_detour
+
+
+def detour_fits(df, x='count_shared_realized', y='detour_dis_actual', months=range(1, 10), nbins=8,
+                level=0.95):
+    """
+    This function fits `y = intercept + slope / x` for every OD pair and computes the binned scatter of
+    each pair in one pass. The table is sorted once by OD and regressor, so every OD pair is a
+    contiguous segment: the least squares sums are reduced per segment and the bins are the quantile
+    bins of the regressor within each segment, as the `binsreg` plots of `Detour_plots.R`.
+
+    Args:
+      df: a pandas DataFrame returned by `read_detour`.
+      x: the name of the regressor column.
+      y: the name of the response column.
+      months: the pickup months to keep. Defaults to January to September, as the paper.
+      nbins: the number of bins of each OD pair.
+      level: the confidence level of the bin means.
+
+    Returns:
+      a tuple `(fits, bins)` of pandas DataFrames. `fits` has one row per OD pair with 'OD', the number
+    of observations 'n', 'intercept', 'slope', the standard error of the slope 'slope_se', 'rmse' (the
+    root mean of the squared residuals, as in `Detour_plots.R`) and 'r2'. `bins` has one row per OD
+    pair and bin with 'OD', 'bin', 'n', the range 'x_low' and 'x_high' and mean 'x_mean' of the
+    regressor, and the mean 'y_mean' of the response with its confidence interval 'y_lower' and
+    'y_upper'. Rows with a missing or non-positive regressor or a missing response are left out.
+    """
+    df = df[df['pickup_month'].isin(list(months))]
+    od = df['OD'].to_numpy()
+    x_values = df[x].to_numpy(np.float64)
+    y_values = df[y].to_numpy(np.float64)
+    valid = np.isfinite(x_values) & (x_values > 0) & np.isfinite(y_values)
+    od, x_values, y_values = od[valid], x_values[valid], y_values[valid]
+    order = np.lexsort((x_values, od))
+    od, x_values, y_values = od[order], x_values[order], y_values[order]
+    starts = np.flatnonzero(np.r_[True, od[1:] != od[:-1]])[:len(od)]
+    sizes = np.diff(np.r_[starts, len(od)])
+    segment = np.repeat(np.arange(len(starts)), sizes)
+
+    t = 1/x_values
+    n = sizes.astype(np.float64)
+    s_t, s_y = np.add.reduceat(t, starts), np.add.reduceat(y_values, starts)
+    s_tt, s_ty = np.add.reduceat(t*t, starts), np.add.reduceat(t*y_values, starts)
+    s_yy = np.add.reduceat(y_values*y_values, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = s_tt - s_t*s_t/n
+        sxy = s_ty - s_t*s_y/n
+        syy = s_yy - s_y*s_y/n
+        slope = sxy/sxx
+        intercept = (s_y - slope*s_t)/n
+        sse = np.maximum(syy - slope*sxy, 0)
+        fits = pd.DataFrame({'OD': od[starts], 'n': sizes, 'intercept': intercept, 'slope': slope,
+                             'slope_se': np.sqrt(sse/(n - 2)/sxx), 'rmse': np.sqrt(sse/n),
+                             'r2': 1 - sse/syy})
+
+    position = np.arange(len(od)) - np.repeat(starts, sizes)
+    code = segment*nbins + position*nbins//np.repeat(sizes, sizes)
+    n_bins = len(starts)*nbins
+    count = np.bincount(code, minlength=n_bins).astype(np.float64)
+    x_sum = np.bincount(code, x_values, minlength=n_bins)
+    y_sum = np.bincount(code, y_values, minlength=n_bins)
+    y_squares = np.bincount(code, y_values*y_values, minlength=n_bins)
+    low = np.full(n_bins, np.nan)
+    high = np.full(n_bins, np.nan)
+    first = np.r_[True, code[1:] != code[:-1]][:len(code)]
+    last = np.r_[code[1:] != code[:-1], True][:len(code)]
+    low[code[first]] = x_values[first]
+    high[code[last]] = x_values[last]
+    critical = scipy.stats.norm.ppf(0.5 + level/2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_mean = y_sum/count
+        y_var = (y_squares - y_sum*y_mean)/(count - 1)
+        half_width = critical*np.sqrt(np.maximum(y_var, 0)/count)
+        bins = pd.DataFrame({'OD': np.repeat(od[starts], nbins),
+                             'bin': np.tile(np.arange(nbins), len(starts)),
+                             'n': count.astype(np.int64), 'x_low': low, 'x_high': high,
+                             'x_mean': x_sum/count, 'y_mean': y_mean, 'y_lower': y_mean - half_width,
+                             'y_upper': y_mean + half_width})
+    return fits, bins[bins['n'] > 0].reset_index(drop=True)
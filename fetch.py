@@ -0,0 +1,333 @@
+import os
+import io
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import http.client
+import urllib.parse
+import concurrent.futures
+import pandas as pd
+import ingest
+
+# the TNP trips dataset of the Chicago Data Portal, in the CSV format of its SODA API
+BASE_URL = 'https://data.cityofchicago.org/resource/m6dm-c72p.csv'
+# the API field names of the raw columns used by `ingest`, with their names in the portal exports
+API_COLUMNS = {'trip_start_timestamp': 'Trip Start Timestamp', 'trip_seconds': 'Trip Seconds',
+               'trip_miles': 'Trip Miles', 'pickup_census_tract': 'Pickup Census Tract',
+               'dropoff_census_tract': 'Dropoff Census Tract',
+               'pickup_community_area': 'Pickup Community Area', 'fare': 'Fare', 'tip': 'Tip',
+               'additional_charges': 'Additional Charges', 'trip_total': 'Trip Total',
+               'shared_trip_authorized': 'Shared Trip Authorized', 'trips_pooled': 'Trips Pooled'}
+BLOCK_SIZE = 1 << 16
+
+
+def day_windows(start, end, days=1):
+    """
+    This function splits a date range into windows of whole days.
+
+    Args:
+      start: the first day, as a `datetime.date` or an ISO date string.
+      end: the day after the last day.
+      days: the number of days of a window.
+
+    Returns:
+      a list of `(first, end)` ISO date string pairs, the end excluded.
+    """
+    start, end = (datetime.date.fromisoformat(str(day)) for day in (start, end))
+    windows = []
+    while start < end:
+        stop = min(start + datetime.timedelta(days=days), end)
+        windows.append((start.isoformat(), stop.isoformat()))
+        start = stop
+    return windows
+
+
+def window_where(window):
+    """
+    This function returns the SoQL filter of the trips that start in a window.
+    """
+    return "trip_start_timestamp >= '%sT00:00:00' AND trip_start_timestamp < '%sT00:00:00'" % window
+
+
+def count_target(url, window):
+    """
+    This function returns the request target counting the trips of a window.
+    """
+    query = urllib.parse.urlencode({'$select': 'count(*) AS count', '$where': window_where(window)})
+    return urllib.parse.urlsplit(url).path + '?' + query
+
+
+def page_target(url, window, offset, page_size):
+    """
+    This function returns the request target of one page of the trips of a window. Pages are ordered
+    by the row identifier, so that the offsets of a window always select the same rows.
+    """
+    query = urllib.parse.urlencode({'$select': ','.join(API_COLUMNS), '$where': window_where(window),
+                                    '$order': ':id', '$limit': page_size, '$offset': offset})
+    return urllib.parse.urlsplit(url).path + '?' + query
+
+
+def page_name(window, offset):
+    """
+    This function returns the name of the staging file of a page.
+    """
+    return '%s_%010d.csv.gz' % (window[0], offset)
+
+
+def connect(url, timeout):
+    """
+    This function opens a persistent HTTP or HTTPS connection to the host of a URL.
+    """
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    return connection(parts.netloc, timeout=timeout)
+
+
+def get(connection, target, headers, sink=None):
+    """
+    This function sends one GET request on a persistent connection, reconnecting once when the server
+    closed it since the last request.
+
+    Args:
+      connection: an `http.client.HTTPConnection`.
+      target: the path and query of the request.
+      headers: the request headers.
+      sink: an optional binary file the body is streamed to in blocks. Without it the body is returned.
+
+    Returns:
+      a tuple `(body, lines)` with the body (None with a `sink`) and its number of lines.
+    """
+    for attempt in range(2):
+        try:
+            connection.request('GET', target, headers=headers)
+            response = connection.getresponse()
+            break
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            connection.close()
+            if attempt:
+                raise
+    if response.status != 200:
+        response.read()
+        raise OSError('HTTP %d %s for %s' % (response.status, response.reason, target))
+    if sink is None:
+        body = response.read()
+        return body, body.count(b'\n')
+    lines = 0
+    for block in iter(lambda: response.read(BLOCK_SIZE), b''):
+        sink.write(block)
+        lines += block.count(b'\n')
+    return None, lines
+
+
+def download_page(connection, target, headers, path):
+    """
+    This function streams one page to a gzip staging file. The file is written under a temporary name
+    and renamed once complete, so a staging file is never partial.
+
+    Returns:
+      a dictionary with the number of data 'rows' and the compressed 'bytes' of the file.
+    """
+    tmp_path = path + '.part'
+    with gzip.open(tmp_path, 'wb', compresslevel=3) as sink:
+        _, lines = get(connection, target, headers, sink)
+    os.replace(tmp_path, path)
+    # the first line is the header
+    return {'rows': max(lines - 1, 0), 'bytes': os.path.getsize(path)}
+
+
+def read_manifest(staging, params):
+    """
+    This function reads the checkpoint manifest of a staging folder, or starts a new one.
+
+    Args:
+      staging: the staging folder.
+      params: the parameters of the pull. A manifest written for other parameters is an error, since
+    its pages would not fit the new pull.
+
+    Returns:
+      a dictionary with the 'params', the trip 'counts' of every window and the completed 'pages'.
+    """
+    path = os.path.join(staging, 'manifest.json')
+    if not os.path.exists(path):
+        return {'params': params, 'counts': {}, 'pages': {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['params'] != params:
+        raise ValueError('the staging folder holds a pull with other parameters: ' +
+                         json.dumps(manifest['params']))
+    # a page counts as done only while its file is there
+    manifest['pages'] = {name: page for name, page in manifest['pages'].items()
+                         if os.path.exists(os.path.join(staging, name))}
+    return manifest
+
+
+def write_manifest(staging, manifest):
+    """
+    This function writes the checkpoint manifest of a staging folder atomically.
+    """
+    path = os.path.join(staging, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+async def fetch(staging, start, end, url=BASE_URL, page_size=50000, concurrency=8, window_days=1,
+                app_token=None, retries=3, timeout=120):
+    """
+    This function downloads the trips of a date range from the paginated SODA endpoint of the TNP trips
+    dataset into gzip staging files, one per page. The range is split into day windows; the trips of
+    every window are counted first, and every page of every window is then a task. The tasks run on
+    `concurrency` workers, each with its own persistent connection, whose requests run in threads so
+    the event loop keeps scheduling. Pages are streamed to disk and recorded in a checkpoint manifest
+    as they complete, so a pull that was interrupted downloads only its missing pages when it is run
+    again with the same arguments.
+
+    Args:
+      staging: the staging folder.
+      start: the first day, as a `datetime.date` or an ISO date string.
+      end: the day after the last day.
+      url: the CSV resource URL of the dataset, or of a local stand-in server.
+      page_size: the number of trips of a page ($limit).
+      concurrency: the number of concurrent requests.
+      window_days: the number of days of a window.
+      app_token: an optional Socrata application token, which raises the rate limits.
+      retries: the number of attempts of a request before the pull fails.
+      timeout: the socket timeout of a request in seconds.
+
+    Returns:
+      the manifest, see `read_manifest`.
+    """
+    os.makedirs(staging, exist_ok=True)
+    windows = day_windows(start, end, window_days)
+    params = {'url': url, 'start': windows[0][0] if windows else str(start), 'end': str(end),
+              'page_size': page_size, 'window_days': window_days, 'columns': list(API_COLUMNS)}
+    manifest = read_manifest(staging, params)
+    headers = {'Accept-Encoding': 'identity'}
+    if app_token:
+        headers['X-App-Token'] = app_token
+    loop = asyncio.get_running_loop()
+    threads = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    async def run_tasks(tasks, action, record):
+        queue = asyncio.Queue()
+        for task in tasks:
+            queue.put_nowait(task)
+
+        async def worker():
+            connection = connect(url, timeout)
+            try:
+                while not queue.empty():
+                    task = queue.get_nowait()
+                    for attempt in range(retries):
+                        try:
+                            result = await loop.run_in_executor(threads, action, connection, task)
+                            break
+                        except (OSError, http.client.HTTPException):
+                            connection.close()
+                            if attempt == retries - 1:
+                                raise
+                            await asyncio.sleep(2**attempt)
+                    record(task, result)
+            finally:
+                connection.close()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, len(tasks)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    def count(connection, window):
+        body, _ = get(connection, count_target(url, window), headers)
+        return int(pd.read_csv(io.BytesIO(body))['count'].iloc[0])
+
+    def download(connection, task):
+        window, offset = task
+        path = os.path.join(staging, page_name(window, offset))
+        return download_page(connection, page_target(url, window, offset, page_size), headers, path)
+
+    def record_count(window, result):
+        manifest['counts'][window[0]] = result
+        write_manifest(staging, manifest)
+
+    def record_page(task, result):
+        window, offset = task
+        expected = min(page_size, manifest['counts'][window[0]] - offset)
+        if result['rows'] != expected:
+            raise OSError('page %s has %d rows instead of %d' % (page_name(window, offset),
+                                                                 result['rows'], expected))
+        manifest['pages'][page_name(window, offset)] = dict(result, window=window[0], offset=offset)
+        write_manifest(staging, manifest)
+
+    try:
+        await run_tasks([window for window in windows if window[0] not in manifest['counts']], count,
+                        record_count)
+        pages = [(window, offset) for window in windows
+                 for offset in range(0, manifest['counts'][window[0]], page_size)
+                 if page_name(window, offset) not in manifest['pages']]
+        await run_tasks(pages, download, record_page)
+    finally:
+        threads.shutdown(wait=True)
+    return manifest
+
+
+def staged_paths(staging):
+    """
+    This function lists the staging files of the completed pages in the order of the trips.
+    """
+    with open(os.path.join(staging, 'manifest.json')) as f:
+        pages = json.load(f)['pages']
+    return [os.path.join(staging, name) for name in sorted(pages)
+            if os.path.exists(os.path.join(staging, name))]
+
+
+def read_staged(staging, chunksize=1000000):
+    """
+    This function reads the staged pages as chunks for `ingest.aggregate_chunks`.
+
+    Args:
+      staging: the staging folder of `fetch`.
+      chunksize: the number of trips of a chunk; small pages are grouped up to it.
+
+    Yields:
+      pandas DataFrames with the column names of the portal exports listed in `ingest.RAW_COLUMNS`
+    and parsed trip start timestamps.
+    """
+    frames, rows = [], 0
+    for path in staged_paths(staging):
+        df = pd.read_csv(path, usecols=list(API_COLUMNS)).rename(columns=API_COLUMNS)
+        df['Trip Start Timestamp'] = pd.to_datetime(df['Trip Start Timestamp'], format='ISO8601')
+        frames.append(df)
+        rows += len(df)
+        if rows >= chunksize:
+            yield pd.concat(frames, ignore_index=True)
+            frames, rows = [], 0
+    if frames:
+        yield pd.concat(frames, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download TNP trips into staging files and aggregate '
+                                                 'them.')
+    parser.add_argument('staging', help='folder of the staged pages and of the manifest')
+    parser.add_argument('start', help='first day, YYYY-MM-DD')
+    parser.add_argument('end', help='day after the last day, YYYY-MM-DD')
+    parser.add_argument('--url', default=BASE_URL)
+    parser.add_argument('--page-size', type=int, default=50000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--app-token', default=os.environ.get('SODA_APP_TOKEN'))
+    parser.add_argument('--aggregate', default=None,
+                        help='folder where the aggregated files are written once the pull is complete')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    manifest = asyncio.run(fetch(args.staging, args.start, args.end, args.url, args.page_size,
+                                 args.concurrency, app_token=args.app_token))
+    print('%d pages, %d trips in %.1f s' % (len(manifest['pages']),
+                                           sum(page['rows'] for page in manifest['pages'].values()),
+                                           time.perf_counter() - started))
+    if args.aggregate:
+        ingest.aggregate_chunks(read_staged(args.staging), args.aggregate)
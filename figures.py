@@ -0,0 +1,181 @@
+import os
+import ast
+import json
+import time
+import hashlib
+import concurrent.futures
+import analysis
+import storage
+
+PAPER_FIGURES = [
+    {'name': 'willingness_to_share', 'plot': 'plot_willingness_to_share', 'data': 'df_day',
+     'region': None, 'title': ''},
+    {'name': 'willingness_to_share_north', 'plot': 'plot_willingness_to_share',
+     'data': 'df_day_Jan_Sep', 'region': 'north', 'title': 'North'},
+    {'name': 'willingness_to_share_south', 'plot': 'plot_willingness_to_share',
+     'data': 'df_day_Jan_Sep', 'region': 'south', 'title': 'South'},
+    {'name': 'match_rate_north', 'plot': 'plot_match_rate', 'data': 'agg_hdm', 'region': 'north',
+     'title': 'North', 'fit': 'sqrt'},
+    {'name': 'match_rate_north_disagg', 'plot': 'plot_match_rate', 'data': 'agg_hdm',
+     'region': 'north', 'title': 'North', 'fit': 'sqrt', 'disaggregate': True},
+    {'name': 'unit_fare_ratio', 'plot': 'plot_unit_fare_ratio', 'data': 'agg_hdm', 'region': None,
+     'title': '', 'fit': 'sqrt'},
+    {'name': 'unit_fare_ratio_north_disagg', 'plot': 'plot_unit_fare_ratio', 'data': 'agg_hdm',
+     'region': 'north', 'title': 'North', 'fit': 'sqrt', 'disaggregate': True},
+]
+# the rendering modules whose source, with that of every in-repo module they import, enters the
+# fingerprint
+CODE_ROOTS = ['analysis', 'utils', 'figures']
+_CODE_FILES = []
+
+
+def code_files(roots=None):
+    """
+    This function lists the source files of the import closure of the analysis and plotting modules
+    within the repository. Imports are read from the syntax tree of every file, so the imports done
+    inside functions, such as the lazy ones of the plotting functions, count too.
+
+    Args:
+      roots: the names of the modules to start from. Defaults to `CODE_ROOTS`, in which case the list
+    is computed once per process.
+
+    Returns:
+      a sorted list of the file names of the modules, relative to the repository folder.
+    """
+    if roots is None and _CODE_FILES:
+        return _CODE_FILES
+    here = os.path.dirname(os.path.abspath(__file__))
+    pending, found = list(CODE_ROOTS if roots is None else roots), set()
+    while pending:
+        name = pending.pop() + '.py'
+        if name in found or not os.path.exists(os.path.join(here, name)):
+            continue
+        found.add(name)
+        with open(os.path.join(here, name), 'rb') as f:
+            tree = ast.parse(f.read(), filename=name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split('.')[0])
+    files = sorted(found)
+    if roots is None:
+        _CODE_FILES.extend(files)
+    return files
+
+
+def figure_fingerprint(spec, folder):
+    """
+    This function computes the fingerprint that decides whether a figure has to be rendered again.
+
+    Args:
+      spec: a figure specification, see `render_figures`.
+      folder: the folder of the aggregated trip files.
+
+    Returns:
+      a hex digest of the specification, the signatures of the three input files of its region and the
+    source of the analysis and plotting modules and of the modules they import (see `code_files`).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(spec, sort_keys=True).encode())
+    for mode, type_of_data in [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]:
+        path = analysis.data_path(folder, mode, type_of_data, spec.get('region'))
+        digest.update(json.dumps(storage.source_signature(path), sort_keys=True).encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in code_files():
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def init_worker():
+    """
+    This function selects the non-interactive Agg backend in a worker process.
+    """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def render_figure(spec, folder, output, formats):
+    """
+    This function builds the data of one figure, draws it and saves it in every requested format.
+
+    Args:
+      spec: a figure specification, see `render_figures`.
+      folder: the folder of the aggregated trip files.
+      output: the folder where the figure files are written.
+      formats: the file extensions to save, for example ('pdf', 'png').
+
+    Returns:
+      a tuple `(name, paths, seconds)` with the written files and the render time.
+    """
+    init_worker()
+    import matplotlib.pyplot as plt
+    import utils
+    start = time.perf_counter()
+    df = getattr(analysis, spec['data'])(folder, spec.get('region'))
+    plot = getattr(utils, spec['plot'])
+    if spec['plot'] == 'plot_willingness_to_share':
+        plot(df, spec.get('title', ''), spec.get('fast', False))
+    else:
+        plot(df, spec.get('title', ''), spec.get('fit'), spec.get('disaggregate', False))
+    paths = []
+    with utils.plot_style():
+        for extension in formats:
+            path = os.path.join(output, spec['name'] + '.' + extension)
+            plt.savefig(path)
+            paths.append(path)
+    plt.close('all')
+    return spec['name'], paths, time.perf_counter() - start
+
+
+def render_figures(specs, folder, output, formats=('pdf', 'png'), max_workers=None, force=False):
+    """
+    This function renders a list of figures in parallel on a process pool, skipping the figures whose
+    specification, input files and plotting code have not changed since they were last written.
+
+    Args:
+      specs: a list of figure specifications such as `PAPER_FIGURES`. Each is a dictionary with a
+    unique 'name', the 'plot' function of `utils` ("plot_willingness_to_share", "plot_match_rate" or
+    "plot_unit_fare_ratio"), the 'data' function of `analysis` that builds its input ("agg_hdm",
+    "df_day" or "df_day_Jan_Sep"), the 'region' (None for citywide) and the 'title', plus 'fit' and
+    'disaggregate' for the match rate and unit fare ratio plots and 'fast' for the willingness to share
+    plot.
+      folder: the folder of the aggregated trip files.
+      output: the folder where the figure files and the manifest are written.
+      formats: the file extensions to save.
+      max_workers: the number of worker processes. Defaults to the number of CPUs.
+      force: a boolean forcing every figure to be rendered again.
+
+    Returns:
+      a dictionary mapping each figure name to a dictionary with its 'paths', its render time in
+    'seconds' (None when skipped) and whether it was 'skipped'.
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest_path = os.path.join(output, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    results = {}
+    pending = {}
+    for spec in specs:
+        fingerprint = figure_fingerprint(spec, folder)
+        paths = [os.path.join(output, spec['name'] + '.' + extension) for extension in formats]
+        if not force and manifest.get(spec['name']) == fingerprint and all(map(os.path.exists, paths)):
+            results[spec['name']] = {'paths': paths, 'seconds': None, 'skipped': True}
+        else:
+            pending[spec['name']] = (spec, fingerprint)
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    initializer=init_worker) as pool:
+            futures = [pool.submit(render_figure, spec, folder, output, formats)
+                       for spec, fingerprint in pending.values()]
+            for future in concurrent.futures.as_completed(futures):
+                name, paths, seconds = future.result()
+                results[name] = {'paths': paths, 'seconds': seconds, 'skipped': False}
+                manifest[name] = pending[name][1]
+                with open(manifest_path + '.tmp', 'w') as f:
+                    json.dump(manifest, f, indent=1, sort_keys=True)
+                os.replace(manifest_path + '.tmp', manifest_path)
+    return results
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import analysis
+import instrument
+
+TRANSFORMS = ['reciprocal', 'linear', 'sqrt', 'log', 'reciprocal_offset']
+
+
+def transform_xy(x, y, transform, x_min):
+    """
+    This function applies one of the functional forms of `utils.periodplot_agg` to the regressor and the
+    response.
+
+    Args:
+      x: a numpy array of regressor values.
+      y: a numpy array of response values.
+      transform: one of "reciprocal", "linear", "sqrt", "log" or "reciprocal_offset".
+      x_min: a numpy array with the minimum of `x` over the segment of each row, used by the "log" and
+    "reciprocal_offset" forms.
+
+    Returns:
+      a tuple `(t, y)` of the transformed regressor and response, so that the fitted model is
+    `y = intercept + slope * t`.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if transform == 'reciprocal':
+            return 1/x, y
+        if transform == 'linear':
+            return x, y
+        if transform == 'sqrt':
+            return np.sqrt(x), y
+        if transform == 'log':
+            return np.log10(x - x_min + 0.01), np.log10(y)
+        if transform == 'reciprocal_offset':
+            return 1/(x - x_min + 0.01), y
+    raise ValueError('unknown transform ' + str(transform))
+
+
+@instrument.traced
+def fit_forms(df, metrics, transforms=TRANSFORMS, by=()):
+    """
+    This function fits `y = intercept + slope * t(x)` by ordinary least squares for every combination
+    of metric pair, functional form and segment in one pass. The per-segment sums needed by the
+    closed-form simple regression are computed for all fits at once with a sparse segment indicator
+    matrix, so no formula is parsed and no model object is built per fit.
+
+    Args:
+      df: a pandas DataFrame such as the output of `agg_hdm` or `df_day`.
+      metrics: a list of `(x, y)` column name pairs, for example
+    [('count_shared_requested_mean', 'matched_percent'), ('count_mean_total', 'cost_ratio_mile')].
+      transforms: the functional forms to fit, from `TRANSFORMS`. The forms match `periodplot_agg`, so
+    "log" regresses log10(y) on log10(x - min(x) + 0.01) with the minimum taken within each segment.
+      by: the columns defining the segments, for example ['region', 'interval', 'month_class'].
+    Defaults to a single segment.
+
+    Returns:
+      a pandas DataFrame with one row per segment, metric pair and form, holding the segment keys, 'x',
+    'y', 'transform', the number of observations 'n', 'intercept', 'slope', the standard error of the
+    slope 'slope_se', the residual mean squared error 'mse' (as `mse_resid` in statsmodels), 'r2' and
+    'aic'. The "aic" of the "log" form includes the Jacobian of the log10 transform, so it is on the
+    scale of the untransformed response and comparable across forms. Rows with a missing or infinite
+    transformed value are left out of their fit.
+    """
+    by = list(by)
+    if by:
+        codes, keys = analysis.factorize_keys(df, by)
+    else:
+        codes, keys = np.zeros(len(df), dtype=np.int64), pd.DataFrame(index=[0])
+    n_groups = len(keys)
+    rows = np.flatnonzero(codes < n_groups)
+    indicator = sp.csr_matrix((np.ones(len(rows)), (codes[rows], rows)), shape=(n_groups, len(df)))
+    fits = []
+    t_columns, y_columns, log_jacobian = [], [], []
+    for x, y in metrics:
+        x_values = df[x].to_numpy(np.float64)
+        y_values = df[y].to_numpy(np.float64)
+        x_min = pd.Series(x_values).groupby(codes).transform('min').to_numpy()
+        for transform in transforms:
+            t, y_t = transform_xy(x_values, y_values, transform, x_min)
+            t_columns.append(t)
+            y_columns.append(y_t)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_jacobian.append(np.log(y_values*np.log(10)) if transform == 'log'
+                                    else np.zeros(len(df)))
+            fits.append((x, y, transform))
+    t = np.column_stack(t_columns)
+    y = np.column_stack(y_columns)
+    valid = np.isfinite(t) & np.isfinite(y)
+    t = np.where(valid, t, 0)
+    y = np.where(valid, y, 0)
+    log_jacobian = np.where(valid, np.column_stack(log_jacobian), 0)
+    n = indicator @ valid.astype(np.float64)
+    s_t, s_y = indicator @ t, indicator @ y
+    s_tt, s_ty, s_yy = indicator @ (t*t), indicator @ (t*y), indicator @ (y*y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = s_tt - s_t*s_t/n
+        sxy = s_ty - s_t*s_y/n
+        syy = s_yy - s_y*s_y/n
+        slope = sxy/sxx
+        intercept = (s_y - slope*s_t)/n
+        sse = np.maximum(syy - slope*sxy, 0)
+        mse = sse/(n - 2)
+        slope_se = np.sqrt(mse/sxx)
+        r2 = 1 - sse/syy
+        llf = -n/2*(np.log(2*np.pi*sse/n) + 1)
+        aic = -2*(llf - indicator @ log_jacobian) + 2*2
+    table = []
+    for j, (x, y, transform) in enumerate(fits):
+        part = keys.copy() if by else pd.DataFrame(index=[0])
+        part['x'] = x
+        part['y'] = y
+        part['transform'] = transform
+        part['n'] = n[:, j].astype(np.int64)
+        part['intercept'] = intercept[:, j]
+        part['slope'] = slope[:, j]
+        part['slope_se'] = slope_se[:, j]
+        part['mse'] = mse[:, j]
+        part['r2'] = r2[:, j]
+        part['aic'] = aic[:, j]
+        table.append(part)
+    return pd.concat(table, ignore_index=True)
+
+
+def best_fits(table, criterion='aic'):
+    """
+    This function selects the best functional form for every segment and metric pair of a fit table.
+
+    Args:
+      table: a pandas DataFrame returned by `fit_forms`.
+      criterion: the column to minimize. Defaults to "aic", which is comparable across forms; the
+    "mse" of the "log" form is on the log10 scale and should not be compared with the other forms.
+
+    Returns:
+      the rows of `table` with the lowest criterion per segment and metric pair.
+    """
+    groups = [column for column in table.columns
+              if column not in ('transform', 'n', 'intercept', 'slope', 'slope_se', 'mse', 'r2', 'aic')]
+    table = table.dropna(subset=[criterion])
+    best = table.groupby(groups, sort=False)[criterion].idxmin()
+    return table.loc[best.to_numpy()].reset_index(drop=True)
@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+import analysis
+import fitting
+import instrument
+
+# OD pair, hour of the week and month effects of the tract panel of `merge_tract_trips_weekdays`
+TRACT_EFFECTS = ['OD', ['pickup_day', 'pickup_hour'], 'pickup_month']
+
+
+def effect_codes(df, absorb):
+    """
+    This function factorizes the fixed-effect dimensions of a regression.
+
+    Args:
+      df: a pandas DataFrame.
+      absorb: a list of dimensions, each a column name or a list of columns whose combinations are the
+    levels, such as `TRACT_EFFECTS`.
+
+    Returns:
+      a tuple `(codes, sizes)` with the numpy int64 level codes of every dimension and their numbers of
+    levels. Rows with a missing key get the code `sizes[i]`.
+    """
+    codes, sizes = [], []
+    for dimension in absorb:
+        columns = [dimension] if isinstance(dimension, str) else list(dimension)
+        dimension_codes, keys = analysis.factorize_keys(df, columns)
+        codes.append(dimension_codes)
+        sizes.append(len(keys))
+    return codes, sizes
+
+
+def drop_singletons(codes, keep):
+    """
+    This function drops the rows that are alone in a level of some dimension, repeating until none is
+    left, since a fixed effect fits them exactly and they only bias the degrees of freedom.
+
+    Args:
+      codes: the level codes of every dimension.
+      keep: a boolean numpy array of the rows kept so far.
+
+    Returns:
+      the boolean numpy array of the rows kept.
+    """
+    keep = keep.copy()
+    while True:
+        dropped = 0
+        for dimension_codes in codes:
+            counts = np.bincount(dimension_codes[keep], minlength=dimension_codes.max(initial=0) + 1)
+            alone = keep & (counts[np.where(keep, dimension_codes, 0)] == 1)
+            dropped += alone.sum()
+            keep &= ~alone
+        if not dropped:
+            return keep
+
+
+def demean(values, codes, sizes, tol=1e-8, max_iter=10000):
+    """
+    This function removes the fixed effects of several dimensions from columns by alternating
+    projections: every sweep subtracts the level means of each dimension in turn, computed with
+    `np.bincount` over the level codes, until a sweep changes no value by more than the tolerance. A
+    single dimension takes one sweep. Memory is a few arrays of the length of the columns.
+
+    Args:
+      values: a float64 numpy array of shape (rows, columns), demeaned in place.
+      codes: the level codes of every dimension, for the same rows.
+      sizes: the numbers of levels of every dimension.
+      tol: the convergence tolerance, relative to the largest absolute value of the columns.
+      max_iter: the maximum number of sweeps.
+
+    Returns:
+      a tuple `(values, sweeps, converged)`.
+    """
+    counts = [np.maximum(np.bincount(dimension_codes, minlength=size), 1)
+              for dimension_codes, size in zip(codes, sizes)]
+    scale = max(np.abs(values).max(initial=0.0), 1.0)
+    for sweep in range(1, max_iter + 1):
+        change = 0.0
+        for dimension_codes, size, count in zip(codes, sizes, counts):
+            for j in range(values.shape[1]):
+                means = np.bincount(dimension_codes, weights=values[:, j], minlength=size)/count
+                values[:, j] -= means[dimension_codes]
+                change = max(change, np.abs(means).max(initial=0.0))
+        if len(codes) == 1 or change <= tol*scale:
+            return values, sweep, True
+    return values, max_iter, False
+
+
+def nested_in(dimension_codes, cluster_codes):
+    """
+    This function tells whether every level of a dimension lies within a single cluster.
+    """
+    pairs = np.unique(dimension_codes*(cluster_codes.max() + 1) + cluster_codes)
+    return len(pairs) == len(np.unique(dimension_codes))
+
+
+@instrument.traced
+def absorb_fit(df, x, y, absorb=TRACT_EFFECTS, transforms=('sqrt',), cluster='OD', singletons=False,
+               tol=1e-8, max_iter=10000):
+    """
+    This function fits `y = slope * t(x) + fixed effects` with any number of high-dimensional fixed
+    effects, such as the OD pair, hour of the week and month effects of the tract panel. The effects
+    are absorbed by demeaning `t(x)` and `y` over factorized level codes (see `demean`) instead of
+    building dummy columns, so only the slope is solved for and memory grows linearly with the rows.
+    By the Frisch-Waugh-Lovell theorem the slope equals that of the regression with all the dummies.
+
+    Args:
+      df: a pandas DataFrame such as the output of `merge_tract_trips_weekdays`.
+      x: the name of the regressor column, for example 'count_shared_realized'.
+      y: the name of the response column.
+      absorb: the fixed-effect dimensions, each a column name or a list of columns, see `effect_codes`.
+    Defaults to `TRACT_EFFECTS`.
+      transforms: the functional forms of the regressor to fit, from `fitting.TRANSFORMS`.
+      cluster: the column of the clusters of the standard errors, or None for homoskedastic standard
+    errors.
+      singletons: a boolean keeping the rows alone in a level of some dimension. By default they are
+    dropped.
+      tol: the convergence tolerance of `demean`.
+      max_iter: the maximum number of sweeps of `demean`.
+
+    Returns:
+      a pandas DataFrame with one row per form with 'x', 'y', 'transform', the number of observations
+    'n', the number of absorbed parameters 'absorbed', 'slope', its standard error 'slope_se' (clustered
+    with the small-sample correction of Stata and reghdfe, where effects nested in the clusters do not
+    count), the number of 'clusters', the within 'r2_within', and the 'sweeps' and 'converged' flag of
+    the demeaning. Rows with a missing or infinite transformed value or a missing key are left out.
+    """
+    codes, sizes = effect_codes(df, absorb)
+    x_values = df[x].to_numpy(np.float64)
+    y_values = df[y].to_numpy(np.float64)
+    keyed = np.ones(len(df), dtype=bool)
+    for dimension_codes, size in zip(codes, sizes):
+        keyed &= dimension_codes < size
+    if cluster is not None:
+        cluster_codes = pd.factorize(df[cluster])[0]
+        keyed &= cluster_codes >= 0
+    table = []
+    for transform in transforms:
+        t, y_t = fitting.transform_xy(x_values, y_values, transform, np.nanmin(x_values))
+        keep = keyed & np.isfinite(t) & np.isfinite(y_t)
+        if not singletons:
+            keep = drop_singletons(codes, keep)
+        rows = np.flatnonzero(keep)
+        # re-factorize the kept rows so that levels without rows do not count
+        kept = [pd.factorize(dimension_codes[rows])[0] for dimension_codes in codes]
+        kept_sizes = [int(dimension_codes.max(initial=-1)) + 1 for dimension_codes in kept]
+        values = np.column_stack([t[rows], y_t[rows]])
+        values, sweeps, converged = demean(values, kept, kept_sizes, tol, max_iter)
+        t_d, y_d = values[:, 0], values[:, 1]
+        n = len(rows)
+        stt = t_d @ t_d
+        slope = (t_d @ y_d)/stt if stt > 0 else np.nan
+        residuals = y_d - slope*t_d
+        absorbed = sum(kept_sizes) - max(len(kept) - 1, 0)
+        row = {'x': x, 'y': y, 'transform': transform, 'n': n, 'absorbed': absorbed, 'slope': slope}
+        if cluster is None:
+            row['slope_se'] = np.sqrt(residuals @ residuals/(n - 1 - absorbed)/stt)
+            row['clusters'] = np.nan
+        else:
+            groups = pd.factorize(cluster_codes[rows])[0]
+            n_clusters = int(groups.max(initial=-1)) + 1
+            nested = [nested_in(dimension_codes, groups) for dimension_codes in kept]
+            outside = [size for size, inside in zip(kept_sizes, nested) if not inside]
+            absorbed_outside = sum(outside) - (len(outside) if any(nested) else max(len(outside) - 1, 0))
+            scores = np.bincount(groups, weights=t_d*residuals, minlength=n_clusters)
+            correction = n_clusters/(n_clusters - 1)*(n - 1)/(n - 1 - absorbed_outside)
+            row['slope_se'] = np.sqrt(correction*(scores @ scores))/stt
+            row['clusters'] = n_clusters
+        row['r2_within'] = 1 - (residuals @ residuals)/(y_d @ y_d)
+        row['sweeps'] = sweeps
+        row['converged'] = converged
+        table.append(row)
+    return pd.DataFrame(table)
@@ -0,0 +1,200 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import analysis
+import storage
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+STORE_KEYS = ['region', 'pickup_hour', 'pickup_day', 'pickup_month']
+CITYWIDE = 'citywide'
+# the trip count totals, which `agg_hdm` returns as integers
+COUNT_COLUMNS = [count + '_total' for count in analysis.AGG_COUNTS] + ['count_total_total']
+
+
+def month_statistics(folder, region=None):
+    """
+    This function computes the sufficient statistics of one delivery of aggregated trip files, for
+    example a new month, grouped like `agg_hdm`.
+
+    Args:
+      folder: the folder of the aggregated trip files of the delivery.
+      region: The region parameter is a string that specifies the geographic region, or None for the
+    citywide files.
+
+    Returns:
+      a pandas DataFrame indexed by `STORE_KEYS` with the `analysis.AGG_STATISTICS` columns.
+    """
+    panel = analysis.build_panel(folder, region).reset_index()
+    stats = analysis.agg_statistics(panel, ['pickup_hour', 'pickup_day', 'pickup_month'])
+    stats.insert(0, 'region', CITYWIDE if region is None else region)
+    return stats.set_index(STORE_KEYS)
+
+
+def empty_store():
+    """
+    This function returns a store with no groups.
+
+    Returns:
+      an empty pandas DataFrame indexed by `STORE_KEYS` with the `analysis.AGG_STATISTICS` columns.
+    """
+    index = pd.MultiIndex.from_arrays([[] for _ in STORE_KEYS], names=STORE_KEYS)
+    return pd.DataFrame(columns=analysis.AGG_STATISTICS, index=index, dtype='float64')
+
+
+def fold(store, stats):
+    """
+    This function adds the statistics of new rows to a store and recomputes the derived columns of the
+    groups they touch. Groups that are not in `stats` are left as they are.
+
+    Args:
+      store: a pandas DataFrame returned by `empty_store`, `load_store` or a previous `fold`.
+      stats: a pandas DataFrame returned by `month_statistics`.
+
+    Returns:
+      the updated store, sorted by its index, holding the statistics and the derived `data_agg` columns
+    of every group, with the `COUNT_COLUMNS` as int64.
+    """
+    common = stats.index.intersection(store.index)
+    new = stats.index.difference(store.index)
+    if len(common):
+        store.loc[common, analysis.AGG_STATISTICS] = \
+            store.loc[common, analysis.AGG_STATISTICS].to_numpy() + \
+            stats.loc[common, analysis.AGG_STATISTICS].to_numpy()
+    if len(new):
+        store = pd.concat([store, stats.loc[new, analysis.AGG_STATISTICS]]).sort_index()
+    changed = stats.index
+    metrics = analysis.agg_metrics(store.loc[changed, analysis.AGG_STATISTICS].reset_index())
+    metrics = metrics.set_index(STORE_KEYS)
+    derived = [column for column in metrics.columns if column not in analysis.AGG_STATISTICS]
+    for column in derived:
+        if column not in store.columns:
+            store[column] = pd.Series(dtype=metrics[column].dtype)
+        store.loc[changed, column] = metrics[column]
+    for column in COUNT_COLUMNS:
+        store[column] = store[column].astype(np.int64)
+    return store
+
+
+def load_store(path):
+    """
+    This function reads a store saved by `save_store`.
+
+    Args:
+      path: the path of the store file.
+
+    Returns:
+      a tuple `(store, folded)` with the store and the list of the signatures of the deliveries that
+    were folded into it. A missing file gives an empty store. Stores written before the list moved
+    into the file read it from their `.json` sidecar.
+    """
+    if not os.path.exists(path):
+        return empty_store(), []
+    if feather is None:
+        raise ImportError('reading a store requires pyarrow')
+    table = feather.read_table(path)
+    metadata = table.schema.metadata or {}
+    if b'folded' in metadata:
+        folded = json.loads(metadata[b'folded'])
+    else:
+        with open(path + '.json') as f:
+            folded = json.load(f)['folded']
+    return table.to_pandas().set_index(STORE_KEYS), folded
+
+
+def save_store(store, folded, path):
+    """
+    This function writes a store and the list of folded deliveries, replacing any previous version.
+    The list is kept in the schema metadata of the Feather file and the file is written under a
+    temporary name first, so a crash leaves either the old store or the new one, each with its own
+    list, and never a store with the list of another version.
+
+    Args:
+      store: the store to write.
+      folded: the list of the signatures of the deliveries folded into the store.
+      path: the path of the store file.
+    """
+    if pa is None:
+        raise ImportError('writing a store requires pyarrow')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    table = pa.Table.from_pandas(store.reset_index(), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'folded'] = json.dumps(folded).encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    feather.write_feather(table, tmp_path)
+    os.replace(tmp_path, path)
+    if os.path.exists(path + '.json'):
+        os.remove(path + '.json')
+
+
+def delivery_signature(folder, region=None):
+    """
+    This function identifies a delivery of aggregated trip files by the content of its files.
+
+    Args:
+      folder: the folder of the aggregated trip files of the delivery.
+      region: the region sub-folder, or None for the citywide files.
+
+    Returns:
+      a hex digest of the region and of the content hashes of the three files.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(region).encode())
+    for mode, type_of_data in [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]:
+        path = analysis.data_path(folder, mode, type_of_data, region)
+        digest.update(storage.source_signature(path, 'hash')['hash'].encode())
+    return digest.hexdigest()
+
+
+def update_store(path, folder, regions=(None,)):
+    """
+    This function folds a new delivery of aggregated trip files, such as the files of one new month,
+    into the store at `path`. Only the new files are read, and only the groups they touch are
+    recomputed, so the time of an update depends on the size of the delivery and not on the history.
+    A delivery that was already folded is skipped.
+
+    Args:
+      path: the path of the store file.
+      folder: the folder of the aggregated trip files of the delivery.
+      regions: the region sub-folders to fold, with None for the citywide files.
+
+    Returns:
+      the updated store.
+    """
+    store, folded = load_store(path)
+    for region in regions:
+        signature = delivery_signature(folder, region)
+        if signature in folded:
+            continue
+        store = fold(store, month_statistics(folder, region))
+        folded.append(signature)
+    save_store(store, folded, path)
+    return store
+
+
+def store_hdm(store, region=None):
+    """
+    This function returns the aggregate of one region in the layout of `agg_hdm`.
+
+    Args:
+      store: a store returned by `fold`, `load_store` or `update_store`.
+      region: the region name, or None for the citywide data.
+
+    Returns:
+      a pandas DataFrame with the same columns as `agg_hdm(folder, region)` over every delivery folded
+    into the store.
+    """
+    rows = store.xs(CITYWIDE if region is None else region, level='region').reset_index()
+    columns = analysis.agg_metrics(empty_store().reset_index()).columns.drop('region')
+    df_hdm = rows[list(columns)].copy()
+    df_hdm['month_class'] = "pre-Sep"
+    df_hdm.loc[(df_hdm['pickup_month'] >= 10), 'month_class'] = "post-Oct"
+    return df_hdm
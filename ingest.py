@@ -0,0 +1,209 @@
+import os
+import numpy as np
+import pandas as pd
+import analysis
+import timebins
+
+TIME_KEYS = ['pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month']
+# the year keeps the same month, date and hour of different years apart in multi-year extracts
+YEAR_KEY = 'year'
+TRACT_KEYS = ['Pickup Census Tract', 'Dropoff Census Tract']
+MEASURES = ['trip_seconds', 'trip_miles', 'trip_mph', 'fare_mile', 'fare_minute',
+            'fare_total', 'fare', 'tip', 'additional_charge']
+TRIP_TYPES = [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]
+RAW_COLUMNS = {'Trip Start Timestamp': 'start', 'Trip Seconds': 'trip_seconds',
+               'Trip Miles': 'trip_miles', 'Pickup Census Tract': 'Pickup Census Tract',
+               'Dropoff Census Tract': 'Dropoff Census Tract',
+               'Pickup Community Area': 'pickup_community_area', 'Fare': 'fare',
+               'Tip': 'tip', 'Additional Charges': 'additional_charge',
+               'Trip Total': 'fare_total', 'Shared Trip Authorized': 'shared_authorized',
+               'Trips Pooled': 'trips_pooled'}
+TIMESTAMP_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
+def prepare_chunk(chunk, bin_width=None):
+    """
+    This function cleans one chunk of the raw TNP trip extract and adds the pickup time keys and the
+    per-trip speed and unit fare measures.
+
+    Args:
+      chunk: a pandas DataFrame with the raw Chicago Data Portal column names listed in `RAW_COLUMNS`.
+    The trip start timestamps are either text in `TIMESTAMP_FORMAT` or already parsed.
+      bin_width: an optional time bin width in minutes, such as 5, 15 or 30. When given, a
+    `pickup_minute` key with the first minute of the day of the bin of each trip is added. The
+    timestamps of the extract are rounded to 15 minutes, so finer bins are only meaningful for other
+    extracts.
+
+    Returns:
+      a pandas DataFrame with the columns renamed to the names used in the aggregated files, the
+    `year`, `pickup_hour`, `pickup_date`, `pickup_day` and `pickup_month` keys, and boolean
+    `shared_requested` and `shared_realized` flags. Trips with a non-positive duration or distance
+    are dropped because their speed and unit fares are undefined.
+    """
+    df = chunk.rename(columns=RAW_COLUMNS)
+    df = df[(df['trip_seconds'] > 0) & (df['trip_miles'] > 0)].copy()
+    start = df['start']
+    if not pd.api.types.is_datetime64_any_dtype(start):
+        start = pd.to_datetime(start, format=TIMESTAMP_FORMAT)
+    df[YEAR_KEY] = start.dt.year.astype(np.int16)
+    df['pickup_hour'] = start.dt.hour.astype(np.int8)
+    df['pickup_date'] = start.dt.day.astype(np.int8)
+    df['pickup_day'] = start.dt.dayofweek.astype(np.int8)
+    df['pickup_month'] = start.dt.month.astype(np.int8)
+    if bin_width is not None:
+        if 60 % bin_width:
+            raise ValueError('the bin width must divide the hour')
+        minutes = start.dt.hour.to_numpy(np.int64)*60 + start.dt.minute.to_numpy(np.int64)
+        df['pickup_minute'] = timebins.bin_minutes(minutes, bin_width).astype(np.int16)
+    df['trip_mph'] = df['trip_miles'] / df['trip_seconds'] * 3600
+    df['fare_mile'] = df['fare_total'] / df['trip_miles']
+    df['fare_minute'] = df['fare_total'] / df['trip_seconds'] * 60
+    authorized = df['shared_authorized']
+    if authorized.dtype != bool:
+        authorized = authorized.astype(str).str.lower() == 'true'
+    df['shared_requested'] = authorized
+    df['shared_realized'] = authorized & (df['trips_pooled'].fillna(1) > 1)
+    return df
+
+
+def chunk_partials(df, tract=False):
+    """
+    This function folds a prepared chunk into partial aggregates, one for each trip type. Partials
+    hold sums and counts only, so partials from different chunks can be merged by adding them.
+
+    Args:
+      df: a pandas DataFrame returned by `prepare_chunk`.
+      tract: a boolean indicating whether the partials are keyed by census tract pair in addition to
+    the year and the pickup time keys.
+
+    Returns:
+      a dictionary mapping each `(mode, type_of_data)` pair in `TRIP_TYPES` to a pandas DataFrame
+    indexed by the grouping keys, with one `<measure>_sum` and one `<measure>_n` column per measure,
+    the sum and the number of non-missing values, and a `count` column with the number of trips.
+    Shared trips that were requested but not matched are counted as single realized trips.
+    """
+    time_keys = [YEAR_KEY] + TIME_KEYS
+    if 'pickup_minute' in df.columns:
+        time_keys.append('pickup_minute')
+    keys = TRACT_KEYS + time_keys if tract else time_keys
+    if tract:
+        df = df.dropna(subset=TRACT_KEYS)
+    masks = {('single', 'realized'): ~df['shared_realized'],
+             ('shared', 'realized'): df['shared_realized'],
+             ('shared', 'requested'): df['shared_requested']}
+    partials = {}
+    for trip_type, mask in masks.items():
+        grouped = df.loc[mask, keys + MEASURES].groupby(keys)
+        partial = pd.concat([grouped[MEASURES].sum().add_suffix('_sum'),
+                             grouped[MEASURES].count().add_suffix('_n')], axis=1)
+        partial['count'] = grouped.size()
+        partials[trip_type] = partial
+    return partials
+
+
+def merge_partials(partials):
+    """
+    This function merges partial aggregates that share the same grouping keys.
+
+    Args:
+      partials: a list of pandas DataFrames returned by `chunk_partials` for the same trip type.
+
+    Returns:
+      a single pandas DataFrame with the sums and counts of all the partials added together per group.
+    """
+    if len(partials) == 1:
+        return partials[0]
+    merged = pd.concat(partials)
+    return merged.groupby(level=list(range(merged.index.nlevels))).sum()
+
+
+def finalize_partial(partial, mode, type_of_data):
+    """
+    This function converts a partial aggregate into the layout that `data_read` and `data_read2`
+    expect.
+
+    Args:
+      partial: a pandas DataFrame returned by `chunk_partials` or `merge_partials`.
+      mode: The "mode" parameter refers to the trip being "single" or "shared".
+      type_of_data: type_of_data is a string that specifies the type of mode either "realized" or "requested".
+
+    Returns:
+      a pandas DataFrame with the grouping keys as columns, one mean column per measure named
+    `<measure>_<mode>_<type_of_data>` and a `count_<mode>_<type_of_data>` column. Means skip missing
+    values like `groupby().mean()`, so they divide by the non-missing values of the measure and not by
+    the number of trips. Requested shared trips only carry the count column.
+    """
+    suffix = '_' + mode + '_' + type_of_data
+    df = pd.DataFrame(index=partial.index)
+    if type_of_data == 'realized':
+        for measure in MEASURES:
+            df[measure + suffix] = partial[measure + '_sum'] / partial[measure + '_n']
+    df['count' + suffix] = partial['count'].astype(np.int64)
+    return df.sort_index().reset_index()
+
+
+def aggregate_chunks(chunks, folder, tract=False, regions=None, merge_every=8, bin_width=None):
+    """
+    This function aggregates a stream of raw trip chunks and writes the aggregated single and shared
+    trip files, see `build_aggregates`.
+
+    Args:
+      chunks: an iterable of pandas DataFrames accepted by `prepare_chunk`, such as a chunked CSV reader
+    or `fetch.read_staged`.
+      folder, tract, regions, merge_every, bin_width: see `build_aggregates`.
+
+    Returns:
+      a dictionary mapping `(region, mode, type_of_data)` to the path of each written file, with
+    region None for the citywide files.
+    """
+    scopes = {None: None}
+    if regions is not None:
+        scopes.update({name: set(areas) for name, areas in regions.items()})
+    pending = {(scope, trip_type): [] for scope in scopes for trip_type in TRIP_TYPES}
+    for chunk in chunks:
+        df = prepare_chunk(chunk, bin_width)
+        for scope, areas in scopes.items():
+            scoped = df if areas is None else df[df['pickup_community_area'].isin(areas)]
+            for trip_type, partial in chunk_partials(scoped, tract).items():
+                parts = pending[(scope, trip_type)]
+                parts.append(partial)
+                if len(parts) >= merge_every:
+                    pending[(scope, trip_type)] = [merge_partials(parts)]
+    paths = {}
+    for (scope, (mode, type_of_data)), parts in pending.items():
+        if not parts:
+            continue
+        df = finalize_partial(merge_partials(parts), mode, type_of_data)
+        path = analysis.data_path(folder, mode, type_of_data, scope, tract)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        df.to_csv(path, index=False)
+        paths[(scope, mode, type_of_data)] = path
+    return paths
+
+
+def build_aggregates(raw_path, folder, tract=False, regions=None, chunksize=1000000, merge_every=8,
+                     bin_width=None):
+    """
+    This function streams the raw TNP trip extract in chunks and writes the aggregated single and
+    shared trip files read by `data_read` (or `data_read2` when `tract` is True). Memory use depends
+    on the number of distinct groups and on `chunksize`, not on the number of trips in the extract.
+
+    Args:
+      raw_path: the path of the raw trip CSV downloaded from the Chicago Data Portal.
+      folder: the directory where the aggregated files are written.
+      tract: a boolean indicating whether to also group by pickup and dropoff census tract.
+      regions: an optional dictionary mapping a region name such as "north" to the pickup community
+    areas it contains. Each region is written to its own sub-folder, in addition to the citywide files.
+      chunksize: the number of raw rows read at a time.
+      merge_every: the number of pending partials per trip type that are merged together. Lower values
+    use less memory, higher values do fewer merges.
+      bin_width: an optional time bin width in minutes that divides the hour, such as 5, 15 or 30. The
+    files then have one row per bin, keyed by the hour keys and `pickup_minute`, and should be written
+    to their own folder.
+
+    Returns:
+      a dictionary mapping `(region, mode, type_of_data)` to the path of each written file, with
+    region None for the citywide files.
+    """
+    reader = pd.read_csv(raw_path, usecols=list(RAW_COLUMNS), chunksize=chunksize)
+    return aggregate_chunks(reader, folder, tract, regions, merge_every, bin_width)
@@ -0,0 +1,224 @@
+import sys
+import json
+import time
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_STACK = []
+
+
+def frame_rows(value):
+    """
+    This function counts the rows of a value passed to or returned by a traced function.
+
+    Args:
+      value: any value. DataFrames and Series count their rows, lists, tuples and dictionaries the
+    rows of the frames they hold.
+
+    Returns:
+      the number of rows, or 0 for values that hold no frame.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(frame_rows(part) for part in value)
+    if isinstance(value, dict):
+        return sum(frame_rows(part) for part in value.values())
+    return 0
+
+
+def max_rss():
+    """
+    This function returns the peak resident memory of the process in bytes, or 0 where it is not
+    available.
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+def open_span(name, rows_in=0):
+    """
+    This function starts a span as a child of the current span.
+
+    Args:
+      name: the name of the span.
+      rows_in: the number of input rows.
+
+    Returns:
+      the new span.
+    """
+    parent = _STACK[-1]
+    span = {'name': name, 'start_s': time.perf_counter() - _STACK[0]['_origin'], 'rows_in': rows_in,
+            'children': [], '_wall': time.perf_counter(), '_cpu': time.process_time()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        parent['_peak'] = max(parent.get('_peak', 0), peak)
+        tracemalloc.reset_peak()
+        span['_memory'], span['_peak'] = current, current
+    else:
+        span['_memory'] = max_rss()
+    parent['children'].append(span)
+    _STACK.append(span)
+    return span
+
+
+def close_span(span, rows_out=0):
+    """
+    This function ends the current span and records its measures.
+
+    Args:
+      span: the span returned by `open_span`.
+      rows_out: the number of output rows.
+    """
+    span['wall_s'] = time.perf_counter() - span.pop('_wall')
+    span['cpu_s'] = time.process_time() - span.pop('_cpu')
+    span['rows_out'] = rows_out
+    start = span.pop('_memory')
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        span_peak = max(span.pop('_peak'), peak)
+        span['memory_delta_mb'] = (current - start)/2**20
+        span['memory_peak_mb'] = (span_peak - start)/2**20
+        if len(_STACK) > 1:
+            _STACK[-2]['_peak'] = max(_STACK[-2].get('_peak', 0), span_peak)
+    else:
+        # the peak resident memory only grows, so this is the growth of the process peak in the span
+        span['memory_peak_mb'] = (max_rss() - start)/2**20
+    _STACK.pop()
+
+
+def traced(function):
+    """
+    This decorator records a span for every call of `function` made inside `trace`. Outside `trace` the
+    wrapper only checks that no trace is running, so the overhead is one list lookup per call.
+
+    Args:
+      function: the function to trace. The span is named after its module and name.
+
+    Returns:
+      the wrapped function.
+    """
+    name = function.__module__ + '.' + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _STACK:
+            return function(*args, **kwargs)
+        span = open_span(name, frame_rows(args) + frame_rows(kwargs))
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            close_span(span, frame_rows(result))
+    return wrapper
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    This context manager records a span for a block of code inside `trace`, for the stages of a
+    function that are not functions themselves. It does nothing outside `trace`.
+
+    Args:
+      name: the name of the span.
+    """
+    if not _STACK:
+        yield
+        return
+    span = open_span(name)
+    try:
+        yield
+    finally:
+        close_span(span)
+
+
+@contextlib.contextmanager
+def trace(name='trace', path=None, chrome_path=None, memory=False):
+    """
+    This context manager traces the calls of the functions decorated with `traced` made in its block.
+    Tracing is single-threaded: calls made from other threads or processes are not recorded.
+
+    Args:
+      name: the name of the root span.
+      path: an optional path where the nested JSON trace is written at the end of the block.
+      chrome_path: an optional path where the trace is written in the Chrome trace event format, which
+    can be opened in chrome://tracing or Perfetto.
+      memory: a boolean measuring the peak and net allocated memory of every span with `tracemalloc`,
+    which slows the traced code down. Without it only the growth of the peak resident memory of the
+    process is recorded.
+
+    Yields:
+      the root span, a dictionary with the 'name', the start time 'start_s' relative to the root, the
+    'wall_s' and 'cpu_s' times, 'rows_in' and 'rows_out', 'memory_peak_mb' (and 'memory_delta_mb' with
+    `memory`) and the 'children' spans, filled in when the block ends.
+    """
+    if _STACK:
+        raise RuntimeError('a trace is already running')
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    root = {'name': name, 'start_s': 0.0, 'rows_in': 0, 'children': [], '_origin': time.perf_counter(),
+            '_wall': time.perf_counter(), '_cpu': time.process_time()}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        root['_memory'] = root['_peak'] = tracemalloc.get_traced_memory()[0]
+    else:
+        root['_memory'] = max_rss()
+    _STACK.append(root)
+    try:
+        yield root
+    finally:
+        del _STACK[1:]
+        root.pop('_origin')
+        close_span(root)
+        if started:
+            tracemalloc.stop()
+        if path is not None:
+            write_trace(root, path)
+        if chrome_path is not None:
+            write_chrome_trace(root, chrome_path)
+
+
+def write_trace(root, path):
+    """
+    This function writes a trace as nested JSON.
+
+    Args:
+      root: the root span yielded by `trace`.
+      path: the path of the JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(root, f, indent=1)
+
+
+def chrome_events(span, events):
+    """
+    This function appends the Chrome trace events of a span and its children.
+    """
+    args = {key: value for key, value in span.items() if key not in ('name', 'start_s', 'children')}
+    events.append({'name': span['name'], 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': span['start_s']*1e6,
+                   'dur': span['wall_s']*1e6, 'args': args})
+    for child in span['children']:
+        chrome_events(child, events)
+    return events
+
+
+def write_chrome_trace(root, path):
+    """
+    This function writes a trace in the Chrome trace event format.
+
+    Args:
+      root: the root span yielded by `trace`.
+      path: the path of the JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': chrome_events(root, []), 'displayTimeUnit': 'ms'}, f)
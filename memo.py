@@ -0,0 +1,224 @@
+import os
+import json
+import inspect
+import hashlib
+import functools
+import collections
+import numpy as np
+import pandas as pd
+import analysis
+import od
+import storage
+import timebins
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+MEMO_ENABLED = True
+MEMO_DIR = None
+MEMO_BUDGET = 2*2**30
+MEMORY_ENTRIES = 16
+# the modules whose code decides the results; a change to any of them invalidates every result
+CODE_MODULES = [analysis, od, storage, timebins]
+PANEL_FILES = [('single', 'realized', False), ('shared', 'realized', False),
+               ('shared', 'requested', False)]
+TRACT_FILES = [('shared', 'realized', True), ('single', 'realized', True)]
+_RESULTS = collections.OrderedDict()
+_CODE_VERSION = []
+
+
+def code_version():
+    """
+    This function returns a digest of the source files of `CODE_MODULES`, computed once per process.
+    """
+    if not _CODE_VERSION:
+        digest = hashlib.blake2b(storage.CACHE_VERSION.encode(), digest_size=8)
+        for module in CODE_MODULES:
+            with open(module.__file__, 'rb') as f:
+                digest.update(f.read())
+        _CODE_VERSION.append(digest.hexdigest())
+    return _CODE_VERSION[0]
+
+
+def memo_dir(folder):
+    """
+    This function returns the folder of the stored results of a data folder: `MEMO_DIR` if it is set,
+    otherwise a `.memo` folder inside the data folder.
+    """
+    return MEMO_DIR if MEMO_DIR is not None else os.path.join(folder, '.memo')
+
+
+def result_key(name, folder, args, files):
+    """
+    This function builds the key of a result.
+
+    Args:
+      name: the name of the entry point.
+      folder: the folder of the aggregated trip files.
+      args: a dictionary with the other arguments of the call by name, defaults included, such as the
+    'region'.
+      files: the (mode, type_of_data, tract) input files of the entry point.
+
+    Returns:
+      a hexadecimal digest of the entry point, its arguments, the signatures of its input files (see
+    `storage.source_signature`, which follows `storage.CACHE_VALIDATION`) and `code_version`.
+    """
+    region = args.get('region')
+    signatures = [storage.source_signature(analysis.data_path(folder, mode, type_of_data,
+                                                              None if tract else region, tract))
+                  for mode, type_of_data, tract in files]
+    text = json.dumps([name, os.path.abspath(folder), args, signatures, code_version()],
+                      sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def encode_attrs(attrs):
+    """
+    This function turns the `attrs` of a result into JSON, with numpy arrays stored as lists.
+    """
+    return json.dumps({name: {'array': value.tolist(), 'dtype': str(value.dtype)}
+                       if isinstance(value, np.ndarray) else {'value': value}
+                       for name, value in attrs.items()})
+
+
+def decode_attrs(text):
+    """
+    This function reads the `attrs` written by `encode_attrs`.
+    """
+    return {name: np.array(value['array'], dtype=value['dtype']) if 'array' in value else value['value']
+            for name, value in json.loads(text).items()}
+
+
+def write_result(df, path):
+    """
+    This function writes a result to an uncompressed Feather file under a temporary name first, so
+    that readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    plain = df.copy(deep=False)
+    plain.attrs = {}
+    table = pa.Table.from_pandas(plain, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'attrs'] = encode_attrs(df.attrs).encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def read_result(path):
+    """
+    This function reads a result written by `write_result` and marks it as recently used.
+
+    Returns:
+      the pandas DataFrame, or None if the file does not exist or cannot be read.
+    """
+    try:
+        table = feather.read_table(path)
+        os.utime(path)
+    except (OSError, pa.ArrowInvalid):
+        return None
+    df = table.to_pandas()
+    df.attrs = decode_attrs((table.schema.metadata or {}).get(b'attrs', b'{}'))
+    return df
+
+
+def evict(folder, budget=None):
+    """
+    This function removes the least recently used stored results until the stored results fit in the
+    disk budget.
+
+    Args:
+      folder: the folder of the stored results.
+      budget: the budget in bytes. Defaults to `MEMO_BUDGET`.
+    """
+    budget = MEMO_BUDGET if budget is None else budget
+    if not os.path.isdir(folder):
+        return
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.feather'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def remember(key, df):
+    """
+    This function keeps a result in memory and drops the least recently used ones beyond
+    `MEMORY_ENTRIES`.
+    """
+    _RESULTS[key] = df
+    _RESULTS.move_to_end(key)
+    while len(_RESULTS) > MEMORY_ENTRIES:
+        _RESULTS.popitem(last=False)
+
+
+def memoize(function, files):
+    """
+    This function wraps an entry point of `analysis.py` with a persistent result cache. A call first
+    looks for the result in memory, then in a Feather file named after `result_key` in `memo_dir`, and
+    only then computes it, stores it and evicts old results beyond `MEMO_BUDGET`. The kept results are
+    never handed out: every call returns its own deep copy, so callers such as `weekdaywiseplot` may
+    modify it. Arguments are bound to the signature of the entry point with their defaults before
+    the key is built, so `f(folder, 'north')` and `f(folder, region='north')` share a result.
+
+    Args:
+      function: an entry point taking the data folder first and other arguments such as a region.
+      files: the (mode, type_of_data, tract) input files whose signatures enter the key.
+
+    Returns:
+      the wrapped function, with the signature of `function`.
+    """
+    name = function.__module__ + '.' + function.__qualname__
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not MEMO_ENABLED or feather is None:
+            return function(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        folder = arguments.pop(next(iter(signature.parameters)))
+        key = result_key(name, folder, arguments, files)
+        if key in _RESULTS:
+            _RESULTS.move_to_end(key)
+            return _RESULTS[key].copy()
+        path = os.path.join(memo_dir(folder), key + '.feather')
+        df = read_result(path)
+        if df is None:
+            df = function(*bound.args, **bound.kwargs)
+            write_result(df, path)
+            evict(memo_dir(folder))
+        remember(key, df)
+        return df.copy()
+    return wrapper
+
+
+def clear(folder=None):
+    """
+    This function drops the results kept in memory and, with a data folder, the stored results of
+    that folder.
+    """
+    _RESULTS.clear()
+    if folder is not None:
+        evict(memo_dir(folder), 0)
+
+
+agg_hdm = memoize(analysis.agg_hdm, PANEL_FILES)
+df_day = memoize(analysis.df_day, PANEL_FILES)
+df_day_Jan_Sep = memoize(analysis.df_day_Jan_Sep, PANEL_FILES)
+merge_tract_trips_weekdays = memoize(analysis.merge_tract_trips_weekdays, TRACT_FILES)
@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import analysis
+
+# census tract GEOIDs are the 2-digit state, 3-digit county and 6-digit tract codes; the TNP trips
+# only have Illinois tracts, whose county and tract digits fit twice in an int64
+STATE_FIPS = 17
+TRACT_BASE = 10 ** 9
+# the entries of a store that are not count matrices
+STORE_FIELDS = ('tracts', 'slots', 'minutes')
+
+
+def tract_index(*frames):
+    """
+    This function builds the census tract vocabulary used to encode OD pairs.
+
+    Args:
+      *frames: pandas DataFrames with the columns 'Pickup Census Tract' and 'Dropoff Census Tract'.
+
+    Returns:
+      a sorted numpy int64 array of the distinct census tracts found in any of the frames.
+    """
+    tracts = [np.unique(df[column].to_numpy(np.int64)) for df in frames
+              for column in ['Pickup Census Tract', 'Dropoff Census Tract']]
+    return np.unique(np.concatenate(tracts))
+
+
+def encode_od(pickup, dropoff, tracts):
+    """
+    This function packs pickup and dropoff census tracts into one int64 code per OD pair.
+
+    Args:
+      pickup: an array-like of pickup census tracts.
+      dropoff: an array-like of dropoff census tracts.
+      tracts: the sorted tract vocabulary returned by `tract_index`.
+
+    Returns:
+      a numpy int64 array with `pickup_position * len(tracts) + dropoff_position`, where the positions
+    are the indices of the tracts in `tracts`. The codes sort by pickup tract first and can be turned
+    back into tracts with `decode_od`.
+    """
+    positions = []
+    for values in (pickup, dropoff):
+        values = np.asarray(values).astype(np.int64)
+        position = np.searchsorted(tracts, values)
+        if (position >= len(tracts)).any() or (tracts[np.minimum(position, len(tracts) - 1)] != values).any():
+            raise KeyError('census tract missing from the tract vocabulary')
+        positions.append(position.astype(np.int64))
+    return positions[0] * len(tracts) + positions[1]
+
+
+def decode_od(codes, tracts):
+    """
+    This function turns OD codes back into census tract pairs.
+
+    Args:
+      codes: an array-like of codes returned by `encode_od`.
+      tracts: the tract vocabulary the codes were built with.
+
+    Returns:
+      a tuple `(pickup, dropoff)` of numpy int64 arrays of census tracts.
+    """
+    pickup, dropoff = np.divmod(np.asarray(codes, dtype=np.int64), len(tracts))
+    return tracts[pickup], tracts[dropoff]
+
+
+def pack_od(pickup, dropoff):
+    """
+    This function packs pickup and dropoff census tracts into a stable int64 identifier per OD pair.
+    Unlike the codes of `encode_od`, the identifier of a pair does not depend on the other tracts of
+    the data, so it is the same across calls and files and `unpack_od` needs no vocabulary.
+
+    Args:
+      pickup: an array-like of pickup census tracts, 11-digit GEOIDs such as 17031010100.
+      dropoff: an array-like of dropoff census tracts.
+
+    Returns:
+      a numpy int64 array with `pickup_county_tract * TRACT_BASE + dropoff_county_tract`, where the
+    county and tract digits are the GEOID without the state code. The identifiers sort by pickup tract
+    first.
+    """
+    parts = []
+    for values in (pickup, dropoff):
+        values = np.asarray(values).astype(np.int64)
+        if ((values // TRACT_BASE) != STATE_FIPS).any():
+            raise ValueError('census tracts must be GEOIDs of the state %02d' % STATE_FIPS)
+        parts.append(values % TRACT_BASE)
+    return parts[0] * TRACT_BASE + parts[1]
+
+
+def unpack_od(ids):
+    """
+    This function turns the identifiers of `pack_od` back into census tract pairs.
+
+    Returns:
+      a tuple `(pickup, dropoff)` of numpy int64 arrays of census tracts.
+    """
+    pickup, dropoff = np.divmod(np.asarray(ids, dtype=np.int64), TRACT_BASE)
+    return pickup + STATE_FIPS * TRACT_BASE, dropoff + STATE_FIPS * TRACT_BASE
+
+
+def od_store(df, columns, tracts=None):
+    """
+    This function stores tract level counts as sparse OD by time slot matrices. Row `i` of every matrix
+    is the OD pair with code `i`, and column `j` is the pickup hour with `analysis.key_code` equal to
+    `slots[j]`.
+
+    Args:
+      df: a pandas DataFrame returned by `data_read2` or `merge_tract_trips_weekdays`.
+      columns: the list of count columns to store, for example ['count_shared_realized'].
+      tracts: an optional tract vocabulary. Stores that share a vocabulary have the same rows and can
+    be combined directly. Defaults to the tracts found in `df`.
+
+    Returns:
+      a dictionary with the tract vocabulary under 'tracts', the sorted slot codes under 'slots',
+    whether the slots are finer than the hour and end with the 'pickup_minute' under 'minutes', and
+    one `scipy.sparse.csr_matrix` per column.
+    """
+    if tracts is None:
+        tracts = tract_index(df)
+    rows = encode_od(df['Pickup Census Tract'], df['Dropoff Census Tract'], tracts)
+    slots, cols = np.unique(analysis.key_code(df), return_inverse=True)
+    shape = (len(tracts) ** 2, len(slots))
+    store = {'tracts': tracts, 'slots': slots, 'minutes': 'pickup_minute' in df.columns}
+    for column in columns:
+        store[column] = sp.csr_matrix((df[column].to_numpy(np.float64), (rows, cols)), shape=shape)
+    return store
+
+
+def align_slots(store, slots):
+    """
+    This function re-indexes the matrices of a store onto another set of time slots.
+
+    Args:
+      store: a dictionary returned by `od_store`.
+      slots: a sorted numpy array of slot codes.
+
+    Returns:
+      a new store with the same matrices restricted to, and padded out to, `slots`.
+    """
+    position = np.searchsorted(slots, store['slots'])
+    found = (position < len(slots)) & (slots[np.minimum(position, len(slots) - 1)] == store['slots'])
+    mapping = sp.csr_matrix((np.ones(found.sum()), (np.flatnonzero(found), position[found])),
+                            shape=(len(store['slots']), len(slots)))
+    aligned = {'tracts': store['tracts'], 'slots': slots, 'minutes': store['minutes']}
+    for column, matrix in store.items():
+        if column not in STORE_FIELDS:
+            aligned[column] = (matrix @ mapping).tocsr()
+    return aligned
+
+
+def join_stores(left, right):
+    """
+    This function inner-joins two stores built with the same tract vocabulary, keeping the OD pair and
+    slot cells that have a non-zero count in both, like an inner merge on the tract and time columns.
+
+    Args:
+      left: a dictionary returned by `od_store`.
+      right: a dictionary returned by `od_store` with the same tract vocabulary.
+
+    Returns:
+      a store with the matrices of both inputs on the union of their slots, masked to the common cells.
+    """
+    if not np.array_equal(left['tracts'], right['tracts']):
+        raise ValueError('stores must share the same tract vocabulary')
+    if left['minutes'] != right['minutes']:
+        raise ValueError('stores must share the same time bins')
+    slots = np.union1d(left['slots'], right['slots'])
+    left, right = align_slots(left, slots), align_slots(right, slots)
+    masks = []
+    for store in (left, right):
+        mask = None
+        for column, matrix in store.items():
+            if column not in STORE_FIELDS:
+                present = (matrix != 0).astype(np.int8)
+                mask = present if mask is None else mask.maximum(present)
+        masks.append(mask)
+    common = masks[0].multiply(masks[1])
+    joined = {'tracts': left['tracts'], 'slots': slots, 'minutes': left['minutes']}
+    for store in (left, right):
+        for column, matrix in store.items():
+            if column not in STORE_FIELDS:
+                joined[column] = matrix.multiply(common).tocsr()
+    return joined
+
+
+def od_totals(store, column):
+    """
+    This function sums a count over all time slots for every OD pair with at least one trip.
+
+    Args:
+      store: a dictionary returned by `od_store` or `join_stores`.
+      column: the name of the count column to sum.
+
+    Returns:
+      a pandas Series of totals indexed by the OD identifier of `pack_od`, like the 'OD' column of
+    `merge_tract_trips_weekdays`.
+    """
+    totals = np.asarray(store[column].sum(axis=1)).ravel()
+    codes = np.flatnonzero(totals)
+    ids = pack_od(*decode_od(codes, store['tracts']))
+    return pd.Series(totals[codes], index=pd.Index(ids, name='OD'), name=column)
+
+
+def top_od(store, column, k):
+    """
+    This function selects the OD pairs with the largest totals of a count.
+
+    Args:
+      store: a dictionary returned by `od_store` or `join_stores`.
+      column: the name of the count column to rank the OD pairs by.
+      k: the number of OD pairs to return.
+
+    Returns:
+      a pandas DataFrame with the 'OD' identifier of `pack_od`, the pickup and dropoff census tracts
+    and the total, sorted by decreasing total.
+    """
+    totals = np.asarray(store[column].sum(axis=1)).ravel()
+    k = min(k, np.count_nonzero(totals))
+    codes = np.argpartition(-totals, k - 1)[:k] if k > 0 else np.array([], dtype=np.int64)
+    codes = codes[np.argsort(-totals[codes], kind='stable')]
+    pickup, dropoff = decode_od(codes, store['tracts'])
+    return pd.DataFrame({'OD': pack_od(pickup, dropoff), 'Pickup Census Tract': pickup,
+                         'Dropoff Census Tract': dropoff, column: totals[codes]})
+
+
+def store_frame(store, columns=None):
+    """
+    This function converts a store back into a long DataFrame with one row per non-empty cell.
+
+    Args:
+      store: a dictionary returned by `od_store` or `join_stores`.
+      columns: the count columns to include. Defaults to every matrix in the store.
+
+    Returns:
+      a pandas DataFrame with the 'OD' identifier of `pack_od`, the census tracts, the pickup time keys,
+    the 'pickup_minute' and the 'year' when the store was built from frames with these columns, and
+    the counts.
+    """
+    if columns is None:
+        columns = [column for column in store if column not in STORE_FIELDS]
+    cells = None
+    for column in columns:
+        present = (store[column] != 0).astype(np.int8)
+        cells = present if cells is None else cells.maximum(present)
+    cells = cells.tocoo()
+    rows, cols = cells.row.astype(np.int64), cells.col
+    pickup, dropoff = decode_od(rows, store['tracts'])
+    code = store['slots'][cols]
+    if store['minutes']:
+        code, minute = np.divmod(code, 60)
+    code, pickup_day = np.divmod(code, 7)
+    code, pickup_hour = np.divmod(code, 24)
+    code, pickup_date = np.divmod(code, 32)
+    year, pickup_month = np.divmod(code, 13)
+    df = pd.DataFrame({'OD': pack_od(pickup, dropoff), 'Pickup Census Tract': pickup,
+                       'Dropoff Census Tract': dropoff, 'pickup_hour': pickup_hour,
+                       'pickup_date': pickup_date, 'pickup_day': pickup_day,
+                       'pickup_month': pickup_month})
+    if store['minutes']:
+        # `analysis.key_code` keeps the minute within the hour of the first minute of the bin
+        df['pickup_minute'] = pickup_hour*60 + minute
+    if year.any():
+        df['year'] = year
+    for column in columns:
+        df[column] = np.asarray(store[column][rows, cols]).ravel()
+    return df
@@ -0,0 +1,157 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import analysis
+import storage
+
+PARTITION_SCHEMA = pa.schema([('region', pa.string()), ('year', pa.int16()),
+                              ('pickup_month', pa.int8())])
+CITYWIDE = 'citywide'
+TRIP_TYPES = [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]
+
+
+def dataset_path(root, mode, type_of_data, tract=False):
+    """
+    This function returns the folder of the partitioned dataset for one trip type.
+
+    Args:
+      root: the root folder of the partitioned datasets.
+      mode: The "mode" parameter refers to the trip being "single" or "shared".
+      type_of_data: type_of_data is a string that specifies the type of mode either "realized" or "requested".
+      tract: a boolean indicating whether the dataset holds the census tract level files.
+
+    Returns:
+      the path `<root>/<mode>_<type_of_data>[_tract]`.
+    """
+    return os.path.join(root, mode + '_' + type_of_data + ('_tract' if tract else ''))
+
+
+def write_partitions(folder, root, year, regions=(None,), tract=False, rows_per_group=None):
+    """
+    This function copies the aggregated trip files into a partitioned Parquet layout
+    `<root>/<mode>_<type_of_data>/region=<region>/year=<year>/pickup_month=<month>/`. Within each month
+    the rows are sorted by date and hour and split into small row groups, so that the row group
+    statistics let `query` skip dates, weekdays and hours that are not requested.
+
+    Args:
+      folder: The folder parameter is a string that represents the directory path where the aggregated
+    files are located.
+      root: the root folder of the partitioned datasets.
+      year: the year of the data in `folder`, used only for files written before ingest added the
+    'year' column; rows with that column are stored under their own year. Can be None when every
+    file has the column.
+      regions: the region sub-folders to copy, with None for the citywide files, which are stored under
+    the region name "citywide".
+      tract: a boolean indicating whether to copy the census tract level files instead of the hourly
+    files.
+      rows_per_group: the maximum number of rows per Parquet row group. Defaults to one day of hourly
+    rows, or 65536 rows for the tract level files.
+    """
+    if rows_per_group is None:
+        rows_per_group = 65536 if tract else 24
+    read = analysis.data_read2 if tract else analysis.data_read
+    for mode, type_of_data in TRIP_TYPES:
+        if tract and type_of_data == 'requested':
+            continue
+        for region in regions:
+            df = read(folder, mode, type_of_data, region)
+            if 'year' not in df.columns:
+                if year is None:
+                    raise ValueError('the files of %s have no year column; pass the year' % folder)
+                df['year'] = year
+            df = df.sort_values(['year', 'pickup_month', 'pickup_date', 'pickup_hour'])
+            df['region'] = CITYWIDE if region is None else region
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.cast(pa.schema([PARTITION_SCHEMA.field(f.name) if f.name in PARTITION_SCHEMA.names
+                                          else f for f in table.schema]))
+            ds.write_dataset(table, dataset_path(root, mode, type_of_data, tract), format='parquet',
+                             partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'),
+                             existing_data_behavior='delete_matching',
+                             max_rows_per_group=rows_per_group)
+
+
+def query_filter(region=None, start=None, end=None, weekdays=None, hours=None):
+    """
+    This function builds the Arrow filter expression used by `query`.
+
+    Args:
+      region: the region name, or None for the citywide data.
+      start: the first pickup date to keep, as anything `pandas.Timestamp` accepts. Defaults to no bound.
+      end: the last pickup date to keep (inclusive). Defaults to no bound.
+      weekdays: an optional collection of `pickup_day` values (0 is Monday) to keep.
+      hours: an optional `(first, last)` pair of pickup hours to keep, both inclusive.
+
+    Returns:
+      a `pyarrow.dataset.Expression`. The region, year and month terms prune whole partitions, and the
+    date, weekday and hour terms prune row groups through their statistics.
+    """
+    expr = ds.field('region') == (CITYWIDE if region is None else region)
+    for bound, side in [(start, 'start'), (end, 'end')]:
+        if bound is None:
+            continue
+        bound = pd.Timestamp(bound)
+        year, month, date = ds.field('year'), ds.field('pickup_month'), ds.field('pickup_date')
+        if side == 'start':
+            expr &= (year > bound.year) | ((year == bound.year) & (
+                (month > bound.month) | ((month == bound.month) & (date >= bound.day))))
+        else:
+            expr &= (year < bound.year) | ((year == bound.year) & (
+                (month < bound.month) | ((month == bound.month) & (date <= bound.day))))
+    if weekdays is not None:
+        expr &= ds.field('pickup_day').isin(sorted(weekdays))
+    if hours is not None:
+        expr &= (ds.field('pickup_hour') >= hours[0]) & (ds.field('pickup_hour') <= hours[1])
+    return expr
+
+
+def query(root, mode, type_of_data, region=None, start=None, end=None, weekdays=None, hours=None,
+          columns=None, tract=False):
+    """
+    This function reads the rows of a partitioned trip dataset that match a region, a date range, a set
+    of weekdays and an hour range. Only the matching partitions and row groups are read from disk.
+
+    Args:
+      root: the root folder of the partitioned datasets written by `write_partitions`.
+      mode: The "mode" parameter refers to the trip being "single" or "shared".
+      type_of_data: type_of_data is a string that specifies the type of mode either "realized" or "requested".
+      region: the region name, or None for the citywide data.
+      start: the first pickup date to keep. Defaults to no bound.
+      end: the last pickup date to keep (inclusive). Defaults to no bound.
+      weekdays: an optional collection of `pickup_day` values (0 is Monday) to keep.
+      hours: an optional `(first, last)` pair of pickup hours to keep, both inclusive.
+      columns: an optional list of the columns to load. Defaults to every column except `region`.
+      tract: a boolean indicating whether to query the census tract level dataset.
+
+    Returns:
+      a pandas DataFrame with the same columns and dtypes as `data_read` (or `data_read2`), plus a
+    `year` column.
+    """
+    dataset = ds.dataset(dataset_path(root, mode, type_of_data, tract), format='parquet',
+                         partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'))
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'region']
+    expr = query_filter(region, start, end, weekdays, hours)
+    df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    return storage.apply_schema(df)
+
+
+def query_panel(root, region=None, start=None, end=None, weekdays=None, hours=None):
+    """
+    This function reads the single realized, shared realized and shared requested rows that match a
+    query and joins them into one hourly panel, like `build_panel` does for the CSV files.
+
+    Args:
+      root: the root folder of the partitioned datasets written by `write_partitions`.
+      region: the region name, or None for the citywide data.
+      start: the first pickup date to keep. Defaults to no bound.
+      end: the last pickup date to keep (inclusive). Defaults to no bound.
+      weekdays: an optional collection of `pickup_day` values (0 is Monday) to keep.
+      hours: an optional `(first, last)` pair of pickup hours to keep, both inclusive.
+
+    Returns:
+      a pandas DataFrame indexed by `year` and `analysis.PANEL_KEYS`.
+    """
+    frames = [query(root, mode, type_of_data, region, start, end, weekdays, hours)
+              for mode, type_of_data in TRIP_TYPES]
+    return analysis.align_frames(frames, ['year'] + analysis.PANEL_KEYS)
@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import scipy.spatial
+import od
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def read_centroids(path, tract='tract', latitude='latitude', longitude='longitude'):
+    """
+    This function reads census tract centroids and projects them on a plane.
+
+    Args:
+      path: the path of a CSV file with one row per census tract, such as the internal points of the
+    Census Bureau tract gazetteer or the centroids of the Chicago Data Portal tract boundaries.
+      tract: the name of the census tract column, with identifiers such as 17031010100.
+      latitude: the name of the latitude column, in degrees.
+      longitude: the name of the longitude column, in degrees.
+
+    Returns:
+      a pandas DataFrame indexed by the int64 census tract with the 'x_km' and 'y_km' coordinates of an
+    equirectangular projection around the mean latitude, which is accurate to well under a percent
+    across a city.
+    """
+    df = pd.read_csv(path, usecols=[tract, latitude, longitude])
+    latitude_rad = np.radians(df[latitude].to_numpy(np.float64))
+    longitude_rad = np.radians(df[longitude].to_numpy(np.float64))
+    x = EARTH_RADIUS_KM*longitude_rad*np.cos(latitude_rad.mean())
+    y = EARTH_RADIUS_KM*latitude_rad
+    index = pd.Index(df[tract].to_numpy(np.int64), name='tract')
+    return pd.DataFrame({'x_km': x, 'y_km': y}, index=index)
+
+
+def neighborhoods(centroids, tracts, radius=None, k=None):
+    """
+    This function finds the neighboring tracts of every tract with a KD-tree over the centroids.
+
+    Args:
+      centroids: a pandas DataFrame returned by `read_centroids`.
+      tracts: the sorted tract vocabulary of the OD codes, see `od.tract_index`.
+      radius: the neighborhood radius in kilometers.
+      k: the number of nearest tracts, the tract itself included. Exactly one of `radius` and `k` must
+    be given.
+
+    Returns:
+      a `scipy.sparse.csr_matrix` of shape (len(tracts), len(tracts)) with a one at (i, j) when tract j
+    is a neighbor of tract i. Every tract is its own neighbor.
+    """
+    missing = ~pd.Index(tracts).isin(centroids.index)
+    if missing.any():
+        raise KeyError('census tracts without a centroid: ' + str(tracts[missing][:5].tolist()))
+    points = centroids.loc[tracts, ['x_km', 'y_km']].to_numpy()
+    tree = scipy.spatial.cKDTree(points)
+    n = len(tracts)
+    if (radius is None) == (k is None):
+        raise ValueError('give exactly one of radius and k')
+    if radius is not None:
+        neighbors = tree.query_ball_point(points, radius, return_sorted=False)
+        lengths = np.fromiter((len(row) for row in neighbors), dtype=np.int64, count=n)
+        indices = np.fromiter((j for row in neighbors for j in row), dtype=np.int64, count=lengths.sum())
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+    else:
+        k = min(k, n)
+        _, indices = tree.query(points, k=k)
+        indices = np.asarray(indices, dtype=np.int64).reshape(n, k).ravel()
+        indptr = np.arange(0, n*k + 1, k)
+    return sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n, n))
+
+
+def od_matrix(df, column, tracts):
+    """
+    This function sums a count over all time slots into a sparse origin by destination matrix.
+    """
+    codes = od.encode_od(df['Pickup Census Tract'], df['Dropoff Census Tract'], tracts)
+    pickup, dropoff = np.divmod(codes, len(tracts))
+    return sp.csr_matrix((df[column].to_numpy(np.float64), (pickup, dropoff)),
+                         shape=(len(tracts), len(tracts)))
+
+
+def pool_od(df, centroids, column='count_shared_realized', min_support=30, radii=(0.5, 1, 2, 4),
+            ks=None, tracts=None):
+    """
+    This function chooses a pooling neighborhood for every OD pair. An OD pair with fewer than
+    `min_support` trips is pooled with the OD pairs whose origin is a neighbor of its origin and whose
+    destination is a neighbor of its destination, at the smallest neighborhood that reaches the
+    support. The pooled support of all the thin pairs at one neighborhood is a sparse product of the
+    neighborhood matrices and the OD count matrix, so no pairwise distance matrix is built.
+
+    Args:
+      df: a pandas DataFrame returned by `merge_tract_trips_weekdays` or `data_read2`.
+      centroids: a pandas DataFrame returned by `read_centroids`.
+      column: the count that measures the support of an OD pair.
+      min_support: the minimum total count of an OD pair or its pool.
+      radii: the increasing neighborhood radii in kilometers to try.
+      ks: increasing numbers of nearest tracts to try instead of `radii`.
+      tracts: the tract vocabulary of the neighborhood matrices. Defaults to the tracts of `df`.
+
+    Returns:
+      a pandas DataFrame with one row per OD pair with the 'OD' identifier of `od.pack_od`, the census
+    tracts, the own 'support', the chosen neighborhood 'level' (0 for pairs that are not pooled, else
+    a radius or a k), the 'pooled_support' and whether it 'reached' `min_support`. Pairs that do not
+    reach it at the largest neighborhood keep that neighborhood. `attrs['tracts']` and `attrs['levels']` hold the vocabulary
+    and the neighborhoods for `pool_members`.
+    """
+    if tracts is None:
+        tracts = od.tract_index(df)
+    levels = list(ks) if ks is not None else list(radii)
+    counts = od_matrix(df, column, tracts)
+    coo = counts.tocoo()
+    origin, destination, support = coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+    level = np.zeros(len(support))
+    pooled = support.copy()
+    thin = np.flatnonzero(pooled < min_support)
+    for value in levels:
+        if len(thin) == 0:
+            break
+        adjacency = neighborhoods(centroids, tracts, k=value) if ks is not None else \
+            neighborhoods(centroids, tracts, radius=value)
+        sums = (adjacency[origin[thin]] @ counts).multiply(adjacency[destination[thin]])
+        pooled[thin] = np.asarray(sums.sum(axis=1)).ravel()
+        level[thin] = value
+        thin = thin[pooled[thin] < min_support]
+    pickup, dropoff = tracts[origin], tracts[destination]
+    result = pd.DataFrame({'OD': od.pack_od(pickup, dropoff), 'Pickup Census Tract': pickup,
+                           'Dropoff Census Tract': dropoff, 'support': support, 'level': level,
+                           'pooled_support': pooled, 'reached': pooled >= min_support})
+    result.attrs['tracts'] = tracts
+    result.attrs['levels'] = {'ks' if ks is not None else 'radii': levels}
+    return result
+
+
+def pool_members(pooling, centroids):
+    """
+    This function lists the members of the pool of every OD pair.
+
+    Args:
+      pooling: a pandas DataFrame returned by `pool_od`.
+      centroids: the centroids passed to `pool_od`.
+
+    Returns:
+      a pandas DataFrame with one row per pool and member OD pair with the 'OD' identifier of the pool
+    and the 'member' OD identifier. A pair that is not pooled is its own only member.
+    """
+    tracts = pooling.attrs['tracts']
+    origin = np.searchsorted(tracts, pooling['Pickup Census Tract'].to_numpy(np.int64))
+    destination = np.searchsorted(tracts, pooling['Dropoff Census Tract'].to_numpy(np.int64))
+    level = pooling['level'].to_numpy()
+    parts = [pd.DataFrame({'OD': pooling['OD'][level == 0], 'member': pooling['OD'][level == 0]})]
+    (kind, values), = pooling.attrs['levels'].items()
+    for value in values:
+        targets = np.flatnonzero(level == value)
+        if len(targets) == 0:
+            continue
+        adjacency = neighborhoods(centroids, tracts, **{'k' if kind == 'ks' else 'radius': value})
+        # pool t holds the pair e when the origin and the destination of e neighbor those of t
+        membership = adjacency[origin[targets]][:, origin].multiply(
+            adjacency[destination[targets]][:, destination]).tocoo()
+        parts.append(pd.DataFrame({'OD': pooling['OD'].to_numpy()[targets[membership.row]],
+                                   'member': pooling['OD'].to_numpy()[membership.col]}))
+    return pd.concat(parts, ignore_index=True)
+
+
+def pooled_rows(df, members, od_column='OD'):
+    """
+    This function relabels the rows of the member OD pairs of every pool with the identifier of the
+    pool, so that per-OD fits such as `detour.detour_fits` run on the pools. A row is repeated for
+    every pool its OD pair belongs to.
+
+    Args:
+      df: a pandas DataFrame with a column of `od.pack_od` identifiers, such as the output of
+    `merge_tract_trips_weekdays`.
+      members: a pandas DataFrame returned by `pool_members`.
+      od_column: the name of the OD identifier column of `df`.
+
+    Returns:
+      a pandas DataFrame with the rows of `df` for every pool, with `od_column` set to the pool
+    identifier and the original identifier in 'member'.
+    """
+    pooled = df.merge(members.rename(columns={'OD': 'pool'}), left_on=od_column, right_on='member')
+    pooled[od_column] = pooled.pop('pool')
+    return pooled
+
+
+def pooled_counts(df, members, columns=('count_shared_realized', 'count_single_realized')):
+    """
+    This function sums the counts of the member OD pairs of every pool per pickup hour, for the
+    tract-level match rate fits.
+
+    Args:
+      df: a pandas DataFrame returned by `merge_tract_trips_weekdays`.
+      members: a pandas DataFrame returned by `pool_members`.
+      columns: the count columns to sum.
+
+    Returns:
+      a pandas DataFrame with one row per pool and pickup hour with the 'OD' identifier of the pool, the
+    pickup time keys, the summed counts and 'count_total' when both realized counts are summed.
+    """
+    keys = ['OD', 'pickup_hour', 'pickup_date', 'pickup_day', 'pickup_month']
+    pooled = pooled_rows(df[keys + list(columns)], members)
+    pooled = pooled.groupby(keys, sort=True)[list(columns)].sum().reset_index()
+    if {'count_shared_realized', 'count_single_realized'} <= set(columns):
+        pooled['count_total'] = pooled['count_shared_realized'] + pooled['count_single_realized']
+    return pooled
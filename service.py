@@ -0,0 +1,315 @@
+import io
+import json
+import math
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import urllib.parse
+import numpy as np
+import pandas as pd
+import analysis
+import bootstrap
+import fitting
+import storage
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+METRICS = {'match_rate': ('count_shared_requested_mean', 'matched_percent'),
+           'fare_ratio': ('count_mean_total', 'cost_ratio_mile')}
+ENDPOINTS = ['agg_hdm', 'df_day', 'fits', 'curves']
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+
+def parse_months(value):
+    """
+    This function parses a month range such as "1-9" or "10".
+
+    Args:
+      value: the text of the 'months' query parameter, or None for every month.
+
+    Returns:
+      a tuple `(start, end)` of months, both included.
+    """
+    if not value:
+        return 1, 12
+    parts = [int(part) if part.isdigit() else 0 for part in value.split('-')]
+    start, end = parts[0], parts[-1]
+    if len(parts) > 2 or not 1 <= start <= end <= 12:
+        raise ValueError('months must look like "1-9"')
+    return start, end
+
+
+def hdm_slice(folder, region, months, interval):
+    """
+    This function returns the rows of `agg_hdm` of a region, month range and period.
+    """
+    df_hdm = analysis.agg_hdm(folder, region)
+    rows = df_hdm['pickup_month'].between(*months)
+    if interval:
+        rows &= df_hdm['interval'] == interval
+    return df_hdm[rows].reset_index(drop=True)
+
+
+def query_frame(folder, endpoint, params):
+    """
+    This function computes the data of one query. It runs in the worker processes of `serve`, which
+    keep the panels of `analysis.build_panel` in memory between queries.
+
+    Args:
+      folder: the folder of the aggregated trip files.
+      endpoint: one of `ENDPOINTS`.
+      params: a dictionary of query parameters. 'region' selects a region sub-folder (citywide when
+    missing), 'months' a month range such as "1-9" and 'interval' one period of the day. The 'fits'
+    and 'curves' endpoints also take the 'metric' ("match_rate" or "fare_ratio"), the 'transform' (a
+    comma separated list of `fitting.TRANSFORMS`, all of them by default) and 'by' ("interval" to fit
+    each period separately); 'curves' takes the number of grid points 'num'.
+
+    Returns:
+      a pandas DataFrame: the `agg_hdm` rows for 'agg_hdm', the `df_day` table for 'df_day', the
+    `fitting.fit_forms` table for 'fits', and the fitted curves on a grid of the regressor with the
+    'x' and 'fit' columns for 'curves'.
+    """
+    region = params.get('region') or None
+    months = parse_months(params.get('months'))
+    interval = params.get('interval')
+    if endpoint == 'df_day':
+        panel = analysis.build_panel(folder, region).reset_index()
+        panel = panel[panel['pickup_month'].between(*months)].reset_index(drop=True)
+        return analysis.weekday_metrics(panel)
+    df_hdm = hdm_slice(folder, region, months, interval)
+    if endpoint == 'agg_hdm':
+        return df_hdm
+    if params.get('metric', 'match_rate') not in METRICS:
+        raise ValueError('metric must be one of ' + ', '.join(METRICS))
+    x, y = METRICS[params.get('metric', 'match_rate')]
+    transforms = params.get('transform', ','.join(fitting.TRANSFORMS)).split(',')
+    if not set(transforms) <= set(fitting.TRANSFORMS):
+        raise ValueError('transform must be among ' + ', '.join(fitting.TRANSFORMS))
+    by = ['interval'] if params.get('by') == 'interval' else []
+    table = fitting.fit_forms(df_hdm, [(x, y)], transforms, by)
+    if endpoint == 'fits':
+        return table
+    num = int(params.get('num', 20))
+    curves = []
+    for _, fit in table.iterrows():
+        values = df_hdm[x] if not by else df_hdm.loc[df_hdm['interval'] == fit['interval'], x]
+        x_min = values.min()
+        low = math.floor(x_min)
+        if fit['transform'] in ('log', 'reciprocal_offset'):
+            low = max(low, x_min)
+        x_range = np.linspace(low, math.ceil(values.max()), num=num)
+        fitted = bootstrap.curve(np.array([[fit['intercept'], fit['slope']]]), x_range,
+                                 fit['transform'], x_min)[0]
+        part = pd.DataFrame({'x': x_range, 'fit': fitted})
+        part.insert(0, 'transform', fit['transform'])
+        if by:
+            part.insert(0, 'interval', fit['interval'])
+        curves.append(part)
+    return pd.concat(curves, ignore_index=True)
+
+
+def encode_frame(df, fmt):
+    """
+    This function serializes a query result.
+
+    Args:
+      df: a pandas DataFrame.
+      fmt: "json" for a JSON object with the 'columns' and the row-major 'data', or "arrow" for an
+    Arrow IPC stream.
+
+    Returns:
+      a tuple `(body, content_type)`.
+    """
+    if fmt == 'arrow':
+        if pa is None:
+            raise ValueError('the arrow format needs pyarrow')
+        sink = io.BytesIO()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue(), 'application/vnd.apache.arrow.stream'
+    if fmt != 'json':
+        raise ValueError('format must be "json" or "arrow"')
+    return df.to_json(orient='split', index=False).encode(), 'application/json'
+
+
+def compute_response(folder, endpoint, params):
+    """
+    This function computes and serializes the response of one query in a worker process.
+
+    Returns:
+      a tuple `(status, body, content_type)`.
+    """
+    try:
+        df = query_frame(folder, endpoint, params)
+        return (200,) + encode_frame(df, params.get('format', 'json'))
+    except (ValueError, KeyError, OSError) as error:
+        return 400, json.dumps({'error': str(error)}).encode(), 'application/json'
+
+
+def query_key(folder, endpoint, params):
+    """
+    This function builds the cache key of a query. The key holds the signatures of the three files of
+    the region, so a cached response is not served after the files change.
+    """
+    region = params.get('region') or None
+    trip_types = [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]
+    signature = tuple(json.dumps(storage.source_signature(analysis.data_path(folder, mode, type_of_data,
+                                                                             region)), sort_keys=True)
+                      for mode, type_of_data in trip_types)
+    return (endpoint, tuple(sorted(params.items())), signature)
+
+
+def cache_get(cache, key):
+    """
+    This function returns a cached response and marks it as the most recently used, or None.
+    """
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+
+def cache_put(cache, key, value, max_entries):
+    """
+    This function stores a response and evicts the least recently used ones beyond `max_entries`.
+    """
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+
+async def read_request(reader):
+    """
+    This function reads the request line and the headers of one HTTP request.
+
+    Returns:
+      a tuple `(method, target, headers)`, or None when the client closed the connection.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if len(parts) != 3:
+        return '', '', headers
+    return parts[0], parts[1], headers
+
+
+def write_response(writer, status, body, content_type, keep_alive):
+    """
+    This function writes one HTTP response.
+    """
+    head = ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' %
+            (status, STATUS[status], content_type, len(body), 'keep-alive' if keep_alive else 'close'))
+    writer.write(head.encode('latin-1') + body)
+
+
+async def serve(folder, host='127.0.0.1', port=8050, max_entries=256, max_workers=None):
+    """
+    This function runs a local HTTP service answering dashboard queries on the aggregates and fits of
+    `analysis.py`, until it is cancelled. Queries are computed in a process pool whose workers keep the
+    hourly panels in memory, so the event loop keeps answering while they run. Responses are kept in
+    a least recently used cache keyed by the endpoint, the parameters and the signatures of the input
+    files, and identical queries that arrive while one is running wait for it instead of computing it
+    again.
+
+    Endpoints, all with GET: `/agg_hdm`, `/df_day`, `/fits` and `/curves`, with the parameters described
+    in `query_frame` and 'format' ("json" or "arrow"), for example
+    `/curves?region=north&months=1-9&metric=match_rate&transform=sqrt&by=interval`; and `/health`.
+
+    Args:
+      folder: the folder of the aggregated trip files.
+      host: the address to listen on.
+      port: the port to listen on.
+      max_entries: the number of responses kept in the cache.
+      max_workers: the number of worker processes. Defaults to the number of CPUs.
+    """
+    loop = asyncio.get_running_loop()
+    cache = collections.OrderedDict()
+    running = {}
+    stats = {'hits': 0, 'misses': 0}
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+    async def respond(target):
+        url = urllib.parse.urlsplit(target)
+        endpoint = url.path.strip('/')
+        if endpoint == 'health':
+            body = dict(stats, entries=len(cache), running=len(running))
+            return 200, json.dumps(body).encode(), 'application/json'
+        if endpoint not in ENDPOINTS:
+            return 404, json.dumps({'error': 'unknown endpoint'}).encode(), 'application/json'
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            key = query_key(folder, endpoint, params)
+        except FileNotFoundError as error:
+            return 400, json.dumps({'error': str(error)}).encode(), 'application/json'
+        response = cache_get(cache, key)
+        if response is not None:
+            stats['hits'] += 1
+            return response
+        stats['misses'] += 1
+        if key not in running:
+            running[key] = loop.run_in_executor(pool, compute_response, folder, endpoint, params)
+        try:
+            response = await asyncio.shield(running[key])
+        finally:
+            if key in running and running[key].done():
+                del running[key]
+        if response[0] == 200:
+            cache_put(cache, key, response, max_entries)
+        return response
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method != 'GET':
+                    response = 405, b'{"error": "only GET is supported"}', 'application/json'
+                else:
+                    try:
+                        response = await respond(target)
+                    except Exception as error:
+                        response = 500, json.dumps({'error': str(error)}).encode(), 'application/json'
+                write_response(writer, *response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the scale-effect aggregates and fits.')
+    parser.add_argument('folder', help='folder of the aggregated trip files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--max-entries', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(serve(args.folder, args.host, args.port, args.max_entries, args.workers))
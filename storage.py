@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import instrument
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+CACHE_ENABLED = True
+CACHE_DIR = None
+CACHE_VALIDATION = 'mtime'
+CACHE_VERSION = '2'
+
+KEY_DTYPES = {'pickup_hour': np.int8, 'pickup_date': np.int8,
+              'pickup_day': np.int8, 'pickup_month': np.int8, 'year': np.int16,
+              'pickup_minute': np.int16}
+TRACT_COLUMNS = ['Pickup Census Tract', 'Dropoff Census Tract']
+# the mean measure columns of the aggregated files, `<measure>_<mode>_<type_of_data>`, which are stored
+# as float32; any other column keeps the dtype it was read with
+MEASURE_COLUMNS = [measure + '_' + suffix
+                   for measure in ['trip_seconds', 'trip_miles', 'trip_mph', 'fare_mile', 'fare_minute',
+                                   'fare_total', 'fare', 'tip', 'additional_charge']
+                   for suffix in ['single_realized', 'shared_realized', 'shared_requested']]
+
+
+def column_dtype(column):
+    """
+    This function returns the compact dtype declared for a column of the aggregated trip files.
+
+    Args:
+      column: the name of a column in one of the `*_agg.csv` or `*_agg_tract.csv` files.
+
+    Returns:
+      int8 for the pickup time keys, int16 for the year, int64 for the census tract columns, int32 for
+    the trip counts, float32 for the measures listed in `MEASURE_COLUMNS` and None for any other
+    column, which is left unchanged.
+    """
+    if column in KEY_DTYPES:
+        return KEY_DTYPES[column]
+    if column in TRACT_COLUMNS:
+        return np.int64
+    if column.startswith('count_'):
+        return np.int32
+    if column in MEASURE_COLUMNS:
+        return np.float32
+    return None
+
+
+def apply_schema(df):
+    """
+    This function casts the columns of an aggregated trip file to their declared compact dtypes.
+
+    Args:
+      df: a pandas DataFrame read from one of the aggregated trip files.
+
+    Returns:
+      the same DataFrame with downcast columns. Columns without a declared dtype, non-numeric columns
+    and integer columns that contain missing values are left as they are so that no value is lost.
+    """
+    for column in df.columns:
+        dtype = column_dtype(column)
+        if dtype is None or not pd.api.types.is_numeric_dtype(df[column]):
+            continue
+        if np.issubdtype(dtype, np.integer) and df[column].isna().any():
+            continue
+        df[column] = df[column].astype(dtype)
+    return df
+
+
+def cache_path(path):
+    """
+    This function returns the location of the columnar copy of a CSV file.
+
+    Args:
+      path: the path of the source CSV file.
+
+    Returns:
+      the path of the Feather file, inside `CACHE_DIR` if it is set and otherwise inside a `.cache`
+    folder next to the source file.
+    """
+    folder = CACHE_DIR
+    if folder is None:
+        folder = os.path.join(os.path.dirname(path), '.cache')
+    else:
+        digest = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+        folder = os.path.join(folder, digest)
+    return os.path.join(folder, os.path.basename(path) + '.feather')
+
+
+def source_signature(path, validation=None):
+    """
+    This function computes the signature used to decide whether a columnar copy is still current.
+
+    Args:
+      path: the path of the source CSV file.
+      validation: either "mtime", which uses the modification time and size of the file, or "hash",
+    which uses a digest of its content. Defaults to `CACHE_VALIDATION`.
+
+    Returns:
+      a dictionary of strings describing the source file.
+    """
+    validation = validation or CACHE_VALIDATION
+    stat = os.stat(path)
+    signature = {'version': CACHE_VERSION, 'size': str(stat.st_size)}
+    if validation == 'hash':
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        signature['hash'] = digest.hexdigest()
+    else:
+        signature['mtime_ns'] = str(stat.st_mtime_ns)
+    return signature
+
+
+def read_signature(path):
+    """
+    This function reads the source signature stored in the schema metadata of a Feather file.
+
+    Args:
+      path: the path of the Feather file.
+
+    Returns:
+      the stored signature as a dictionary, or None if the file does not exist or cannot be read.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    if b'source' not in metadata:
+        return None
+    return json.loads(metadata[b'source'])
+
+
+def write_cache(df, path, signature):
+    """
+    This function writes a DataFrame to an uncompressed Feather file together with the signature of
+    its source. The file is written under a temporary name first so that readers never see a partial
+    file.
+
+    Args:
+      df: the pandas DataFrame to store.
+      path: the path of the Feather file.
+      signature: the dictionary returned by `source_signature`.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'source'] = json.dumps(signature).encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+@instrument.traced
+def read_table(path, columns=None):
+    """
+    This function reads an aggregated trip CSV file through a columnar cache. The first read parses the
+    CSV and stores a Feather copy with compact dtypes; later reads memory-map that copy and only load
+    the requested columns. The copy is rebuilt whenever the source file changes.
+
+    Args:
+      path: the path of the source CSV file.
+      columns: an optional list of column names to load. Defaults to all columns.
+
+    Returns:
+      a pandas DataFrame with the columns of the CSV file cast to the dtypes given by `column_dtype`.
+    """
+    if not CACHE_ENABLED or feather is None:
+        with instrument.stage('storage.parse_csv'):
+            df = pd.read_csv(path, usecols=columns)
+        return apply_schema(df)
+    cached = cache_path(path)
+    signature = source_signature(path)
+    if read_signature(cached) != signature:
+        with instrument.stage('storage.parse_csv'):
+            df = pd.read_csv(path)
+        write_cache(apply_schema(df), cached, signature)
+    table = feather.read_table(cached, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def clear_cache(folder):
+    """
+    This function removes the columnar copies stored next to the CSV files of a folder.
+
+    Args:
+      folder: the folder containing the aggregated trip files.
+    """
+    cache_folder = os.path.join(folder, '.cache')
+    if not os.path.isdir(cache_folder):
+        return
+    for name in os.listdir(cache_folder):
+        if name.endswith('.feather'):
+            os.remove(os.path.join(cache_folder, name))
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import itertools
+import concurrent.futures
+import pandas as pd
+import analysis
+import fitting
+import timebins
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+METRICS = {'willingness_to_share': ('df_day', 'count_total', 'requested_per'),
+           'match_rate': ('agg_hdm', 'count_shared_requested_mean', 'matched_percent'),
+           'unit_fare_ratio': ('agg_hdm', 'count_mean_total', 'cost_ratio_mile')}
+DAY_TYPES = {'all': list(range(7)), 'weekday': [0, 1, 2, 3, 4], 'weekend': [5, 6]}
+PAPER_GRID = {'region': [None, 'north', 'south'], 'months': [(1, 9), (1, 12)],
+              'days': ['all', 'weekday', 'weekend'], 'metric': list(METRICS), 'scheme': ['paper']}
+_SHARED = {}
+
+
+def expand_grid(grid):
+    """
+    This function expands a scenario grid into the list of its cells.
+
+    Args:
+      grid: a dictionary mapping each dimension to its values, such as `PAPER_GRID`. The dimensions
+    are 'year' (keys of the `folders` of `run_sweep`), 'region' (None for citywide), 'months' (a
+    `(first, last)` month window), 'days' (a key of `DAY_TYPES`), 'metric' (a key of `METRICS`) and
+    'scheme' (a key of `timebins.PERIOD_SCHEMES`). Missing dimensions take their first usual value.
+
+    Returns:
+      a list of dictionaries, one per cell of the cross product.
+    """
+    grid = dict({'year': [None], 'region': [None], 'months': [(1, 12)], 'days': ['all'],
+                 'metric': ['match_rate'], 'scheme': ['paper']}, **grid)
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def share_panel(folder, region, workdir):
+    """
+    This function writes the hourly panel of a folder and region to an uncompressed Feather file that
+    the workers memory-map, so every worker reads the same pages instead of its own copy.
+
+    Args:
+      folder: the folder of the aggregated trip files.
+      region: the region sub-folder, or None for the citywide files.
+      workdir: the folder of the shared panel files.
+
+    Returns:
+      the path of the panel file.
+    """
+    paths = [analysis.data_path(folder, mode, type_of_data, region) for mode, type_of_data in
+             [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]]
+    digest = hashlib.blake2b(digest_size=12)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update((os.path.abspath(path) + str(stat.st_mtime_ns) + str(stat.st_size)).encode())
+    path = os.path.join(workdir, 'panel_' + digest.hexdigest() + '.feather')
+    if not os.path.exists(path):
+        panel = analysis.build_panel(folder, region).reset_index()
+        feather.write_feather(panel, path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def open_panel(path):
+    """
+    This function maps a shared panel file in a worker. The columns are numpy views of the mapped file,
+    and the frame is kept for the next cells of the worker.
+    """
+    if path not in _SHARED:
+        table = feather.read_table(path, memory_map=True)
+        _SHARED[path] = pd.DataFrame({name: column.to_numpy() for name, column in
+                                      zip(table.column_names, table.columns)}, copy=False)
+    return _SHARED[path]
+
+
+def run_cell(path, cell, transforms):
+    """
+    This function aggregates and fits one cell of a sweep.
+
+    Args:
+      path: the path of the shared panel of the cell.
+      cell: a dictionary returned by `expand_grid`.
+      transforms: the functional forms to fit, from `fitting.TRANSFORMS`.
+
+    Returns:
+      a pandas DataFrame with the `fitting.fit_forms` rows of the cell, for all periods together
+    (period "all") and for each period of the scheme, preceded by the dimensions of the cell and the
+    'interval'.
+    """
+    panel = open_panel(path)
+    first, last = cell['months']
+    rows = panel['pickup_month'].between(first, last) & panel['pickup_day'].isin(DAY_TYPES[cell['days']])
+    panel = panel[rows].reset_index(drop=True)
+    table, x, y = METRICS[cell['metric']]
+    if table == 'df_day':
+        df = analysis.weekday_metrics(panel)
+    else:
+        df = analysis.data_agg(panel, ['pickup_hour', 'pickup_day', 'pickup_month'])
+    df['interval'] = timebins.periods(df, cell['scheme'])
+    fits = [fitting.fit_forms(df, [(x, y)], transforms).assign(interval='all'),
+            fitting.fit_forms(df, [(x, y)], transforms, by=['interval'])]
+    result = pd.concat(fits, ignore_index=True)
+    result.insert(0, 'interval', result.pop('interval'))
+    for position, (name, value) in enumerate(cell.items()):
+        result.insert(position, name, [value]*len(result))
+    return result
+
+
+def run_sweep(grid, folders, workdir, transforms=('sqrt',), max_workers=None, chunksize=4):
+    """
+    This function runs the aggregation and the fits of every cell of a scenario grid on a process pool
+    and collects the results in one table. Each panel is built once in the calling process and
+    shared with the workers through a memory-mapped Feather file, so the workers neither read the CSV
+    files nor hold private copies of the panels, and the cells are independent.
+
+    Args:
+      grid: a scenario grid, see `expand_grid`.
+      folders: a dictionary mapping each 'year' of the grid to the folder of its aggregated trip files,
+    or a single folder for grids without a 'year' dimension.
+      workdir: the folder where the shared panel files are written. Files of unchanged inputs are
+    reused by later sweeps.
+      transforms: the functional forms to fit, from `fitting.TRANSFORMS`.
+      max_workers: the number of worker processes. Defaults to the number of CPUs; 1 runs the cells in
+    the calling process.
+      chunksize: the number of cells sent to a worker at a time.
+
+    Returns:
+      a pandas DataFrame with the rows of `run_cell` for every cell.
+    """
+    if feather is None:
+        raise ImportError('run_sweep needs pyarrow to share the panels')
+    if not isinstance(folders, dict):
+        folders = {None: folders}
+    os.makedirs(workdir, exist_ok=True)
+    cells = expand_grid(grid)
+    panels = {}
+    for cell in cells:
+        key = (cell['year'], cell['region'])
+        if key not in panels:
+            panels[key] = share_panel(folders[cell['year']], cell['region'], workdir)
+    paths = [panels[(cell['year'], cell['region'])] for cell in cells]
+    transforms = [list(transforms)]*len(cells)
+    if max_workers == 1:
+        results = list(map(run_cell, paths, cells, transforms))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(run_cell, paths, cells, transforms, chunksize=chunksize))
+    return pd.concat(results, ignore_index=True)
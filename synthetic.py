@@ -0,0 +1,191 @@
+import os
+import numpy as np
+import pandas as pd
+import analysis
+import ingest
+
+# relative trip volume of each hour of the day, with the morning and evening peaks
+HOUR_PROFILE = np.array([0.45, 0.3, 0.2, 0.15, 0.15, 0.25, 0.5, 0.85, 1.0, 0.8, 0.65, 0.7,
+                         0.75, 0.75, 0.75, 0.85, 0.95, 1.0, 0.95, 0.85, 0.75, 0.7, 0.65, 0.55])
+# relative trip volume of each day of the week, Monday first
+DAY_PROFILE = np.array([0.85, 0.9, 0.95, 1.0, 1.15, 1.2, 0.95])
+
+
+def time_grid(year, days, hours):
+    """
+    This function lists the pickup hours covered by a synthetic data set.
+
+    Args:
+      year: the year of the first day.
+      days: the number of days, starting on January 1st.
+      hours: the hours of the day to include.
+
+    Returns:
+      a pandas DataFrame with the `ingest.YEAR_KEY` and `ingest.TIME_KEYS` columns, one row per day
+    and hour.
+    """
+    dates = pd.date_range(str(year) + '-01-01', periods=days, freq='D')
+    hours = np.asarray(list(hours), dtype=np.int64)
+    day_index = np.repeat(np.arange(days), len(hours))
+    return pd.DataFrame({ingest.YEAR_KEY: dates.year.to_numpy()[day_index],
+                         'pickup_hour': np.tile(hours, days),
+                         'pickup_date': dates.day.to_numpy()[day_index],
+                         'pickup_day': dates.dayofweek.to_numpy()[day_index],
+                         'pickup_month': dates.month.to_numpy()[day_index]})
+
+
+def trip_counts(rng, rate, share=0.2):
+    """
+    This function draws the trip counts of each row. The match rate of shared requests grows with the
+    number of requests, so the synthetic data shows a scale effect.
+
+    Args:
+      rng: a `numpy.random.Generator`.
+      rate: a numpy array with the expected number of trips of each row.
+      share: the expected fraction of trips requested as shared.
+
+    Returns:
+      a dictionary mapping each `(mode, type_of_data)` pair in `ingest.TRIP_TYPES` to a count array.
+    Shared requests that are not matched are counted as single realized trips, as in `ingest`.
+    """
+    requested = rng.poisson(rate*share)
+    match_rate = 0.35 + 0.4*(1 - np.exp(-requested/40))
+    realized = rng.binomial(requested, match_rate)
+    single = rng.poisson(rate*(1 - share)) + requested - realized
+    return {('single', 'realized'): single, ('shared', 'realized'): realized,
+            ('shared', 'requested'): requested}
+
+
+def trip_measures(rng, count, hour, mode):
+    """
+    This function draws the mean trip measures of each row.
+
+    Args:
+      rng: a `numpy.random.Generator`.
+      count: a numpy array with the number of trips of each row.
+      hour: a numpy array with the pickup hour of each row.
+      mode: "single" or "shared". Shared trips are longer, slower and cheaper per mile.
+
+    Returns:
+      a dictionary mapping each measure in `ingest.MEASURES` to a numpy array of row means.
+    """
+    spread = 1/np.sqrt(np.maximum(count, 1))
+    shared = mode == 'shared'
+    peak = HOUR_PROFILE[hour]
+    trip_miles = (5.5 if shared else 4.5)*np.exp(rng.normal(0, 0.6*spread))
+    trip_mph = (16 if shared else 19)*(1.3 - 0.4*peak)*np.exp(rng.normal(0, 0.3*spread))
+    trip_seconds = trip_miles/trip_mph*3600
+    fare = ((1.5 if shared else 2.5) + (0.8 if shared else 1.1)*trip_miles +
+            0.25*trip_seconds/60)*np.exp(rng.normal(0, 0.2*spread))
+    tip = (0.1 if shared else 0.6)*fare*rng.uniform(0, 2*spread.clip(max=0.5)+0.5)
+    additional_charge = 2.5 + rng.exponential(0.5*spread)
+    fare_total = fare + tip + additional_charge
+    return {'trip_seconds': trip_seconds, 'trip_miles': trip_miles, 'trip_mph': trip_mph,
+            'fare_mile': fare_total/trip_miles, 'fare_minute': fare_total/trip_seconds*60,
+            'fare_total': fare_total, 'fare': fare, 'tip': tip,
+            'additional_charge': additional_charge}
+
+
+def trip_frames(rng, keys, rate):
+    """
+    This function draws the three aggregated trip files of one region.
+
+    Args:
+      rng: a `numpy.random.Generator`.
+      keys: a pandas DataFrame with the key columns of every row, as returned by `time_grid`.
+      rate: a numpy array with the expected number of trips of each row.
+
+    Returns:
+      a dictionary mapping each `(mode, type_of_data)` pair to a pandas DataFrame in the layout of
+    `ingest.finalize_partial`, without the rows that have no trips.
+    """
+    hour = keys['pickup_hour'].to_numpy()
+    frames = {}
+    for (mode, type_of_data), count in trip_counts(rng, rate).items():
+        suffix = '_' + mode + '_' + type_of_data
+        rows = count > 0
+        df = keys[rows].reset_index(drop=True)
+        if type_of_data == 'realized':
+            for measure, values in trip_measures(rng, count[rows], hour[rows], mode).items():
+                df[measure + suffix] = values
+        df['count' + suffix] = count[rows]
+        frames[(mode, type_of_data)] = df
+    return frames
+
+
+def tract_ids(rng, tracts):
+    """
+    This function draws census tract identifiers in the format of the Chicago files.
+
+    Args:
+      rng: a `numpy.random.Generator`.
+      tracts: the number of tracts.
+
+    Returns:
+      a sorted numpy array of float tract identifiers such as 17031010100.0.
+    """
+    codes = rng.choice(np.arange(1000, 8500), size=tracts, replace=False)
+    return np.sort(17031000000 + codes*100).astype(np.float64)
+
+
+def generate(folder, year=2019, days=365, hours=range(24), regions=('north', 'south'), tracts=100,
+             od_pairs=1000, trips_per_hour=2000, tract_share=0.1, seed=0):
+    """
+    This function writes a seeded synthetic set of aggregated trip files with the exact layout of the
+    files written by `ingest.build_aggregates`: the citywide and region files read by `data_read` and
+    the citywide census tract files read by `data_read2`. The tract files are written one month at a
+    time, so the memory use does not depend on the number of days.
+
+    Args:
+      folder: the directory where the files are written.
+      year: the year of the data.
+      days: the number of days, starting on January 1st.
+      hours: the hours of the day to include.
+      regions: the names of the region sub-folders. Each region gets a share of the citywide volume.
+      tracts: the number of census tracts.
+      od_pairs: the number of pickup and dropoff tract pairs with trips.
+      trips_per_hour: the mean number of citywide trips per hour at the peak.
+      tract_share: the fraction of the citywide trips spread over the tract pairs.
+      seed: the seed of the random draws. The same arguments and seed give the same files.
+
+    Returns:
+      a dictionary mapping `(region, mode, type_of_data, tract)` to the path of each written file, with
+    region None for the citywide files.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(regions) + 2)
+    keys = time_grid(year, days, hours)
+    profile = HOUR_PROFILE[keys['pickup_hour'].to_numpy()]*DAY_PROFILE[keys['pickup_day'].to_numpy()]
+    paths = {}
+    scopes = [(None, 1.0)] + [(region, 1/len(regions)) for region in regions]
+    for (region, weight), child in zip(scopes, seeds):
+        rng = np.random.default_rng(child)
+        rate = trips_per_hour*weight*profile*np.exp(rng.normal(0, 0.1, len(keys)))
+        for (mode, type_of_data), df in trip_frames(rng, keys, rate).items():
+            path = analysis.data_path(folder, mode, type_of_data, region)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_csv(path, index=False)
+            paths[(region, mode, type_of_data, False)] = path
+
+    rng = np.random.default_rng(seeds[-1])
+    ids = tract_ids(rng, tracts)
+    pairs = rng.choice(tracts*tracts, size=min(od_pairs, tracts*tracts), replace=False)
+    pair_weight = rng.lognormal(0, 1, len(pairs))
+    pair_weight = pair_weight/pair_weight.sum()
+    for mode, type_of_data in ingest.TRIP_TYPES:
+        path = analysis.data_path(folder, mode, type_of_data, tract=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        paths[(None, mode, type_of_data, True)] = path
+    for month in np.unique(keys['pickup_month']):
+        month_rows = np.flatnonzero(keys['pickup_month'].to_numpy() == month)
+        pair_index = np.tile(np.arange(len(pairs)), len(month_rows))
+        row_index = np.repeat(month_rows, len(pairs))
+        tract_keys = pd.DataFrame({'Pickup Census Tract': ids[pairs[pair_index]//tracts],
+                                   'Dropoff Census Tract': ids[pairs[pair_index] % tracts]})
+        tract_keys = pd.concat([tract_keys, keys.iloc[row_index].reset_index(drop=True)], axis=1)
+        rate = trips_per_hour*tract_share*profile[row_index]*pair_weight[pair_index]
+        for (mode, type_of_data), df in trip_frames(rng, tract_keys, rate).items():
+            path = paths[(None, mode, type_of_data, True)]
+            df.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+    return paths
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pytest
+import analysis
+import synthetic
+
+KEYS = ['pickup_hour', 'pickup_day', 'pickup_month']
+
+
+@pytest.fixture(scope='module')
+def folder(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('synthetic'))
+    synthetic.generate(folder, days=70, regions=('north',), tracts=12, od_pairs=40,
+                       trips_per_hour=300)
+    return folder
+
+
+def merge_panel(folder, region=None):
+    """
+    This function joins the three hourly files with the inner merges that `build_panel` replaces.
+    """
+    frames = [pd.read_csv(analysis.data_path(folder, mode, type_of_data, region))
+              for mode, type_of_data in [('single', 'realized'), ('shared', 'realized'),
+                                         ('shared', 'requested')]]
+    keys = ['year'] + analysis.PANEL_KEYS
+    return pd.merge(pd.merge(frames[0], frames[1], on=keys), frames[2], on=keys)
+
+
+def groupby_agg(df, base):
+    """
+    This function is the groupby implementation of `data_agg` that the bincount kernels replace.
+    """
+    df = df.copy()
+    counts = ['count_shared_realized', 'count_shared_requested', 'count_single_realized']
+    aggregations = {}
+    for count in counts:
+        aggregations[count + '_total'] = (count, 'sum')
+        aggregations[count + '_mean'] = (count, 'mean')
+    for measure in ['fare_total', 'trip_miles', 'trip_seconds']:
+        for mode in ['shared', 'single']:
+            column = measure + '_' + mode + '_realized'
+            df[column + '_total'] = df[column]*df['count_' + mode + '_realized']
+            aggregations[column + '_total'] = (column + '_total', 'sum')
+    g = df.groupby(base).agg(**aggregations).reset_index()
+    for mode in ['single', 'shared']:
+        g['fare_minute_%s_realized_mean' % mode] = \
+            g['fare_total_%s_realized_total' % mode]/g['trip_seconds_%s_realized_total' % mode]*60
+    for mode in ['single', 'shared']:
+        g['fare_mile_%s_realized_mean' % mode] = \
+            g['fare_total_%s_realized_total' % mode]/g['trip_miles_%s_realized_total' % mode]
+    g['count_total_total'] = g['count_shared_realized_total'] + g['count_single_realized_total']
+    g['count_mean_total'] = g['count_shared_realized_mean'] + g['count_single_realized_mean']
+    g['requested_percent'] = g['count_shared_requested_total']/g['count_total_total']*100
+    g['matched_percent'] = g['count_shared_realized_total']/g['count_shared_requested_total']*100
+    g['cost_ratio_minute'] = g['fare_minute_shared_realized_mean']/g['fare_minute_single_realized_mean']
+    g['cost_ratio_mile'] = g['fare_mile_shared_realized_mean']/g['fare_mile_single_realized_mean']
+    g['interval'] = 'AM Peak'
+    g.loc[(g['pickup_hour'] > 6) & (g['pickup_hour'] < 13), 'interval'] = 'Mid-day'
+    g.loc[(g['pickup_hour'] >= 13) & (g['pickup_hour'] <= 18), 'interval'] = 'PM Peak'
+    g.loc[(g['pickup_hour'] > 18) | (g['pickup_hour'] < 4), 'interval'] = 'Night'
+    g['colors'] = g['interval'].map({'Night': 'blue', 'AM Peak': 'orange', 'Mid-day': 'green',
+                                     'PM Peak': 'red'})
+    g['markers'] = g['interval'].map({'Night': 'o', 'AM Peak': '^', 'Mid-day': 's', 'PM Peak': 'D'})
+    return g
+
+
+def test_build_panel_matches_merge(folder):
+    panel = analysis.build_panel(folder, 'north').reset_index()
+    expected = merge_panel(folder, 'north').sort_values(['year'] + analysis.PANEL_KEYS)
+    assert sorted(panel.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(panel, expected[panel.columns].reset_index(drop=True),
+                                  check_dtype=False, rtol=1e-6)
+
+
+def test_align_frames_matches_merge_on_partial_overlap():
+    rng = np.random.default_rng(0)
+    frames = []
+    for name in ['a', 'b', 'c']:
+        keys = pd.DataFrame({'pickup_month': rng.integers(1, 4, 200),
+                             'pickup_date': rng.integers(1, 29, 200),
+                             'pickup_hour': rng.integers(0, 24, 200)})
+        keys['pickup_day'] = keys['pickup_date'] % 7
+        keys = keys.drop_duplicates().sample(frac=1, random_state=0)
+        frames.append(keys.assign(**{name: rng.random(len(keys))}))
+    aligned = analysis.align_frames(frames).reset_index()
+    expected = pd.merge(pd.merge(frames[0], frames[1], on=analysis.PANEL_KEYS), frames[2],
+                        on=analysis.PANEL_KEYS).sort_values(analysis.PANEL_KEYS).reset_index(drop=True)
+    assert len(aligned) > 0
+    pd.testing.assert_frame_equal(aligned, expected[aligned.columns])
+
+
+def test_align_frames_duplicate_keys_fall_back_to_merge():
+    left = pd.DataFrame({'pickup_month': [1, 1, 1], 'pickup_date': [1, 1, 2], 'pickup_hour': [0, 0, 0],
+                         'pickup_day': [1, 1, 2], 'x': [1, 2, 3]})
+    right = pd.DataFrame({'pickup_month': [1, 1], 'pickup_date': [2, 1], 'pickup_hour': [0, 0],
+                          'pickup_day': [2, 1], 'y': [9, 8]})
+    aligned = analysis.align_frames([left, right]).reset_index()
+    expected = pd.merge(left, right, on=analysis.PANEL_KEYS)
+    expected = expected.sort_values(analysis.PANEL_KEYS, kind='stable')
+    pd.testing.assert_frame_equal(aligned, expected.reset_index(drop=True))
+    assert aligned['x'].tolist() == [1, 2, 3]
+
+
+def test_group_kernels_match_groupby_with_missing_values():
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({'a': rng.integers(0, 5, 500), 'b': rng.choice([10.0, 20.0, np.nan], 500),
+                       'value': rng.normal(size=500), 'count': rng.integers(0, 9, 500)})
+    df.loc[rng.random(500) < 0.2, 'value'] = np.nan
+    df.loc[df['a'] == 4, 'value'] = np.nan
+    codes, keys = analysis.factorize_keys(df, ['a', 'b'])
+    grouped = df.groupby(['a', 'b'])
+    expected_keys = grouped.size().reset_index()[['a', 'b']]
+    pd.testing.assert_frame_equal(keys, expected_keys, check_column_type=False)
+    assert (codes[df['b'].isna().to_numpy()] == len(keys)).all()
+    for column in ['value', 'count']:
+        values = df[column].to_numpy()
+        np.testing.assert_allclose(analysis.group_sum(codes, len(keys), values), grouped[column].sum())
+        np.testing.assert_allclose(analysis.group_mean(codes, len(keys), values), grouped[column].mean())
+        np.testing.assert_array_equal(analysis.group_count(codes, len(keys), values),
+                                      grouped[column].count())
+
+
+def test_data_agg_matches_groupby(folder):
+    panel = merge_panel(folder)
+    panel['trip_seconds_shared_realized'] = panel['trip_seconds_shared_realized'].mask(
+        panel['pickup_hour'] == 3)
+    result = analysis.data_agg(panel, KEYS)
+    expected = groupby_agg(panel, KEYS)
+    assert result.columns.tolist() == expected.columns.tolist()
+    assert isinstance(result['interval'].dtype, pd.CategoricalDtype)
+    assert set(result['interval'].cat.categories) == {'Night', 'AM Peak', 'Mid-day', 'PM Peak'}
+    result['interval'] = result['interval'].astype(object)
+    for column in ['colors', 'markers']:
+        result[column] = result[column].astype(object)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+
+def test_data_agg_weekday_new_matches_groupby(folder):
+    df = merge_panel(folder)
+    df['count_total'] = df['count_shared_realized'] + df['count_single_realized']
+    df['weekday'] = np.where(df['pickup_day'] < 5, 'weekday', 'weekend')
+    result = analysis.data_agg_weekday_new(df)
+    expected = df.groupby(['pickup_hour', 'weekday', 'pickup_day']).agg(
+        count_total=('count_total', 'mean'), count_total2=('count_total', 'sum'),
+        count_shared_requested=('count_shared_requested', 'sum')).reset_index()
+    day = (expected['pickup_hour'] >= 4) & (expected['pickup_hour'] <= 18)
+    expected['d or n'] = np.where(day, 70, 30)
+    expected['requested_per'] = expected['count_shared_requested']/expected['count_total2']*100
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
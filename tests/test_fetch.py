@@ -0,0 +1,125 @@
+import os
+import json
+import asyncio
+import threading
+import http.server
+import urllib.parse
+import numpy as np
+import pandas as pd
+import pytest
+import fetch
+import ingest
+
+START, END = '2019-03-04', '2019-03-07'
+PAGE_SIZE = 50
+
+
+def raw_trips(n=600, seed=0):
+    """
+    This function draws trips in the layout of the portal exports, on the 15-minute timestamps of the
+    TNP extract.
+    """
+    rng = np.random.default_rng(seed)
+    tracts = np.array([17031010100, 17031010200, 17031080100, 17031320100])
+    start = pd.Timestamp(START) + pd.to_timedelta(rng.integers(0, 3*96, n)*15, unit='min')
+    shared = rng.random(n) < 0.3
+    fare = rng.uniform(5, 30, n).round(2)
+    return pd.DataFrame({
+        'Trip Start Timestamp': start, 'Trip Seconds': rng.integers(60, 3600, n),
+        'Trip Miles': rng.uniform(0.5, 20, n).round(1),
+        'Pickup Census Tract': rng.choice(tracts, n), 'Dropoff Census Tract': rng.choice(tracts, n),
+        'Pickup Community Area': rng.integers(1, 78, n), 'Fare': fare, 'Tip': rng.integers(0, 5, n),
+        'Additional Charges': 2.5, 'Trip Total': fare + 2.5, 'Shared Trip Authorized': shared,
+        'Trips Pooled': np.where(shared & (rng.random(n) < 0.5), 2, 1)})
+
+
+def record_pages(trips):
+    """
+    This function records the responses of the SODA endpoint for the count and page requests of
+    `fetch`, keyed by the first day of the window and the offset (None for the count).
+    """
+    api = trips.rename(columns={name: field for field, name in fetch.API_COLUMNS.items()})
+    api['trip_start_timestamp'] = api['trip_start_timestamp'].dt.strftime('%Y-%m-%dT%H:%M:%S.000')
+    pages = {}
+    for window in fetch.day_windows(START, END):
+        rows = api[(api['trip_start_timestamp'] >= window[0]) & (api['trip_start_timestamp'] < window[1])]
+        pages[(window[0], None)] = ('count\n%d\n' % len(rows)).encode()
+        for offset in range(0, len(rows), PAGE_SIZE):
+            pages[(window[0], offset)] = rows.iloc[offset:offset + PAGE_SIZE].to_csv(index=False).encode()
+    return pages
+
+
+@pytest.fixture
+def server(request):
+    """
+    This fixture serves recorded pages over HTTP. Pages listed in `failing` answer with an error, and
+    every page that is served is appended to `served`.
+    """
+    state = {'pages': record_pages(raw_trips()), 'failing': set(), 'served': []}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+            day = query['$where'].split("'")[1][:10]
+            offset = None if query['$select'].startswith('count') else int(query['$offset'])
+            if (day, offset) in state['failing']:
+                body, status = b'', 500
+            else:
+                body, status = state['pages'][(day, offset)], 200
+                if offset is not None:
+                    state['served'].append((day, offset))
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    request.addfinalizer(httpd.shutdown)
+    state['url'] = 'http://127.0.0.1:%d/resource/m6dm-c72p.csv' % httpd.server_port
+    return state
+
+
+def pull(server, staging):
+    return asyncio.run(fetch.fetch(staging, START, END, server['url'], page_size=PAGE_SIZE,
+                                   concurrency=2, retries=1, timeout=10))
+
+
+def test_resume_fetches_only_missing_pages(server, tmp_path):
+    staging = str(tmp_path / 'staging')
+    all_pages = {key for key in server['pages'] if key[1] is not None}
+    failed = ('2019-03-05', PAGE_SIZE)
+    server['failing'].add(failed)
+    with pytest.raises(OSError):
+        pull(server, staging)
+    with open(os.path.join(staging, 'manifest.json')) as f:
+        first = json.load(f)
+    done = {(page['window'], page['offset']) for page in first['pages'].values()}
+    assert failed not in done and done and done < all_pages
+
+    server['failing'].clear()
+    server['served'].clear()
+    manifest = pull(server, staging)
+    assert sorted(server['served']) == sorted(all_pages - done)
+    with open(os.path.join(staging, 'manifest.json')) as f:
+        assert json.load(f) == manifest
+    assert {(page['window'], page['offset']) for page in manifest['pages'].values()} == all_pages
+    assert sum(page['rows'] for page in manifest['pages'].values()) == sum(manifest['counts'].values())
+
+    trips = raw_trips()
+    trips['Trip Start Timestamp'] = trips['Trip Start Timestamp'].dt.strftime(ingest.TIMESTAMP_FORMAT)
+    trips.to_csv(tmp_path / 'raw.csv', index=False)
+    for tract in (False, True):
+        staged = ingest.aggregate_chunks(fetch.read_staged(staging, chunksize=120),
+                                         str(tmp_path / 'staged'), tract=tract)
+        built = ingest.build_aggregates(str(tmp_path / 'raw.csv'), str(tmp_path / 'built'), tract=tract,
+                                        chunksize=120)
+        assert staged.keys() == built.keys()
+        for key in staged:
+            pd.testing.assert_frame_equal(pd.read_csv(staged[key]), pd.read_csv(built[key]))
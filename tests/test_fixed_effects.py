@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+import fixed_effects
+
+sm = pytest.importorskip('statsmodels.formula.api')
+
+FORMULA = 'y ~ np.sqrt(x) + C(OD) + C(week_hour) + C(pickup_month)'
+
+
+@pytest.fixture(scope='module')
+def panel():
+    rng = np.random.default_rng(2)
+    n = 900
+    df = pd.DataFrame({'OD': rng.integers(0, 30, n), 'pickup_day': rng.integers(0, 7, n),
+                       'pickup_hour': rng.integers(0, 4, n), 'pickup_month': rng.integers(1, 4, n),
+                       'group': rng.integers(0, 25, n), 'x': rng.gamma(2.0, 5.0, n)})
+    df['week_hour'] = df['pickup_day']*24 + df['pickup_hour']
+    effects = rng.normal(size=30)[df['OD']] + rng.normal(size=168)[df['week_hour']] + df['pickup_month']/2
+    df['y'] = 1.5*np.sqrt(df['x']) + effects + rng.normal(scale=1 + df['group']/10, size=n)
+    return df
+
+
+def test_absorb_fit_matches_dummy_regression(panel):
+    result = fixed_effects.absorb_fit(panel, 'x', 'y', cluster=None, singletons=True, tol=1e-12)
+    expected = sm.ols(FORMULA, panel).fit()
+    assert result['n'][0] == len(panel)
+    assert result['absorbed'][0] == expected.df_model
+    assert result['slope'][0] == pytest.approx(expected.params['np.sqrt(x)'], rel=1e-8)
+    assert result['slope_se'][0] == pytest.approx(expected.bse['np.sqrt(x)'], rel=1e-6)
+
+
+def test_absorb_fit_clustered_standard_error(panel):
+    result = fixed_effects.absorb_fit(panel, 'x', 'y', cluster='group', singletons=True, tol=1e-12)
+    expected = sm.ols(FORMULA, panel).fit(cov_type='cluster', cov_kwds={'groups': panel['group']})
+    assert result['clusters'][0] == 25
+    assert result['slope'][0] == pytest.approx(expected.params['np.sqrt(x)'], rel=1e-8)
+    assert result['slope_se'][0] == pytest.approx(expected.bse['np.sqrt(x)'], rel=1e-6)
+
+
+def test_absorb_fit_nested_effects_do_not_count(panel):
+    result = fixed_effects.absorb_fit(panel, 'x', 'y', cluster='OD', singletons=True, tol=1e-12)
+    expected = sm.ols(FORMULA, panel).fit(cov_type='cluster', cov_kwds={'groups': panel['OD']})
+    n, k = expected.nobs, expected.df_model + 1
+    # the OD effects, and the intercept they contain, lie within the OD clusters, so reghdfe leaves
+    # them out of the correction
+    nested = panel['OD'].nunique()
+    se = expected.bse['np.sqrt(x)']*np.sqrt((n - k)/(n - k + nested))
+    assert result['slope_se'][0] == pytest.approx(se, rel=1e-6)
@@ -0,0 +1,21 @@
+import benchmark
+
+
+def test_compute_imports_without_plotting_stack():
+    # a fresh interpreter imports `compute` and reports the top-level modules it loaded
+    measure = benchmark.measure_import('compute', repeat=1)
+    loaded = [name for name in benchmark.PLOTTING_MODULES if name in measure['modules']]
+    assert loaded == []
+    # loose limits: the probe guards against pulling in the plotting stack, not against slow disks
+    assert measure['seconds'] < 10*benchmark.IMPORT_BUDGETS['compute']['seconds']
+    assert measure['rss_mb'] < 4*benchmark.IMPORT_BUDGETS['compute']['rss_mb']
+
+
+def test_check_imports_flags_forbidden_modules():
+    budgets = {'utils': {'seconds': 60, 'rss_mb': 4096, 'forbidden': benchmark.PLOTTING_MODULES},
+               'figures': {'seconds': 60, 'rss_mb': 4096, 'forbidden': ['json']}}
+    table = benchmark.check_imports(budgets, repeat=1).set_index('module')
+    assert table.loc['utils', 'within']
+    assert table.loc['utils', 'forbidden_loaded'] == ''
+    assert not table.loc['figures', 'within']
+    assert table.loc['figures', 'forbidden_loaded'] == 'json'
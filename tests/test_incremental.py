@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pandas as pd
+import analysis
+import incremental
+import synthetic
+
+FILES = [('single', 'realized'), ('shared', 'realized'), ('shared', 'requested')]
+
+
+def split_months(folder, root, region):
+    """
+    This function splits the hourly files of a folder into one delivery folder per pickup month.
+    """
+    frames = [pd.read_csv(analysis.data_path(folder, mode, type_of_data, region))
+              for mode, type_of_data in FILES]
+    deliveries = []
+    for month in sorted(frames[0]['pickup_month'].unique()):
+        delivery = os.path.join(root, 'm%02d' % month)
+        for df, (mode, type_of_data) in zip(frames, FILES):
+            path = analysis.data_path(delivery, mode, type_of_data, region)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df[df['pickup_month'] == month].to_csv(path, index=False)
+        deliveries.append(delivery)
+    return deliveries
+
+
+def test_update_store_matches_agg_hdm(tmp_path):
+    folder = str(tmp_path / 'full')
+    synthetic.generate(folder, days=100, regions=('north',), tracts=8, od_pairs=20, trips_per_hour=200)
+    deliveries = split_months(folder, str(tmp_path / 'deliveries'), 'north')
+    assert len(deliveries) == 4
+    path = str(tmp_path / 'store.feather')
+    for delivery in deliveries:
+        store = incremental.update_store(path, delivery, regions=('north',))
+    # a delivery that was already folded is skipped
+    store = incremental.update_store(path, deliveries[0], regions=('north',))
+    assert len(incremental.load_store(path)[1]) == len(deliveries)
+    result = incremental.store_hdm(store, 'north')
+    expected = analysis.agg_hdm(folder, 'north')
+    for column in incremental.COUNT_COLUMNS:
+        assert result[column].dtype == np.int64
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True),
+                                  check_dtype=False, rtol=1e-9)
+    assert (result.dtypes[incremental.COUNT_COLUMNS] == expected.dtypes[incremental.COUNT_COLUMNS]).all()
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import od
+
+
+def tract_frame(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    tracts = np.array([17031010100, 17031010200, 17031842400, 17043840000, 17197880400])
+    df = pd.DataFrame({'Pickup Census Tract': rng.choice(tracts, n).astype(np.float64),
+                       'Dropoff Census Tract': rng.choice(tracts, n).astype(np.float64),
+                       'year': 2019, 'pickup_month': rng.integers(1, 13, n),
+                       'pickup_date': rng.integers(1, 29, n), 'pickup_hour': rng.integers(0, 24, n),
+                       'count_total': rng.integers(1, 20, n)})
+    df['pickup_day'] = df['pickup_date'] % 7
+    keys = ['Pickup Census Tract', 'Dropoff Census Tract', 'pickup_month', 'pickup_date', 'pickup_hour']
+    return df.drop_duplicates(keys).reset_index(drop=True)
+
+
+def test_pack_od_round_trip():
+    df = tract_frame()
+    ids = od.pack_od(df['Pickup Census Tract'], df['Dropoff Census Tract'])
+    pickup, dropoff = od.unpack_od(ids)
+    np.testing.assert_array_equal(pickup, df['Pickup Census Tract'].to_numpy(np.int64))
+    np.testing.assert_array_equal(dropoff, df['Dropoff Census Tract'].to_numpy(np.int64))
+    # the identifier of a pair does not depend on the other pairs
+    np.testing.assert_array_equal(od.pack_od(df['Pickup Census Tract'][:5], df['Dropoff Census Tract'][:5]),
+                                  ids[:5])
+    order = np.lexsort((df['Dropoff Census Tract'], df['Pickup Census Tract']))
+    assert (np.diff(ids[order]) >= 0).all()
+
+
+def test_pack_od_rejects_other_states():
+    with pytest.raises(ValueError):
+        od.pack_od([18097310100], [17031010100])
+
+
+def test_store_summaries_use_pack_od_identifiers():
+    df = tract_frame()
+    df['OD'] = od.pack_od(df['Pickup Census Tract'], df['Dropoff Census Tract'])
+    store = od.od_store(df, ['count_total'])
+    totals = od.od_totals(store, 'count_total')
+    expected = df.groupby('OD')['count_total'].sum()
+    pd.testing.assert_series_equal(totals, expected.astype(np.float64), check_names=False)
+    top = od.top_od(store, 'count_total', 3)
+    assert top['OD'].tolist() == expected.sort_values(ascending=False, kind='stable').index[:3].tolist()
+    frame = od.store_frame(store)
+    joined = frame.merge(df, on=['OD', 'pickup_month', 'pickup_date', 'pickup_hour'], suffixes=('', '_df'))
+    assert len(joined) == len(df)
+    assert (joined['count_total'] == joined['count_total_df']).all()
+    assert (joined['Pickup Census Tract'] == joined['Pickup Census Tract_df']).all()
+
+
+def test_store_frame_keeps_minute_bins():
+    df = tract_frame()
+    df['pickup_minute'] = df['pickup_hour']*60 + np.arange(len(df)) % 4*15
+    frame = od.store_frame(od.od_store(df, ['count_total']))
+    keys = ['Pickup Census Tract', 'Dropoff Census Tract', 'year', 'pickup_month', 'pickup_date',
+            'pickup_hour', 'pickup_minute', 'pickup_day']
+    expected = df[keys + ['count_total']].sort_values(keys).to_numpy(np.float64)
+    np.testing.assert_array_equal(frame[keys + ['count_total']].sort_values(keys).to_numpy(np.float64),
+                                  expected)
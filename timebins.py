@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import analysis
+
+MINUTES_PER_DAY = 24*60
+# a scheme lists (period, first minute, end minute) ranges covering the day once; the categories are
+# the periods in the order of their first range
+PERIOD_SCHEMES = {
+    'paper': [('Night', 0, 240), ('AM Peak', 240, 420), ('Mid-day', 420, 780),
+              ('PM Peak', 780, 1140), ('Night', 1140, 1440)],
+    'day_night': [('Night', 0, 240), ('Day', 240, 1140), ('Night', 1140, 1440)],
+}
+PERIOD_COLORS = {'Night': 'blue', 'AM Peak': 'orange', 'Mid-day': 'green', 'PM Peak': 'red'}
+PERIOD_MARKERS = {'Night': 'o', 'AM Peak': '^', 'Mid-day': 's', 'PM Peak': 'D'}
+_LOOKUPS = {}
+
+
+def scheme_lookup(scheme):
+    """
+    This function builds the minute-of-day lookup table of a period scheme.
+
+    Args:
+      scheme: a key of `PERIOD_SCHEMES`, or a list of `(period, first minute, end minute)` ranges.
+
+    Returns:
+      a tuple `(codes, categories)` with the category code of each of the 1440 minutes of the day and
+    the list of periods.
+    """
+    key = scheme if isinstance(scheme, str) else tuple(map(tuple, scheme))
+    if key in _LOOKUPS:
+        return _LOOKUPS[key]
+    ranges = PERIOD_SCHEMES[scheme] if isinstance(scheme, str) else scheme
+    categories = list(dict.fromkeys(period for period, _, _ in ranges))
+    codes = np.full(MINUTES_PER_DAY, -1, dtype=np.int8)
+    for period, start, end in ranges:
+        if (codes[start:end] >= 0).any():
+            raise ValueError('the ranges of a period scheme must not overlap')
+        codes[start:end] = categories.index(period)
+    if (codes < 0).any():
+        raise ValueError('the ranges of a period scheme must cover the whole day')
+    _LOOKUPS[key] = (codes, categories)
+    return codes, categories
+
+
+def minute_of_day(df):
+    """
+    This function returns the minute of the day of every row: the start of the time bin for frames
+    with a 'pickup_minute' column, else the start of the pickup hour.
+    """
+    if 'pickup_minute' in df.columns:
+        return df['pickup_minute'].to_numpy(np.int64)
+    return df['pickup_hour'].to_numpy(np.int64)*60
+
+
+def periods(df, scheme='paper'):
+    """
+    This function assigns every row to a period of the day in one table lookup.
+
+    Args:
+      df: a pandas DataFrame with a 'pickup_hour' or 'pickup_minute' column.
+      scheme: a key of `PERIOD_SCHEMES`, or a list of `(period, first minute, end minute)` ranges.
+    Defaults to the four periods of the paper.
+
+    Returns:
+      a pandas Categorical with the period of every row, with the periods of the scheme as categories.
+    """
+    codes, categories = scheme_lookup(scheme)
+    return pd.Categorical.from_codes(codes[minute_of_day(df)], categories)
+
+
+def bin_minutes(minutes, width):
+    """
+    This function maps minutes of the day to the start of their time bin.
+
+    Args:
+      minutes: a numpy array of minutes of the day.
+      width: the width of the bins in minutes, for example 5, 15 or 30. It must divide the day.
+
+    Returns:
+      a numpy array with the first minute of the bin of every minute.
+    """
+    if MINUTES_PER_DAY % width:
+        raise ValueError('the bin width must divide the 1440 minutes of a day')
+    return minutes//width*width
+
+
+def window_sums(df, columns, window, width=60, by=(), year=None):
+    """
+    This function sums columns over a trailing time window, for example the shared trip requests of
+    the last 30 minutes, for every row. The sums are differences of prefix sums over the time bins, so
+    every window width costs the same linear time.
+
+    Args:
+      df: a pandas DataFrame with one row per time bin (and per `by` group), with the 'pickup_month' and
+    'pickup_date' keys, 'pickup_hour' or 'pickup_minute', and a 'year' column or the `year` argument.
+    Bins without a row count as zero.
+      columns: the names of the columns to sum.
+      window: the width of the window in minutes, including the bin of the row. It must be a multiple
+    of `width`.
+      width: the width of the time bins of `df` in minutes.
+      by: the columns of the groups summed separately, for example ['Pickup Census Tract'].
+      year: the year of the rows when `df` has no 'year' column.
+
+    Returns:
+      a pandas DataFrame with the index of `df` and one `<column>_trailing_<window>` column per column.
+    """
+    if window % width:
+        raise ValueError('the window must be a multiple of the bin width')
+    if 'year' in df.columns:
+        years = df['year']
+    elif year is not None:
+        years = np.full(len(df), year)
+    else:
+        raise ValueError('a year column or the year argument is needed to order the days')
+    dates = pd.to_datetime(pd.DataFrame({'year': np.asarray(years),
+                                         'month': df['pickup_month'].to_numpy(),
+                                         'day': df['pickup_date'].to_numpy()}))
+    day = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+    bins = MINUTES_PER_DAY//width
+    t = day*bins + minute_of_day(df)//width
+    t = t - t.min() if len(t) else t
+    w = window//width
+    span = int(t.max()) + 1 + w if len(t) else 0
+    if by:
+        codes, keys = analysis.factorize_keys(df, list(by))
+        t = t + codes*span
+        length = (len(keys) + 1)*span
+    else:
+        length = span
+    result = pd.DataFrame(index=df.index)
+    if length <= 4*len(df) + 1024:
+        position = t + w
+        for column in columns:
+            totals = np.bincount(position, df[column].to_numpy(np.float64), minlength=length + w)
+            prefix = np.concatenate([[0.0], np.cumsum(totals)])
+            result[column + '_trailing_' + str(window)] = prefix[position + 1] - prefix[position + 1 - w]
+    else:
+        # sparse bins: prefix sums over the rows sorted by time
+        order = np.argsort(t, kind='stable')
+        t_sorted = t[order]
+        last = np.searchsorted(t_sorted, t_sorted, side='right')
+        first = np.searchsorted(t_sorted, t_sorted - w, side='right')
+        for column in columns:
+            prefix = np.concatenate([[0.0], np.cumsum(df[column].to_numpy(np.float64)[order])])
+            sums = np.empty(len(df))
+            sums[order] = prefix[last] - prefix[first]
+            result[column + '_trailing_' + str(window)] = sums
+    return result
@@ -1,53 +1,164 @@
 import math
+import hashlib
+import functools
+import collections
 import numpy as np
-import matplotlib
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
-import statsmodels.formula.api as smf
-from adjustText import adjust_text
+import instrument
+import timebins
 
-matplotlib.rcParams.update(
-    {
-        "font.family": "serif",
-        "font.size": 12,
-        "pgf.rcfonts": False,
-        "axes.unicode_minus": False,
-        "axes.titlesize":14,
-        "axes.labelsize":14,
-        "xtick.labelsize":10,
-        "ytick.labelsize":10,
-        "figure.dpi":200,
-        "savefig.dpi":300,
-        "figure.figsize":(8,6),
-        "lines.linewidth":1.5
-    }
-)
+# matplotlib, statsmodels and adjustText are imported by the functions that draw or fit, so that
+# importing this module stays cheap for processes that only aggregate
+PLOT_STYLE = {
+    "font.family": "serif",
+    "font.size": 12,
+    "pgf.rcfonts": False,
+    "axes.unicode_minus": False,
+    "axes.titlesize":14,
+    "axes.labelsize":14,
+    "xtick.labelsize":10,
+    "ytick.labelsize":10,
+    "figure.dpi":200,
+    "savefig.dpi":300,
+    "figure.figsize":(8,6),
+    "lines.linewidth":1.5
+}
 
-def weekdaywiseplot(df, x, y, xlabel, ylabel, title):
-    df['interval'] = "AM Peak"
-    df.loc[(df['pickup_hour']>6) & (df['pickup_hour']<13), 'interval'] = "Mid-day"
-    df.loc[(df['pickup_hour']>=13) & (df['pickup_hour']<=18), 'interval'] = "PM Peak"
-    df.loc[(df['pickup_hour']>18) | (df['pickup_hour']<4), 'interval'] = "Night"
-    colors = {'Night':'blue', 'AM Peak':'orange', 'Mid-day':'green', 'PM Peak':'red'}
+# the label placements of the most recently drawn figures, least recently used first
+LABEL_CACHE_ENTRIES = 256
+_LABEL_CACHE = collections.OrderedDict()
+
+def place_labels(ax, xs, ys, labels, fontsize=8, max_iter=100, padding=2.0):
+    """
+    This function places text labels next to points so that they do not overlap each other or the
+    points, using a deterministic repulsion with a fixed iteration budget. Placements are cached by the
+    data, the labels and the axes geometry, so a re-render of the same figure reuses them; only the
+    last `LABEL_CACHE_ENTRIES` placements are kept.
+    
+    Args:
+      ax: the matplotlib axes the labels belong to. Its limits and size must be final.
+      xs: the x data coordinates of the points.
+      ys: the y data coordinates of the points.
+      labels: the label of each point.
+      fontsize: the font size of the labels, in points.
+      max_iter: the maximum number of repulsion steps.
+      padding: the gap kept around each label, in pixels.
+    
+    Returns:
+      a numpy array with the x and y data coordinates of the center of each label.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    labels = [str(label) for label in labels]
+    bbox = ax.get_window_extent()
+    key = hashlib.blake2b(repr((xs.tobytes(), ys.tobytes(), labels, ax.get_xlim(), ax.get_ylim(),
+                                bbox.width, bbox.height, fontsize, max_iter, padding)).encode(),
+                          digest_size=16).hexdigest()
+    if key in _LABEL_CACHE:
+        _LABEL_CACHE.move_to_end(key)
+        return _LABEL_CACHE[key]
+    to_pixels = ax.transData
+    points = to_pixels.transform(np.column_stack([xs, ys])) - [bbox.x0, bbox.y0]
+    pixels = ax.figure.dpi/72*fontsize
+    half = np.column_stack([np.array([len(label) for label in labels])*0.3*pixels + padding,
+                            np.full(len(labels), 0.5*pixels + padding)])
+    marker = 0.5*pixels
+    n = len(labels)
+    # start above and to the right of each point, alternating sides to spread dense clusters
+    side = np.where(np.arange(n) % 2 == 0, 1.0, -1.0)
+    centers = points + np.column_stack([side*(half[:, 0] + marker), half[:, 1] + marker])
+    low, high = half, np.array([bbox.width, bbox.height]) - half
+    for _ in range(max_iter):
+        delta = centers[:, None, :] - centers[None, :, :]
+        overlap = half[:, None, :] + half[None, :, :] - np.abs(delta)
+        collide = (overlap > 0).all(axis=2)
+        np.fill_diagonal(collide, False)
+        to_point = centers[:, None, :] - points[None, :, :]
+        point_overlap = half[:, None, :] + marker - np.abs(to_point)
+        hit = (point_overlap > 0).all(axis=2)
+        if not collide.any() and not hit.any():
+            break
+        # push along the axis of least overlap; ties on identical centers break by index order
+        tie = np.sign(np.subtract.outer(np.arange(n), np.arange(n)))[..., None]
+        direction = np.where(delta == 0, tie, np.sign(delta))
+        axis = overlap[..., 1] <= overlap[..., 0]
+        push = np.zeros((n, n, 2))
+        push[..., 1] = np.where(collide & axis, direction[..., 1]*overlap[..., 1]/2, 0)
+        push[..., 0] = np.where(collide & ~axis, direction[..., 0]*overlap[..., 0]/2, 0)
+        point_direction = np.sign(to_point)
+        point_direction[point_direction == 0] = 1
+        push[..., 1] += np.where(hit, point_direction[..., 1]*point_overlap[..., 1], 0)
+        centers = np.clip(centers + push.sum(axis=1), low, np.maximum(high, low))
+    positions = to_pixels.inverted().transform(centers + [bbox.x0, bbox.y0])
+    _LABEL_CACHE[key] = positions
+    while len(_LABEL_CACHE) > LABEL_CACHE_ENTRIES:
+        _LABEL_CACHE.popitem(last=False)
+    return positions
+
+def plot_style():
+    """
+    This function returns a context manager applying `PLOT_STYLE` to the figures drawn and saved inside
+    it, without changing the global matplotlib settings. Wrap `plt.savefig` in it to save at the
+    style's resolution.
+    """
+    import matplotlib
+    return matplotlib.rc_context(PLOT_STYLE)
+
+def styled(function):
+    """
+    This decorator draws the figures of a plotting function with `plot_style`.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with plot_style():
+            return function(*args, **kwargs)
+    return wrapper
+
+@instrument.traced
+@styled
+def weekdaywiseplot(df, x, y, xlabel, ylabel, title, fast=False):
+    """
+    This function plots y against x for each day of the week, with one panel per day, points colored
+    by period and labelled by hour.
+    
+    Args:
+      df: a pandas DataFrame returned by `df_day` or `df_day_Jan_Sep`.
+      x: The name of the column used for the x-axis.
+      y: The name of the column used for the y-axis.
+      xlabel: The label for the x-axis of the plot.
+      ylabel: The label for the y-axis of the plot.
+      title: The title of the plot
+      fast: a boolean selecting the fast renderer, which draws one scatter per panel and places the hour
+    labels with `place_labels` instead of adjustText. Defaults to False.
+    """
+    import matplotlib.cm as cm
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+    if not fast:
+        from adjustText import adjust_text
+    df['interval'] = timebins.periods(df)
 #     colors = {'Night':'#0077BB', 'AM Peak':'#DDAA33', 'Mid-day':'#BBCC33', 'PM Peak':'#CC3311'}
-    df['colors'] = df['interval'].map(colors)
+    df['colors'] = df['interval'].map(timebins.PERIOD_COLORS)
     figure, axes = plt.subplots(4,2, sharex=True, sharey=True, figsize=(10, 8))
     # figure.delaxes(axes[3,1])
     axes[3,1].axis('off')
     axes[2,1].xaxis.set_tick_params(labelbottom=True)
     j=1
+    panels = []
     for day in range(7):
         df1 = df[df['pickup_day'] == day]
         colors = cm.rainbow(np.linspace(0, 1, len(df1['pickup_hour'])))
         # because there are 52 weeks in a year, so divided the volume columns by 52
         ax_x,ax_y = math.floor((j-1)/2),j%2 -1
-        texts = []
-        for i, txt in enumerate(df1['pickup_hour']):
-            axes[ax_x,ax_y].scatter(df1.iloc[i][x], df1.iloc[i][y],s = df1.iloc[i]['d or n'], color = df1.iloc[i]['colors'], edgecolors='black', linewidths=0.5)
-            # axes[ax_x,ax_y].annotate((txt+3 if txt<=20 else txt-21), (df1.iloc[i][x], df1.iloc[i][y]),fontsize=10) # +np.random.choice([-0.02,0.02])
-            texts.append(axes[ax_x,ax_y].text(x = df1.iloc[i][x], y = df1.iloc[i][y], s = (txt+3 if txt<=20 else txt-21), fontsize=8) )
-        adjust_text(texts, only_move={'points':'y', 'texts':'xy'}, force_text=0.25, force_points=0.25, ax = axes[ax_x,ax_y],arrowprops=dict(arrowstyle='-', color='black', alpha=.5))
+        if fast:
+            axes[ax_x,ax_y].scatter(df1[x], df1[y], s=df1['d or n'], color=df1['colors'].tolist(), edgecolors='black', linewidths=0.5)
+            panels.append((axes[ax_x,ax_y], df1))
+        else:
+            texts = []
+            for i, txt in enumerate(df1['pickup_hour']):
+                axes[ax_x,ax_y].scatter(df1.iloc[i][x], df1.iloc[i][y],s = df1.iloc[i]['d or n'], color = df1.iloc[i]['colors'], edgecolors='black', linewidths=0.5)
+                # axes[ax_x,ax_y].annotate((txt+3 if txt<=20 else txt-21), (df1.iloc[i][x], df1.iloc[i][y]),fontsize=10) # +np.random.choice([-0.02,0.02])
+                texts.append(axes[ax_x,ax_y].text(x = df1.iloc[i][x], y = df1.iloc[i][y], s = (txt+3 if txt<=20 else txt-21), fontsize=8) )
+            adjust_text(texts, only_move={'points':'y', 'texts':'xy'}, force_text=0.25, force_points=0.25, ax = axes[ax_x,ax_y],arrowprops=dict(arrowstyle='-', color='black', alpha=.5))
         axes[ax_x,ax_y].plot(df1[x], df1[y], '0.8')
         axes[ax_x,ax_y].set_title(df1.iloc[0]['weekday'], fontsize=12)
         j=j+1
@@ -60,8 +171,18 @@ def weekdaywiseplot(df, x, y, xlabel, ylabel, title):
     figure.supxlabel(xlabel)
     figure.supylabel(ylabel)
     figure.tight_layout()
+    # labels are placed last, once the shared limits and the panel sizes are final
+    for ax, df1 in panels:
+        hours = df1['pickup_hour'].to_numpy()
+        labels = np.where(hours<=20, hours+3, hours-21)
+        positions = place_labels(ax, df1[x], df1[y], labels, fontsize=8)
+        for label, (px, py), (tx, ty) in zip(labels, zip(df1[x], df1[y]), positions):
+            ax.annotate(label, (px, py), xytext=(tx, ty), fontsize=8, ha='center', va='center',
+                        arrowprops=dict(arrowstyle='-', color='black', alpha=.5, shrinkA=0, shrinkB=0))
 
-def periodplot_agg(df, x, y, xlabel, ylabel, title,r_type):
+@instrument.traced
+@styled
+def periodplot_agg(df, x, y, xlabel, ylabel, title,r_type, band=None):
     """
     This is a Python function that creates a period plot with different transformations of the x-axis
     and fits a regression line based on the chosen transformation type.
@@ -76,7 +197,11 @@ def periodplot_agg(df, x, y, xlabel, ylabel, title,r_type):
       title: The title of the plot
       r_type: The type of regression to perform on the data. It can be "reciprocal", "linear", "sqrt",
     "log", or "reciprocal_offset".
+      band: an optional confidence band to shade, such as `bootstrap_fit(...)['bands'][None]`.
     """
+    import matplotlib.pyplot as plt
+    if r_type in ("reciprocal", "linear", "sqrt", "log", "reciprocal_offset"):
+        import statsmodels.formula.api as smf
     figure, axes = plt.subplots()
     df1 = df.copy()
     x1=df1[x]
@@ -91,27 +216,27 @@ def periodplot_agg(df, x, y, xlabel, ylabel, title,r_type):
         axes.scatter(df1[x], df1[y], alpha=0.2)
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
         x_trans_range = 1/x_range
-        axes.plot(x_range, results.params[1]*x_trans_range+results.params[0], c='black', linewidth=3.0, linestyle='dashed')
+        axes.plot(x_range, results.params.iloc[1]*x_trans_range+results.params.iloc[0], c='black', linewidth=3.0, linestyle='dashed')
     elif r_type == "linear":
         results = smf.ols(y+' ~ '+x, data=df1).fit()
         print(results.mse_resid)
         axes.scatter(df1[x], df1[y], alpha=0.2)
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
-        axes.plot(x_range, results.params[1]*x_range+results.params[0], c='black', linewidth=3.0, linestyle='dashed')
+        axes.plot(x_range, results.params.iloc[1]*x_range+results.params.iloc[0], c='black', linewidth=3.0, linestyle='dashed')
     elif r_type == "sqrt":
         results = smf.ols(y+' ~ sqrt', data=df1).fit()
         print(results.mse_resid)
         axes.scatter(df1[x], df1[y], alpha=0.2)
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
         x_trans_range = np.sqrt(x_range)
-        axes.plot(x_range, results.params[1]*x_trans_range+results.params[0], c='black', linewidth=3.0, linestyle='dashed')
+        axes.plot(x_range, results.params.iloc[1]*x_trans_range+results.params.iloc[0], c='black', linewidth=3.0, linestyle='dashed')
     elif r_type == "log":
         results = smf.ols('logy ~ logx', data=df1).fit()
         print(results.mse_resid)
         axes.scatter(df1[x], df1[y], alpha=0.2)
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
         x_trans_range = np.log10(x_range-math.floor(min(x1))+0.01)
-        axes.plot(x_range, 10**(results.params[1]*x_trans_range+results.params[0]), c='black', linewidth=3.0, linestyle='dashed')
+        axes.plot(x_range, 10**(results.params.iloc[1]*x_trans_range+results.params.iloc[0]), c='black', linewidth=3.0, linestyle='dashed')
     elif r_type == "reciprocal_offset":
         results = smf.ols(y+' ~ reciprocal_offset', data=df1).fit()
         print(results.mse_resid)
@@ -119,16 +244,20 @@ def periodplot_agg(df, x, y, xlabel, ylabel, title,r_type):
         axes.scatter(df1[x], df1[y], alpha=0.2)
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
         x_trans_range = 1/(x_range-min(x1)+0.01)
-        axes.plot(x_range, results.params[1]*x_trans_range+results.params[0], c='black', linewidth=3.0, linestyle='dashed')
+        axes.plot(x_range, results.params.iloc[1]*x_trans_range+results.params.iloc[0], c='black', linewidth=3.0, linestyle='dashed')
     else:
         axes.scatter(df1[x], df1[y], alpha=0.2)
+    if band is not None:
+        axes.fill_between(band['x'], band['lower'], band['upper'], color='black', alpha=0.15, linewidth=0)
     plt.title(title)
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.tight_layout()
     # plt.legend(loc="lower right",  prop={'size': 12})
     
-def periodplot_disagg(df, x, y, xlabel, ylabel, title):
+@instrument.traced
+@styled
+def periodplot_disagg(df, x, y, xlabel, ylabel, title, bands=None):
     """
     This function creates a scatter plot with a regression line for different time intervals and
     calculates the mean squared error and parameters of the regression model.
@@ -140,24 +269,20 @@ def periodplot_disagg(df, x, y, xlabel, ylabel, title):
       xlabel: The label for the x-axis of the plot.
       ylabel: The label for the y-axis of the plot.
       title: The title of the plot
+      bands: an optional dictionary of confidence bands per period to shade, such as
+    `bootstrap_fit(..., effects=True)['bands']`.
     """
-    df['interval'] = "AM Peak"
-    df.loc[(df['pickup_hour']>6) & (df['pickup_hour']<13), 'interval'] = "Mid-day"
-    df.loc[(df['pickup_hour']>=13) & (df['pickup_hour']<=18), 'interval'] = "PM Peak"
-    df.loc[(df['pickup_hour']>18) | (df['pickup_hour']<4), 'interval'] = "Night"
+    import matplotlib.pyplot as plt
+    import statsmodels.formula.api as smf
+    df['interval'] = timebins.periods(df)
     df1 = df.copy()
-    df1['interval_cat']=0
-    df1.loc[(df1['pickup_hour']>6) & (df1['pickup_hour']<13), 'interval_cat']=1
-    df1.loc[(df1['pickup_hour']>=13) & (df1['pickup_hour']<=18), 'interval_cat']=2
-    df1.loc[(df1['pickup_hour']>18) | (df1['pickup_hour']<4), 'interval_cat']=3
+    df1['interval_cat'] = df1['interval'].map({'AM Peak':0, 'Mid-day':1, 'PM Peak':2, 'Night':3}).astype(int)
     df1['sqrt'] = np.sqrt(df1[x])
     results = smf.ols(y+" ~ sqrt + C(interval, Treatment('Night'))", data=df1).fit()
     print(results.mse_resid)
     print(results.params)
-    colors = {'Night':'blue', 'AM Peak':'orange', 'Mid-day':'green', 'PM Peak':'red'}
-    symbols = {'Night':'o', 'AM Peak':'^', 'Mid-day':'s', 'PM Peak':'D'}
-    df1['colors'] = df1['interval'].map(colors)
-    df1['markers'] = df1['interval'].map(symbols)
+    df1['colors'] = df1['interval'].map(timebins.PERIOD_COLORS)
+    df1['markers'] = df1['interval'].map(timebins.PERIOD_MARKERS)
     figure, axes = plt.subplots()
     for interval in df1['interval'].unique():
         df2 = df1[df1['interval'] == interval]
@@ -166,22 +291,26 @@ def periodplot_disagg(df, x, y, xlabel, ylabel, title):
         x_range = np.linspace(math.floor(min(x1)), math.ceil(max(x1)), num=20)
         x_trans_range = np.sqrt(x_range)
         if interval == "Night":
-            aa = results.params[0]
+            aa = results.params.iloc[0]
         elif interval == "AM Peak":
-            aa = results.params[0]+results.params[1]
+            aa = results.params.iloc[0]+results.params.iloc[1]
         elif interval == "Mid-day":
-            aa = results.params[0]+results.params[2]
+            aa = results.params.iloc[0]+results.params.iloc[2]
         else:
-            aa = results.params[0]+results.params[3]
-        axes.plot(x_range, results.params[4]*x_trans_range+aa,
+            aa = results.params.iloc[0]+results.params.iloc[3]
+        axes.plot(x_range, results.params.iloc[4]*x_trans_range+aa,
                   c=df2['colors'].iloc[0], linewidth=5.0, linestyle='dashed')
+        if bands is not None and interval in bands:
+            band = bands[interval]
+            axes.fill_between(band['x'], band['lower'], band['upper'], color=df2['colors'].iloc[0], alpha=0.15, linewidth=0)
     plt.title(title)
     plt.legend(loc="lower right",  prop={'size': 12})
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.tight_layout()
        
-def plot_willingness_to_share(df, title):
+@instrument.traced
+def plot_willingness_to_share(df, title, fast=False):
     """
     This function plots the willingness-to-share against the average number of trips for a given dataset
     and title.
@@ -189,14 +318,16 @@ def plot_willingness_to_share(df, title):
     Args:
       df: a pandas DataFrame containing the data to be plotted
       title: The title of the plot.
+      fast: a boolean selecting the fast renderer of `weekdaywiseplot`. Defaults to False.
     """
     x = 'count_total'
     y = 'requested_per'
     xlabel = r"Average number of trips $n^a_n(h,d)$"
     ylabel = r"Willingness-to-share $\theta_{s_a,n}(h,d)$"
-    weekdaywiseplot(df, x, y, xlabel, ylabel, title)
+    weekdaywiseplot(df, x, y, xlabel, ylabel, title, fast)
 
-def plot_match_rate(df, title, fit , disaggregate = False):
+@instrument.traced
+def plot_match_rate(df, title, fit , disaggregate = False, bands = None):
     """
     This function plots a match rate against the number of authorized shared trips, with the option to
     disaggregate the data.
@@ -211,17 +342,20 @@ def plot_match_rate(df, title, fit , disaggregate = False):
     certain variable or not. If set to True, the function will call the periodplot_disagg() function to
     plot the data disaggregated by a certain variable. If set to False, the function will call the
     periodplot_agg(). Defaults to False
+      bands: the optional 'bands' of `bootstrap.bootstrap_fit` to shade around the fitted curves.
     """
     x = 'count_shared_requested_mean'
     y = 'matched_percent'
     xlabel = r"Number of authorized shared trips $n_{s_a,n}^a(h,d,m)$"
     ylabel = r'Matched percentage $\theta_{s_m,n}(h,d,m)$'
     if not disaggregate:
-        periodplot_agg(df, x, y, xlabel, ylabel, title, fit)
+        periodplot_agg(df, x, y, xlabel, ylabel, title, fit,
+                       None if bands is None else bands.get(None))
     else:
-        periodplot_disagg(df, x, y, xlabel, ylabel, title)
+        periodplot_disagg(df, x, y, xlabel, ylabel, title, bands)
 
-def plot_unit_fare_ratio(df, title, fit, disaggregate = False):
+@instrument.traced
+def plot_unit_fare_ratio(df, title, fit, disaggregate = False, bands = None):
     """
     This function plots the unit fare ratio against the total number of trips, with the option to
     disaggregate the data.
@@ -234,13 +368,15 @@ def plot_unit_fare_ratio(df, title, fit, disaggregate = False):
       disaggregate: A boolean parameter that determines whether the plot should be disaggregated or not.
     If set to True, the plot will show data for each individual category in the dataset. If set to
     False, the plot will show aggregated data for the entire dataset. Defaults to False
+      bands: the optional 'bands' of `bootstrap.bootstrap_fit` to shade around the fitted curves.
     """
     x = 'count_mean_total'
     y = 'cost_ratio_mile'
     xlabel = r'Total number of trips $n^a(h,d,m)$'
     ylabel = r'Unit fare ratio $e^d(h,d,m)$'
     if not disaggregate:
-        periodplot_agg(df, x, y, xlabel, ylabel, title, fit)
+        periodplot_agg(df, x, y, xlabel, ylabel, title, fit,
+                       None if bands is None else bands.get(None))
     else:
-        periodplot_disagg(df, x, y, xlabel, ylabel, title)
+        periodplot_disagg(df, x, y, xlabel, ylabel, title, bands)
    